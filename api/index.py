@@ -1,73 +1,3045 @@
-from http.server import BaseHTTPRequestHandler
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.client import HTTPMessage
 from urllib.parse import urlparse, parse_qs
 import json
 import os
-import requests
+import re
+import time
+import tempfile
+import hashlib
+import hmac
+import threading
+import queue
+import secrets
+import signal
+import argparse
+import contextvars
+import math
+import random
+import sqlite3
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import base64
-from openai import OpenAI
+import gzip
+import io
+import sys
 
-class handler(BaseHTTPRequestHandler):
-    def do_OPTIONS(self):
-        # CORS preflight
-        self.send_response(204)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-        self.end_headers()
+# openai, httpx, requests, Pillow и asyncio импортируются в функциях, которые с ними работают:
+# холодный старт ради страницы или логина не платит за их загрузку (~0.4 с)
+
+try:
+    import brotli
+except ImportError:
+    # Без brotli страницы отдаются в gzip
+    brotli = None
+
+_pil_image = None
+_pil_image_lock = threading.Lock()
+
+
+def pil_image():
+    """Модуль PIL.Image при первом обращении или None, если Pillow не установлен"""
+    global _pil_image
+    if _pil_image is None:
+        with _pil_image_lock:
+            if _pil_image is None:
+                try:
+                    from PIL import Image
+                except ImportError:
+                    # Без Pillow превью не строятся, страница грузит оригиналы
+                    Image = False
+                _pil_image = Image
+    return _pil_image or None
+
+
+def _env_int(name, default):
+    """Читает целое число из окружения"""
+    try:
+        return int(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _env_float(name, default):
+    """Читает число с плавающей точкой из окружения"""
+    try:
+        return float(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+# Метрики процесса в текстовом формате Prometheus
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 60.0, 120.0, 240.0)
+BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(10))
+STAGE_LABELS = ('stage', 'model', 'size', 'quality')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + list(extra or [])
+    if not pairs:
+        return ''
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{name}="{value}"')
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    """Монотонный счетчик с метками"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, labels, (), value) for labels, value in self._values.items()]
+
+
+class Gauge:
+    """Текущее значение, снимаемое функцией в момент выгрузки"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, read):
+        self.name = name
+        self.help = help_text
+        self.labels = ()
+        self._read = read
+
+    def samples(self):
+        return [(self.name, (), (), self._read())]
+
+
+class Histogram:
+    """Гистограмма с фиксированными границами корзин"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        result = []
+        with self._lock:
+            for labels, (counts, total, count) in self._series.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    result.append((self.name + '_bucket', labels, (('le', repr(float(bound))),), cumulative))
+                result.append((self.name + '_bucket', labels, (('le', '+Inf'),), count))
+                result.append((self.name + '_sum', labels, (), total))
+                result.append((self.name + '_count', labels, (), count))
+        return result
+
+
+class MetricsRegistry:
+    """Набор метрик процесса и их выгрузка для Prometheus"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Текстовый формат экспозиции Prometheus 0.0.4"""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, extra, value in metric.samples():
+                lines.append(f'{name}{_format_labels(metric.labels, labels, extra)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+request_count = metrics.register(Counter(
+    'imagegen_requests_total', 'HTTP requests by method, route and status.', ('method', 'route', 'status')))
+request_duration = metrics.register(Histogram(
+    'imagegen_request_duration_seconds', 'HTTP request duration.', ('method', 'route')))
+error_count = metrics.register(Counter(
+    'imagegen_errors_total', 'Failed requests and generations by error type.', ('type',)))
+stage_duration = metrics.register(Histogram(
+    'imagegen_stage_duration_seconds', 'Duration of request stages.', STAGE_LABELS))
+stage_bytes = metrics.register(Histogram(
+    'imagegen_stage_bytes', 'Bytes processed by request stages.', STAGE_LABELS, BYTES_BUCKETS))
+
+
+def record_error(error):
+    """Учитывает ошибку в счетчике по имени ее класса"""
+    error_count.inc((type(error).__name__,))
+
+
+# Трассировка запросов: Server-Timing, отладочный trace в ответе и пересылка во внешний коллектор
+TRACE_DEBUG = os.environ.get('TRACE_DEBUG', '').lower() in ('1', 'true', 'yes')
+TRACE_COLLECTOR_URL = os.environ.get('TRACE_COLLECTOR_URL', '')
+TRACE_COLLECTOR_QUEUE = _env_int('TRACE_COLLECTOR_QUEUE', 1000)
+span_hooks = []
+
+
+def add_span_hook(hook):
+    """Регистрирует hook(trace), который получает спаны каждого завершенного запроса"""
+    span_hooks.append(hook)
+    return hook
+
+
+class StageTimer:
+    """Длительности и объемы этапов одного запроса или задания"""
+
+    # Контекст, а не thread-local: у каждого потока и каждой asyncio задачи свой текущий таймер
+    _current = contextvars.ContextVar('stage_timer', default=None)
+
+    def __init__(self, name=''):
+        self.name = name
+        self.status = None
+        self.trace_id = secrets.token_hex(16)
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+        self.labels = ('', '', '')
+        self.stages = []
+        self._flushed = False
+        self._lock = threading.Lock()
+
+    def set_params(self, params):
+        """Метки модели, размера и качества для гистограмм этапов"""
+        self.labels = (params.get('model') or '', params.get('size') or '', params.get('quality') or '')
+
+    def record(self, stage, seconds, nbytes=None, started=None):
+        if started is None:
+            started = time.perf_counter() - seconds
+        with self._lock:
+            if self._flushed:
+                # Фоновый поток закончил после ответа, пишем сразу в гистограммы
+                observe_stage(stage, self.labels, seconds, nbytes)
+            else:
+                self.stages.append((stage, started, seconds, nbytes))
+
+    def totals(self):
+        """Время, число и объем по этапам в порядке первого появления"""
+        intervals = OrderedDict()
+        with self._lock:
+            for stage, started, seconds, nbytes in self.stages:
+                intervals.setdefault(stage, []).append((started, started + seconds, nbytes or 0))
+        totals = OrderedDict()
+        for stage, spans in intervals.items():
+            # Параллельные вызовы (деление n, потоковые изображения) считаем по стеновым часам, а не суммой
+            wall = 0.0
+            end = None
+            for span_start, span_end, _ in sorted(spans):
+                if end is None or span_start > end:
+                    wall += span_end - span_start
+                    end = span_end
+                elif span_end > end:
+                    wall += span_end - end
+                    end = span_end
+            totals[stage] = {'ms': wall * 1000, 'count': len(spans), 'bytes': sum(span[2] for span in spans)}
+        return totals
+
+    def timings(self):
+        """Краткая разбивка для клиента: общее время и миллисекунды по этапам"""
+        return {
+            'total_ms': round((time.perf_counter() - self.started) * 1000, 1),
+            'stages': {stage: round(total['ms'], 1) for stage, total in self.totals().items()},
+        }
+
+    def server_timing(self):
+        """Значение заголовка Server-Timing по уже завершенным этапам"""
+        parts = []
+        for stage, total in self.totals().items():
+            # Число вызовов этапа уходит в desc
+            desc = f';desc="x{total["count"]}"' if total['count'] > 1 else ''
+            parts.append(f'{stage};dur={total["ms"]:.1f}{desc}')
+        parts.append(f'total;dur={(time.perf_counter() - self.started) * 1000:.1f}')
+        return ', '.join(parts)
+
+    def trace(self):
+        """Запрос целиком со спанами этапов относительно его начала"""
+        with self._lock:
+            stages = list(self.stages)
+        return {
+            'trace_id': self.trace_id,
+            'name': self.name,
+            'status': self.status,
+            'started_at': self.started_at,
+            'duration_ms': round((time.perf_counter() - self.started) * 1000, 3),
+            'model': self.labels[0],
+            'size': self.labels[1],
+            'quality': self.labels[2],
+            'spans': [{
+                'stage': stage,
+                'start_ms': round((started - self.started) * 1000, 3),
+                'duration_ms': round(seconds * 1000, 3),
+                'bytes': nbytes,
+            } for stage, started, seconds, nbytes in stages],
+        }
+
+    def flush(self):
+        """Переносит накопленные этапы в гистограммы с итоговыми метками и отдает trace в hooks"""
+        trace = self.trace() if span_hooks else None
+        with self._lock:
+            stages, self.stages = self.stages, []
+            self._flushed = True
+        for stage, _, seconds, nbytes in stages:
+            observe_stage(stage, self.labels, seconds, nbytes)
+        for hook in span_hooks:
+            try:
+                hook(trace)
+            except Exception:
+                # Трассировка не должна ломать обработку запроса
+                pass
+        return stages
+
+    def activate(self):
+        """Делает таймер текущим для потока или задачи на время блока with"""
+        return _ActiveStageTimer(self)
+
+    @classmethod
+    def current(cls):
+        return cls._current.get()
+
+
+class _ActiveStageTimer:
+    def __init__(self, timer):
+        self.timer = timer
+
+    def __enter__(self):
+        self.token = StageTimer._current.set(self.timer)
+        return self.timer
+
+    def __exit__(self, exc_type, exc, tb):
+        StageTimer._current.reset(self.token)
+
+
+class _StageSpan:
+    def __init__(self, stage):
+        self.stage = stage
+        self.bytes = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        record_stage(self.stage, time.perf_counter() - self.started, self.bytes, self.started)
+
+
+def observe_stage(stage, labels, seconds, nbytes=None):
+    stage_duration.observe(seconds, (stage,) + labels)
+    if nbytes is not None:
+        stage_bytes.observe(nbytes, (stage,) + labels)
+
+
+def record_stage(stage, seconds, nbytes=None, started=None):
+    """Пишет этап в таймер текущего потока, без таймера сразу в гистограммы"""
+    timer = StageTimer.current()
+    if timer is not None:
+        timer.record(stage, seconds, nbytes, started)
+    else:
+        observe_stage(stage, ('', '', ''), seconds, nbytes)
+
+
+def measure_stage(stage):
+    """Замеряет блок with как этап текущего запроса; объем задается через span.bytes"""
+    return _StageSpan(stage)
+
+
+def with_stage_timer(fn):
+    """Переносит таймер текущего запроса в поток, где будет выполнена fn"""
+    timer = StageTimer.current()
+    if timer is None:
+        return fn
+
+    def run(*args, **kwargs):
+        with timer.activate():
+            return fn(*args, **kwargs)
+    return run
+
+
+class TraceCollectorForwarder:
+    """Span hook: отправляет trace запросов JSON-ом в локальный коллектор из фонового потока"""
+
+    def __init__(self, url, queue_size=TRACE_COLLECTOR_QUEUE):
+        self.url = url
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def __call__(self, trace):
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            # Коллектор не успевает, запросы из-за него не тормозим
+            self.dropped += 1
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._worker, name='trace-forwarder', daemon=True)
+                self._thread.start()
+
+    def _worker(self):
+        import requests
+
+        session = requests.Session()
+        while True:
+            trace = self._queue.get()
+            try:
+                session.post(self.url, json=trace, timeout=2)
+            except requests.exceptions.RequestException:
+                self.dropped += 1
+
+
+if TRACE_COLLECTOR_URL:
+    add_span_hook(TraceCollectorForwarder(TRACE_COLLECTOR_URL))
+
+
+# Настройки пула соединений к OpenAI
+OPENAI_POOL_MAX_CONNECTIONS = _env_int('OPENAI_POOL_MAX_CONNECTIONS', 20)
+OPENAI_POOL_MAX_KEEPALIVE = _env_int('OPENAI_POOL_MAX_KEEPALIVE', 10)
+OPENAI_POOL_KEEPALIVE_EXPIRY = _env_float('OPENAI_POOL_KEEPALIVE_EXPIRY', 60.0)
+OPENAI_CLIENT_IDLE_TTL = _env_float('OPENAI_CLIENT_IDLE_TTL', 900.0)
+OPENAI_TIMEOUT = _env_float('OPENAI_TIMEOUT', 180.0)
+
+
+class OpenAIClientRegistry:
+    """Процессный реестр OpenAI клиентов поверх общего keep-alive пула соединений"""
+
+    def __init__(self, max_connections=OPENAI_POOL_MAX_CONNECTIONS,
+                 max_keepalive=OPENAI_POOL_MAX_KEEPALIVE,
+                 keepalive_expiry=OPENAI_POOL_KEEPALIVE_EXPIRY,
+                 idle_ttl=OPENAI_CLIENT_IDLE_TTL,
+                 timeout=OPENAI_TIMEOUT):
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.keepalive_expiry = keepalive_expiry
+        self.idle_ttl = idle_ttl
+        self.timeout = timeout
+        self._http_client = None
+        self._clients = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _shared_http_client(self):
+        # Один httpx клиент на процесс: соединения переиспользуются между всеми ключами
+        if self._http_client is None:
+            import httpx
+            from openai import DefaultHttpxClient
+
+            self._http_client = DefaultHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_keepalive,
+                    keepalive_expiry=self.keepalive_expiry,
+                ),
+                timeout=httpx.Timeout(self.timeout, connect=10.0),
+            )
+        return self._http_client
+
+    def _evict_idle(self, now):
+        # Убираем клиентов, которыми давно не пользовались
+        expired = [key for key, (_, last_used) in self._clients.items()
+                   if now - last_used > self.idle_ttl]
+        for key in expired:
+            del self._clients[key]
+            self.evictions += 1
+
+    @staticmethod
+    def client_key(api_key, base_url=None):
+        """Ключ клиента и итоговый base_url; ключ API хранится в виде хеша, чтобы не держать секрет в словаре"""
+        base_url = base_url or os.environ.get('OPENAI_BASE_URL') or None
+        return (hashlib.sha256(api_key.encode('utf-8')).hexdigest(), base_url or ''), base_url
+
+    def get(self, api_key, base_url=None):
+        """Возвращает закешированный клиент для пары (api_key, base_url)"""
+        key, base_url = self.client_key(api_key, base_url)
+        now = time.monotonic()
+
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._clients.get(key)
+            if entry is not None:
+                self.hits += 1
+                self._clients[key] = (entry[0], now)
+                return entry[0]
+
+            self.misses += 1
+            from openai import OpenAI
+
+            # Повторы делает наш слой устойчивости, встроенные повторы SDK выключены
+            client = OpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                http_client=self._shared_http_client(),
+                max_retries=0,
+            )
+            self._clients[key] = (client, now)
+            return client
+
+    def stats(self):
+        """Счетчики попаданий/промахов реестра"""
+        with self._lock:
+            return {
+                'clients': len(self._clients),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'max_connections': self.max_connections,
+                'max_keepalive_connections': self.max_keepalive,
+                'keepalive_expiry': self.keepalive_expiry,
+            }
+
+
+openai_clients = OpenAIClientRegistry()
+
+
+# Настройки загрузки изображений по URL (путь dall-e-2/dall-e-3)
+IMAGE_DOWNLOAD_WORKERS = _env_int('IMAGE_DOWNLOAD_WORKERS', 8)
+IMAGE_DOWNLOAD_TIMEOUT = _env_float('IMAGE_DOWNLOAD_TIMEOUT', 60.0)
+IMAGE_DOWNLOAD_RETRIES = _env_int('IMAGE_DOWNLOAD_RETRIES', 2)
+# Меньше этого остатка бюджета времени повторять загрузку уже нет смысла
+IMAGE_DOWNLOAD_MIN_ATTEMPT = _env_float('IMAGE_DOWNLOAD_MIN_ATTEMPT', 5.0)
+IMAGE_DOWNLOAD_MAX_BYTES = _env_int('IMAGE_DOWNLOAD_MAX_BYTES', 25 * 1024 * 1024)
+IMAGE_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class ImageDownloadError(Exception):
+    """Ошибка загрузки конкретного изображения"""
+
+    def __init__(self, index, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.index = index
+        self.status = status
+        self.retry_after = retry_after
+
+
+_download_session = None
+_download_executor = None
+_download_lock = threading.Lock()
+
+
+def _get_download_pool():
+    """Общая requests-сессия и пул потоков для загрузок"""
+    global _download_session, _download_executor
+    with _download_lock:
+        if _download_session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=IMAGE_DOWNLOAD_WORKERS)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _download_session = session
+            _download_executor = ThreadPoolExecutor(
+                max_workers=IMAGE_DOWNLOAD_WORKERS,
+                thread_name_prefix='image-download',
+            )
+        return _download_session, _download_executor
+
+
+def _check_image_response(status_code, headers, index):
+    """Проверяет статус и объявленный размер ответа до чтения тела"""
+    if status_code != 200:
+        raise ImageDownloadError(
+            index,
+            f'Ошибка загрузки изображения {index + 1}',
+            status_code,
+            parse_retry_after(headers),
+        )
+
+    declared = headers.get('Content-Length')
+    if declared and declared.isdigit() and int(declared) > IMAGE_DOWNLOAD_MAX_BYTES:
+        raise ImageDownloadError(index, f'Изображение {index + 1} превышает допустимый размер')
+
+
+def _append_chunk(buffer, chunk, index):
+    buffer += chunk
+    if len(buffer) > IMAGE_DOWNLOAD_MAX_BYTES:
+        raise ImageDownloadError(index, f'Изображение {index + 1} превышает допустимый размер')
+
+
+def _fetch_image(session, url, index, timeout=IMAGE_DOWNLOAD_TIMEOUT):
+    """Потоково скачивает одно изображение с ограничением размера и общего времени"""
+    import requests
+
+    # Таймаут requests действует на каждое чтение, общий срок загрузки проверяем сами
+    expires = time.monotonic() + timeout
+    with session.get(url, timeout=timeout, stream=True) as response:
+        _check_image_response(response.status_code, response.headers, index)
+        buffer = bytearray()
+        for chunk in response.iter_content(chunk_size=IMAGE_DOWNLOAD_CHUNK_SIZE):
+            _append_chunk(buffer, chunk, index)
+            if time.monotonic() > expires:
+                raise requests.exceptions.Timeout(f'Загрузка изображения {index + 1} не уложилась в {timeout:.0f} с')
+        return bytes(buffer)
+
+
+async def _fetch_image_async(http_client, url, index, timeout=IMAGE_DOWNLOAD_TIMEOUT):
+    """Асинхронный вариант _fetch_image поверх httpx.AsyncClient"""
+    import httpx
+
+    expires = time.monotonic() + timeout
+    async with http_client.stream('GET', url, timeout=timeout) as response:
+        _check_image_response(response.status_code, response.headers, index)
+        buffer = bytearray()
+        async for chunk in response.aiter_bytes(IMAGE_DOWNLOAD_CHUNK_SIZE):
+            _append_chunk(buffer, chunk, index)
+            if time.monotonic() > expires:
+                raise httpx.ReadTimeout(f'Загрузка изображения {index + 1} не уложилась в {timeout:.0f} с')
+        return bytes(buffer)
+
+
+def download_image(url, index=0, deadline=None):
+    """Скачивает изображение через слой повторов и circuit breaker загрузок"""
+    session, _ = _get_download_pool()
+    import requests
+
+    try:
+        return download_retry.call(
+            lambda timeout: _fetch_image(session, url, index, timeout), download_breaker, deadline)
+    except requests.exceptions.RequestException as e:
+        raise ImageDownloadError(index, f'Ошибка загрузки: {str(e)}')
+
+
+def download_images(urls, deadline=None):
+    """Параллельно скачивает изображения, сохраняя порядок"""
+    if not urls:
+        return []
+    _, executor = _get_download_pool()
+    futures = [executor.submit(download_image, url, i, deadline) for i, url in enumerate(urls)]
+    return [future.result() for future in futures]
+
+
+async def download_image_async(http_client, url, index=0, deadline=None):
+    """Скачивает изображение без блокировки потока, с теми же повторами и circuit breaker"""
+    import httpx
+
+    try:
+        return await download_retry.call_async(
+            lambda timeout: _fetch_image_async(http_client, url, index, timeout), download_breaker, deadline)
+    except httpx.HTTPError as e:
+        raise ImageDownloadError(index, f'Ошибка загрузки: {str(e)}')
+
+
+async def download_images_async(http_client, urls, deadline=None):
+    """Параллельно скачивает изображения в цикле событий, сохраняя порядок"""
+    import asyncio
+
+    return list(await asyncio.gather(
+        *(download_image_async(http_client, url, i, deadline) for i, url in enumerate(urls))))
+
+
+# Настройки хранилища изображений (на Vercel писать можно только в /tmp)
+IMAGE_STORE_DIR = os.environ.get('IMAGE_STORE_DIR') or os.path.join(tempfile.gettempdir(), 'imagegen-images')
+IMAGE_STORE_MAX_BYTES = _env_int('IMAGE_STORE_MAX_BYTES', 512 * 1024 * 1024)
+IMAGE_STORE_MAX_AGE = _env_float('IMAGE_STORE_MAX_AGE', 7 * 24 * 3600.0)
+IMAGE_STORE_SWEEP_INTERVAL = _env_float('IMAGE_STORE_SWEEP_INTERVAL', 300.0)
+IMAGE_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+def sniff_image_type(head):
+    """Определяет MIME тип изображения по первым байтам"""
+    if head.startswith(b'\x89PNG'):
+        return 'image/png'
+    if head.startswith(b'\xff\xd8'):
+        return 'image/jpeg'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'application/octet-stream'
+
+
+class ImageStore:
+    """Контентно-адресуемое хранилище изображений на диске"""
+
+    def __init__(self, root=IMAGE_STORE_DIR, max_bytes=IMAGE_STORE_MAX_BYTES,
+                 max_age=IMAGE_STORE_MAX_AGE, sweep_interval=IMAGE_STORE_SWEEP_INTERVAL):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.sweep_interval = sweep_interval
+        self._lock = threading.Lock()
+        self._total_bytes = None
+        self._last_sweep = 0.0
+
+    def path(self, image_id):
+        """Путь к файлу изображения или None для некорректного ID"""
+        if not IMAGE_ID_RE.match(image_id or ''):
+            return None
+        return os.path.join(self.root, image_id[:2], image_id)
+
+    def put(self, content):
+        """Сохраняет байты изображения и возвращает его ID"""
+        image_id = hashlib.sha256(content).hexdigest()[:32]
+        path = self.path(image_id)
+
+        if os.path.exists(path):
+            # Дубликат: только обновляем время, чтобы файл не вытеснили
+            os.utime(path, None)
+            return image_id
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+        with self._lock:
+            if self._total_bytes is not None:
+                self._total_bytes += len(content)
+        self.maybe_evict()
+        return image_id
+
+    def open(self, image_id):
+        """Открывает изображение на чтение или возвращает None"""
+        path = self.path(image_id)
+        if path is None:
+            return None
+        try:
+            return open(path, 'rb')
+        except FileNotFoundError:
+            return None
+
+    def link_derivative(self, image_id, kind, derived_id):
+        """Запоминает производное изображение (например, превью) для оригинала"""
+        path = self.path(image_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f'{path}.{kind}', 'w', encoding='ascii') as f:
+            f.write(derived_id)
+
+    def get_derivative(self, image_id, kind):
+        """ID производного изображения или None, если его нет или оно вытеснено"""
+        path = self.path(image_id)
+        if path is None:
+            return None
+        try:
+            with open(f'{path}.{kind}', 'r', encoding='ascii') as f:
+                derived_id = f.read().strip()
+        except OSError:
+            return None
+        derived_path = self.path(derived_id)
+        return derived_id if derived_path and os.path.exists(derived_path) else None
+
+    def maybe_evict(self):
+        """Запускает очистку, если превышен размер или пора по расписанию"""
+        now = time.monotonic()
+        with self._lock:
+            over_limit = self._total_bytes is not None and self._total_bytes > self.max_bytes
+            due = now - self._last_sweep > self.sweep_interval
+            if not (over_limit or due):
+                return
+            self._last_sweep = now
+        self.evict()
+
+    def evict(self):
+        """Удаляет устаревшие файлы и самые старые при превышении лимита"""
+        entries = []
+        now = time.time()
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if name.startswith('.tmp-'):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = 0
+        survivors = []
+        for mtime, size, path in entries:
+            if now - mtime > self.max_age:
+                self._remove(path)
+            else:
+                survivors.append((mtime, size, path))
+                total += size
+
+        # Самые давно использованные файлы уходят первыми
+        survivors.sort()
+        for mtime, size, path in survivors:
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+        with self._lock:
+            self._total_bytes = total
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+image_store = ImageStore()
+
+
+def image_url(image_id):
+    """Публичный URL изображения из хранилища"""
+    return f'/api/images/{image_id}'
+
+
+# Сколько промежуточных превью просить у gpt-image-1 в потоковом режиме (0-3)
+GENERATE_PARTIAL_IMAGES = _env_int('GENERATE_PARTIAL_IMAGES', 2)
+
+
+# Декларативный реестр моделей: единый источник правил для сервера и страницы.
+# max_n — сколько изображений модель отдает за один вызов API; цены в долларах за изображение.
+MODEL_REGISTRY = {
+    'gpt-image-1': {
+        'label': 'GPT Image 1 (Лучшее качество)',
+        'info': '🚀 Новейшая модель с лучшим качеством, пониманием текста и поддержкой прозрачного фона. Может занимать до 2 минут.',
+        'operations': ['generate', 'edit'],
+        'native_output_format': True,
+        'streaming': True,
+        'max_n': 10,
+        'sizes': {
+            '1024x1024': '1024×1024 (Квадрат)',
+            '1024x1536': '1024×1536 (Портрет)',
+            '1536x1024': '1536×1024 (Пейзаж)',
+        },
+        'options': {
+            'quality': {
+                'label': 'Качество',
+                'values': {'low': 'Низкое', 'medium': 'Среднее', 'high': 'Высокое', 'auto': 'По-умолчанию (среднее)'},
+                'default': None,
+            },
+            'background': {
+                'label': 'Фон',
+                'values': {'auto': 'Авто (по умолчанию)', 'transparent': 'Прозрачный', 'opaque': 'Непрозрачный'},
+                'default': None,
+            },
+            'moderation': {
+                'label': 'Модерация',
+                'values': {'low': 'Низкая (менее строгая)', 'auto': 'Авто (стандартная)'},
+                'default': None,
+            },
+        },
+        'prices': {
+            '1024x1024': {'low': 0.011, 'medium': 0.042, 'high': 0.167, 'auto': 0.042},
+            '1024x1536': {'low': 0.016, 'medium': 0.063, 'high': 0.250, 'auto': 0.063},
+            '1536x1024': {'low': 0.016, 'medium': 0.063, 'high': 0.250, 'auto': 0.063},
+        },
+    },
+    'dall-e-3': {
+        'label': 'DALL-E 3 (Высокое качество)',
+        'info': '🎨 Высокое качество изображений и понимание сложных описаний.',
+        'operations': ['generate'],
+        'max_n': 1,
+        'sizes': {
+            '1024x1024': '1024×1024 (Квадрат)',
+            '1024x1792': '1024×1792 (Портрет)',
+            '1792x1024': '1792×1024 (Пейзаж)',
+        },
+        'options': {
+            'quality': {
+                'label': 'Качество',
+                'values': {'standard': 'Стандартное', 'hd': 'HD'},
+                'default': 'standard',
+            },
+            'style': {
+                'label': 'Стиль',
+                'values': {'vivid': 'Яркий', 'natural': 'Естественный'},
+                'default': 'vivid',
+            },
+        },
+        'prices': {
+            '1024x1024': {'standard': 0.040, 'hd': 0.080},
+            '1024x1792': {'standard': 0.080, 'hd': 0.120},
+            '1792x1024': {'standard': 0.080, 'hd': 0.120},
+        },
+    },
+    'dall-e-2': {
+        'label': 'DALL-E 2 (Быстро и доступно)',
+        'info': '⚡ Быстрая генерация изображений по доступной цене.',
+        'operations': ['generate', 'edit', 'variation'],
+        'max_n': 10,
+        'sizes': {
+            '1024x1024': '1024×1024',
+            '512x512': '512×512',
+            '256x256': '256×256',
+        },
+        'options': {
+            'quality': {
+                'label': 'Качество',
+                'values': {'standard': 'Стандартное'},
+                'default': None,
+            },
+        },
+        'prices': {
+            '1024x1024': {'standard': 0.020},
+            '512x512': {'standard': 0.018},
+            '256x256': {'standard': 0.016},
+        },
+    },
+}
+
+# Модель по умолчанию совпадает с умолчанием OpenAI API
+DEFAULT_MODEL = 'dall-e-2'
+GENERATE_MAX_IMAGES = _env_int('GENERATE_MAX_IMAGES', 10)
+
+# Форматы результата; модели без нативного output_format перекодируются на сервере
+OUTPUT_FORMATS = {'png': 'PNG (без потерь)', 'jpeg': 'JPEG', 'webp': 'WebP'}
+OUTPUT_DEFAULT_COMPRESSION = _env_int('OUTPUT_DEFAULT_COMPRESSION', 85)
+
+# Какие необязательные параметры принимают операции API (None — все параметры модели)
+OPERATION_OPTIONS = {
+    'generate': None,
+    'edit': ('quality', 'background'),
+    'variation': (),
+}
+
+
+class GenerationError(Exception):
+    """Ошибка генерации с HTTP статусом для ответа клиенту"""
+
+    def __init__(self, message, status=500):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_json_object(body):
+    """JSON объект из тела запроса; иначе GenerationError 400"""
+    try:
+        data = json.loads(body.decode('utf-8'))
+    except ValueError:
+        raise GenerationError('Некорректный JSON в теле запроса', 400)
+    if not isinstance(data, dict):
+        raise GenerationError('Тело запроса должно быть JSON объектом', 400)
+    return data
+
+
+def _form_value(data, name, default=None):
+    # Поля формы - строки или числа; списки и объекты отклоняем до сравнения со справочниками
+    value = data.get(name) or default
+    if value is not None and not isinstance(value, (str, int, float)):
+        raise GenerationError(f'Поле {name} должно быть строкой или числом', 400)
+    return value
+
+
+def build_generation_params(data, operation='generate'):
+    """Проверяет данные формы по реестру моделей и собирает параметры OpenAI API"""
+    model = _form_value(data, 'model', DEFAULT_MODEL)
+    spec = MODEL_REGISTRY.get(model)
+    if spec is None:
+        raise GenerationError(f'Неизвестная модель: {model}', 400)
+    if operation not in spec['operations']:
+        raise GenerationError(f'Модель {model} не поддерживает операцию {operation}', 400)
+
+    # Вариациям описание не нужно
+    prompt = data.get('prompt')
+    if not prompt and operation != 'variation':
+        raise GenerationError('Описание изображения обязательно', 400)
+    if prompt and not isinstance(prompt, str):
+        raise GenerationError('Описание изображения должно быть строкой', 400)
+
+    size = _form_value(data, 'size', next(iter(spec['sizes'])))
+    if size not in spec['sizes']:
+        raise GenerationError(f'Размер {size} не поддерживается моделью {model}', 400)
+
+    try:
+        n = int(data.get('n', 1))
+    except (TypeError, ValueError):
+        raise GenerationError('Количество изображений должно быть числом', 400)
+    if not 1 <= n <= GENERATE_MAX_IMAGES:
+        raise GenerationError(f'Количество изображений должно быть от 1 до {GENERATE_MAX_IMAGES}', 400)
+
+    # Собираем параметры для OpenAI API
+    params = {
+        "model": model,
+        "prompt": prompt,
+        "n": n,
+        "size": size
+    }
+    if operation == 'variation':
+        del params['prompt']
+
+    # Необязательные параметры берем только те, что поддерживает модель;
+    # поля чужих моделей (форма шлет все select'ы) просто игнорируются
+    allowed = OPERATION_OPTIONS[operation]
+    for name, option in spec['options'].items():
+        if allowed is not None and name not in allowed:
+            continue
+        value = _form_value(data, name, option['default'])
+        if value is None:
+            continue
+        if value not in option['values']:
+            raise GenerationError(f'Недопустимое значение {name}={value} для модели {model}', 400)
+        params[name] = value
+
+    output_format, compression = _parse_output_format(data)
+    if spec.get('native_output_format') and output_format != 'png':
+        params['output_format'] = output_format
+        if compression is not None:
+            params['output_compression'] = compression
+
+    return params
+
+
+def _parse_output_format(data):
+    # Формат и степень сжатия из формы; для PNG сжатие не применяется
+    output_format = _form_value(data, 'output_format', 'png')
+    if output_format not in OUTPUT_FORMATS:
+        raise GenerationError(f'Неподдерживаемый формат: {output_format}', 400)
+
+    compression = data.get('output_compression')
+    if compression in (None, '') or output_format == 'png':
+        return output_format, None
+    try:
+        compression = int(compression)
+    except (TypeError, ValueError):
+        raise GenerationError('Сжатие должно быть числом от 0 до 100', 400)
+    if not 0 <= compression <= 100:
+        raise GenerationError('Сжатие должно быть числом от 0 до 100', 400)
+    return output_format, compression
+
+
+def build_output_options(data, params):
+    """Параметры серверного перекодирования или None, если оно не нужно"""
+    output_format, compression = _parse_output_format(data)
+    # Модель уже вернет нужный формат сама
+    if output_format == 'png' or 'output_format' in params:
+        return None
+    if pil_image() is None:
+        raise GenerationError('Перекодирование недоступно: на сервере не установлен Pillow', 400)
+    return {
+        'format': output_format,
+        'compression': OUTPUT_DEFAULT_COMPRESSION if compression is None else compression,
+    }
+
+
+def transcode_image(content, output):
+    """Перекодирует изображение в JPEG/WebP с заданным качеством"""
+    target = 'image/jpeg' if output['format'] == 'jpeg' else 'image/webp'
+    if sniff_image_type(content[:16]) == target and output['compression'] >= 100:
+        return content
+
+    Image = pil_image()
+    with Image.open(io.BytesIO(content)) as img:
+        result = io.BytesIO()
+        if output['format'] == 'jpeg':
+            # JPEG не умеет прозрачность: накладываем на белый фон
+            if img.mode in ('RGBA', 'LA', 'P'):
+                rgba = img.convert('RGBA')
+                flattened = Image.new('RGB', rgba.size, (255, 255, 255))
+                flattened.paste(rgba, mask=rgba.getchannel('A'))
+                img = flattened
+            img.convert('RGB').save(result, 'JPEG', quality=output['compression'], optimize=True, progressive=True)
+        else:
+            img.save(result, 'WEBP', quality=output['compression'], method=4)
+        return result.getvalue()
+
+
+def apply_output_format(contents, output):
+    """Приводит результаты к запрошенному формату"""
+    if not output:
+        return contents
+    return [transcode_image(content, output) for content in contents]
+
+
+def estimate_cost(params):
+    """Стоимость генерации в долларах по ценам из реестра"""
+    spec = MODEL_REGISTRY.get(params.get('model'), {})
+    prices = spec.get('prices', {}).get(params.get('size'), {})
+    # Без явного качества API использует умолчание модели: auto или единственное значение
+    quality = params.get('quality') or ('auto' if 'auto' in prices else next(iter(prices), None))
+    return round(prices.get(quality, 0.0) * params.get('n', 1), 6)
+
+
+def decode_image_items(items):
+    """Декодирует base64 из ответа OpenAI; возвращает байты (None на месте ссылок) и [(индекс, URL)]"""
+    contents = [None] * len(items)
+    pending = []
+    with measure_stage('decode') as span:
+        for i, image_data in enumerate(items):
+            if hasattr(image_data, 'b64_json') and image_data.b64_json:
+                contents[i] = base64.b64decode(image_data.b64_json)
+                # Строку base64 отпускаем сразу, иначе до конца разбора живут обе копии каждого изображения
+                image_data.b64_json = None
+            elif hasattr(image_data, 'url') and image_data.url:
+                pending.append((i, image_data.url))
+            else:
+                raise GenerationError(f'Изображение {i+1} не содержит данных')
+        span.bytes = sum(len(content) for content in contents if content is not None)
+    return contents, pending
+
+
+def extract_image_contents(items, deadline=None):
+    """Достает байты изображений из ответа OpenAI: base64 декодирует, URL скачивает"""
+    contents, pending = decode_image_items(items)
+    if pending:
+        with measure_stage('download') as span:
+            try:
+                downloaded = download_images([url for _, url in pending], deadline)
+            except ImageDownloadError as e:
+                raise GenerationError(str(e))
+            span.bytes = sum(len(content) for content in downloaded)
+    else:
+        downloaded = []
+    for (i, _), content in zip(pending, downloaded):
+        contents[i] = content
+    return contents
+
+
+def _generate_once(client, params, deadline):
+    # Один вызов API в пределах лимита модели на n; слот допуска держится до конца загрузок
+    with upstream_admission:
+        with measure_stage('upstream'):
+            openai_response = upstream_retry.call(
+                lambda timeout: client.images.generate(**params, timeout=timeout), openai_breaker, deadline)
+
+        if not hasattr(openai_response, 'data') or not openai_response.data:
+            raise GenerationError('Неверный ответ от OpenAI API')
+
+        return extract_image_contents(openai_response.data, deadline)
+
+
+def split_n(params):
+    """Значения n для отдельных вызовов API в пределах лимита модели"""
+    max_n = MODEL_REGISTRY.get(params.get('model'), {}).get('max_n', params['n'])
+    chunks = [max_n] * (params['n'] // max_n)
+    if params['n'] % max_n:
+        chunks.append(params['n'] % max_n)
+    return chunks
+
+
+def generate_image_contents(client, params):
+    """Генерирует изображения и возвращает их байты; большие n делит на параллельные вызовы"""
+    # Общий бюджет времени на вызовы API, повторы и загрузки одного запроса
+    deadline = time.monotonic() + UPSTREAM_DEADLINE
+    chunks = split_n(params)
+    if len(chunks) == 1:
+        return _generate_once(client, params, deadline)
+
+    # Каждый вызов занимает свой слот допуска, больше слотов запускать бессмысленно
+    workers = min(len(chunks), upstream_admission.max_inflight)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='generate-split') as executor:
+        futures = [executor.submit(with_stage_timer(_generate_once), client, dict(params, n=n), deadline) for n in chunks]
+        contents = []
+        for future in futures:
+            contents.extend(future.result())
+    return contents
+
+
+# Ограничения частоты запросов и числа одновременных вызовов OpenAI
+RATE_LIMIT_PER_MINUTE = _env_float('RATE_LIMIT_PER_MINUTE', 20.0)
+# Емкость не меньше максимального n, иначе один полный запрос не пройдет никогда
+RATE_LIMIT_BURST = _env_float('RATE_LIMIT_BURST', float(GENERATE_MAX_IMAGES))
+RATE_LIMIT_MAX_CLIENTS = _env_int('RATE_LIMIT_MAX_CLIENTS', 10000)
+# Сколько доверенных прокси стоит перед сервером; 0 - X-Forwarded-For игнорируется
+TRUSTED_PROXY_HOPS = _env_int('TRUSTED_PROXY_HOPS', 0)
+UPSTREAM_MAX_INFLIGHT = _env_int('UPSTREAM_MAX_INFLIGHT', 8)
+UPSTREAM_MAX_WAITING = _env_int('UPSTREAM_MAX_WAITING', 16)
+UPSTREAM_WAIT_TIMEOUT = _env_float('UPSTREAM_WAIT_TIMEOUT', 2.0)
+UPSTREAM_RETRY_AFTER = _env_int('UPSTREAM_RETRY_AFTER', 5)
+
+
+class RateLimitExceeded(GenerationError):
+    """Превышен лимит: ответ 429 с заголовком Retry-After"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message, 429)
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+
+class ClientRateLimiter:
+    """Token bucket на каждого клиента: пополнение rate в минуту, емкость burst"""
+
+    def __init__(self, per_minute=RATE_LIMIT_PER_MINUTE, burst=RATE_LIMIT_BURST,
+                 max_clients=RATE_LIMIT_MAX_CLIENTS):
+        self.rate = per_minute / 60.0
+        self.capacity = burst
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.rejected = 0
+
+    @property
+    def enabled(self):
+        return self.rate > 0 and self.capacity > 0
+
+    def acquire(self, client_id, cost=1.0, wait=0.0):
+        """Списывает cost токенов, дожидаясь их не дольше wait секунд, или бросает RateLimitExceeded"""
+        if not self.enabled:
+            return
+        # Запрос дороже емкости не пройдет никогда, ждать бессмысленно
+        if cost > self.capacity:
+            with self._lock:
+                self.rejected += 1
+            raise GenerationError(
+                f'Запрос на {int(cost)} изображений превышает лимит в {int(self.capacity)}, разбейте его на части',
+                400,
+            )
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(client_id, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+            delay = max(0.0, (cost - tokens) / self.rate)
+            if delay > wait:
+                self._buckets[client_id] = (tokens, now)
+                self.rejected += 1
+                raise RateLimitExceeded('Слишком много запросов, попробуйте чуть позже', delay)
+            # Недостающие токены берутся в долг: следующий запрос клиента ждет, пока долг не пополнится
+            self._buckets[client_id] = (tokens - cost, now)
+            self.allowed += 1
+            # Самые давно неактивные клиенты в начале словаря
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        if delay:
+            time.sleep(delay)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'per_minute': self.rate * 60,
+                'burst': self.capacity,
+                'clients': len(self._buckets),
+                'allowed': self.allowed,
+                'rejected': self.rejected,
+            }
+
+
+class AdmissionController:
+    """Глобальный лимит одновременных вызовов OpenAI с короткой очередью ожидания"""
+
+    def __init__(self, max_inflight=UPSTREAM_MAX_INFLIGHT, max_waiting=UPSTREAM_MAX_WAITING,
+                 wait_timeout=UPSTREAM_WAIT_TIMEOUT, retry_after=UPSTREAM_RETRY_AFTER):
+        self.max_inflight = max_inflight
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.retry_after = retry_after
+        self._condition = threading.Condition()
+        self.inflight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    def _reject(self):
+        self.rejected += 1
+        raise RateLimitExceeded('Сервер перегружен генерациями, попробуйте позже', self.retry_after)
+
+    def acquire(self):
+        with self._condition:
+            if self.inflight >= self.max_inflight:
+                if self.waiting >= self.max_waiting:
+                    self._reject()
+                self.waiting += 1
+                try:
+                    deadline = time.monotonic() + self.wait_timeout
+                    while self.inflight >= self.max_inflight:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._reject()
+                        self._condition.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.inflight += 1
+            self.admitted += 1
+
+    def release(self):
+        with self._condition:
+            self.inflight -= 1
+            self._condition.notify()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+    def stats(self):
+        with self._condition:
+            return {
+                'max_inflight': self.max_inflight,
+                'max_waiting': self.max_waiting,
+                'inflight': self.inflight,
+                'waiting': self.waiting,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+            }
+
+
+client_rate_limiter = ClientRateLimiter()
+upstream_admission = AdmissionController()
+metrics.register(Gauge(
+    'imagegen_generations_in_flight', 'Upstream OpenAI calls currently running.',
+    lambda: upstream_admission.stats()['inflight']))
+metrics.register(Gauge(
+    'imagegen_generations_waiting', 'OpenAI calls waiting for an upstream slot.',
+    lambda: upstream_admission.stats()['waiting']))
+
+
+# Повторы вызовов OpenAI и загрузок: лимиты по классам ошибок, бюджет времени, circuit breaker
+UPSTREAM_DEADLINE = _env_float('UPSTREAM_DEADLINE', 240.0)
+UPSTREAM_BACKOFF_BASE = _env_float('UPSTREAM_BACKOFF_BASE', 0.5)
+UPSTREAM_BACKOFF_MAX = _env_float('UPSTREAM_BACKOFF_MAX', 8.0)
+UPSTREAM_RETRY_LIMITS = {
+    'rate_limit': _env_int('UPSTREAM_RETRIES_RATE_LIMIT', 3),
+    'server': _env_int('UPSTREAM_RETRIES_SERVER', 2),
+    'connection': _env_int('UPSTREAM_RETRIES_CONNECTION', 3),
+    # Таймаут генерации стоит минуты, поэтому повторяем его осторожно
+    'timeout': _env_int('UPSTREAM_RETRIES_TIMEOUT', 1),
+}
+# Меньше этого остатка бюджета времени новую попытку генерации не начинаем
+UPSTREAM_MIN_ATTEMPT = _env_float('UPSTREAM_MIN_ATTEMPT', 30.0)
+BREAKER_FAILURE_THRESHOLD = _env_int('BREAKER_FAILURE_THRESHOLD', 5)
+BREAKER_RESET_TIMEOUT = _env_float('BREAKER_RESET_TIMEOUT', 30.0)
+
+
+def parse_retry_after(headers):
+    """Секунды из Retry-After / retry-after-ms или None"""
+    if headers is None:
+        return None
+    value = headers.get('retry-after-ms')
+    if value:
+        try:
+            return float(value) / 1000.0
+        except ValueError:
+            pass
+    value = headers.get('retry-after')
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            # Формат HTTP-даты не разбираем, полагаемся на собственный backoff
+            return None
+    return None
+
+
+def classify_upstream_error(error):
+    """Класс ошибки для повторов ('rate_limit', 'server', 'connection', 'timeout') и Retry-After"""
+    # Ошибки openai и requests возможны только после их импорта, сами модули здесь не грузим
+    openai = sys.modules.get('openai')
+    requests = sys.modules.get('requests')
+    httpx = sys.modules.get('httpx')
+    if openai is not None and isinstance(error, openai.APITimeoutError):
+        return 'timeout', None
+    if openai is not None and isinstance(error, openai.APIConnectionError):
+        return 'connection', None
+    if openai is not None and isinstance(error, openai.APIStatusError):
+        retry_after = parse_retry_after(error.response.headers)
+        if error.status_code == 429:
+            return 'rate_limit', retry_after
+        if error.status_code >= 500 or error.status_code in (408, 409):
+            return 'server', retry_after
+        return None, None
+    if isinstance(error, ImageDownloadError) and error.status is not None:
+        if error.status == 429:
+            return 'rate_limit', error.retry_after
+        if error.status >= 500:
+            return 'server', error.retry_after
+        return None, None
+    if requests is not None and isinstance(error, requests.exceptions.Timeout):
+        return 'timeout', None
+    if requests is not None and isinstance(error, requests.exceptions.ConnectionError):
+        return 'connection', None
+    # Загрузки ASGI приложения идут через httpx
+    if httpx is not None and isinstance(error, httpx.TimeoutException):
+        return 'timeout', None
+    if httpx is not None and isinstance(error, httpx.TransportError):
+        return 'connection', None
+    return None, None
+
+
+class CircuitOpenError(GenerationError):
+    """Circuit breaker открыт: вызов отклонен без обращения к сервису"""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f'Сервис {name} временно недоступен, попробуйте позже', 503)
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+
+class CircuitBreaker:
+    """Размыкается после серии сбоев и пропускает пробный вызов после паузы"""
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opens = 0
+        self.rejected = 0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Пропускает вызов или бросает CircuitOpenError"""
+        with self._lock:
+            if self.state == 'closed':
+                return
+            elapsed = time.monotonic() - self.opened_at
+            if self.state == 'open' and elapsed >= self.reset_timeout:
+                self.state = 'half_open'
+            if self.state == 'half_open' and not self._probe_in_flight:
+                # Одна пробная попытка решает, закрываться ли обратно
+                self._probe_in_flight = True
+                return
+            self.rejected += 1
+            raise CircuitOpenError(self.name, max(self.reset_timeout - elapsed, 1))
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probe_in_flight = False
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    self.opens += 1
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'failures': self.failures,
+                'opens': self.opens,
+                'rejected': self.rejected,
+            }
+
+
+class DeadlineExceeded(GenerationError):
+    """Бюджет времени запроса исчерпан до очередной попытки"""
+
+    def __init__(self):
+        super().__init__('Превышено время ожидания ответа, попробуйте позже', 504)
+
+
+class RetryPolicy:
+    """Повторы с экспоненциальной задержкой, jitter и учетом Retry-After
+
+    fn получает таймаут попытки: настроенный attempt_timeout, но не дальше общего срока.
+    """
+
+    def __init__(self, limits, backoff_base=UPSTREAM_BACKOFF_BASE, backoff_max=UPSTREAM_BACKOFF_MAX,
+                 deadline=UPSTREAM_DEADLINE, attempt_timeout=OPENAI_TIMEOUT, min_attempt=UPSTREAM_MIN_ATTEMPT):
+        self.limits = limits
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.deadline = deadline
+        self.attempt_timeout = attempt_timeout
+        self.min_attempt = min_attempt
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.retries = 0
+        self.retries_by_class = {name: 0 for name in limits}
+        self.gave_up = 0
+        self.wait_seconds = 0.0
+
+    def delay(self, attempt, retry_after=None):
+        """Пауза перед повтором: Retry-After или full jitter от экспоненты"""
+        if retry_after is not None:
+            return retry_after + random.uniform(0, self.backoff_base)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _start(self, deadline):
+        with self._lock:
+            self.calls += 1
+        return time.monotonic() + self.deadline if deadline is None else deadline
+
+    def _timeout(self, deadline):
+        """Таймаут очередной попытки в пределах оставшегося бюджета"""
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            with self._lock:
+                self.gave_up += 1
+            raise DeadlineExceeded()
+        return min(self.attempt_timeout, remaining)
+
+    def _after_error(self, error, breaker, attempts, attempt, deadline):
+        """Пауза перед следующей попыткой; если повторять нельзя, бросает error дальше"""
+        error_class, retry_after = classify_upstream_error(error)
+        if error_class in ('server', 'connection', 'timeout'):
+            breaker.record_failure()
+        else:
+            # Ошибки клиента и лимиты не говорят о деградации сервиса
+            breaker.record_success()
+
+        if error_class is None:
+            raise error
+        attempts[error_class] = attempts.get(error_class, 0) + 1
+        delay = self.delay(attempt, retry_after)
+        # Повтор, которому после паузы не хватит времени на нормальную попытку, только продлит ожидание
+        if (attempts[error_class] > self.limits.get(error_class, 0)
+                or time.monotonic() + delay + self.min_attempt > deadline):
+            with self._lock:
+                self.gave_up += 1
+            raise error
+
+        with self._lock:
+            self.retries += 1
+            self.retries_by_class[error_class] += 1
+            self.wait_seconds += delay
+        return delay
+
+    def call(self, fn, breaker, deadline=None):
+        """Вызывает fn, повторяя временные ошибки в пределах лимитов и бюджета времени"""
+        deadline = self._start(deadline)
+        attempts = {}
+        attempt = 0
+        while True:
+            timeout = self._timeout(deadline)
+            breaker.allow()
+            try:
+                result = fn(timeout)
+            except Exception as e:
+                time.sleep(self._after_error(e, breaker, attempts, attempt, deadline))
+                attempt += 1
+                continue
+
+            breaker.record_success()
+            return result
+
+    async def call_async(self, fn, breaker, deadline=None):
+        """То же, что call, для fn, возвращающей корутину; пауза не занимает поток"""
+        import asyncio
+
+        deadline = self._start(deadline)
+        attempts = {}
+        attempt = 0
+        while True:
+            timeout = self._timeout(deadline)
+            breaker.allow()
+            try:
+                result = await fn(timeout)
+            except Exception as e:
+                await asyncio.sleep(self._after_error(e, breaker, attempts, attempt, deadline))
+                attempt += 1
+                continue
+
+            breaker.record_success()
+            return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'retries': self.retries,
+                'retries_by_class': dict(self.retries_by_class),
+                'gave_up': self.gave_up,
+                'wait_seconds': round(self.wait_seconds, 3),
+            }
+
+
+openai_breaker = CircuitBreaker('OpenAI')
+download_breaker = CircuitBreaker('загрузки изображений')
+upstream_retry = RetryPolicy(UPSTREAM_RETRY_LIMITS)
+download_retry = RetryPolicy(
+    {name: IMAGE_DOWNLOAD_RETRIES for name in UPSTREAM_RETRY_LIMITS},
+    attempt_timeout=IMAGE_DOWNLOAD_TIMEOUT,
+    min_attempt=IMAGE_DOWNLOAD_MIN_ATTEMPT,
+)
+
+
+# Настройки кеша результатов генерации
+RESULT_CACHE_ENABLED = os.environ.get('RESULT_CACHE_ENABLED', '1').lower() not in ('0', 'false', 'no')
+RESULT_CACHE_TTL = _env_float('RESULT_CACHE_TTL', 3600.0)
+RESULT_CACHE_MAX_BYTES = _env_int('RESULT_CACHE_MAX_BYTES', 128 * 1024 * 1024)
+RESULT_CACHE_MAX_ENTRIES = _env_int('RESULT_CACHE_MAX_ENTRIES', 256)
+RESULT_CACHE_DIR = os.environ.get('RESULT_CACHE_DIR')
+
+
+def generation_cache_key(params):
+    """Ключ кеша по нормализованному словарю параметров"""
+    raw = json.dumps(params, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """LRU кеш результатов в памяти с необязательным слоем на диске"""
+
+    def __init__(self, enabled=RESULT_CACHE_ENABLED, ttl=RESULT_CACHE_TTL,
+                 max_bytes=RESULT_CACHE_MAX_BYTES, max_entries=RESULT_CACHE_MAX_ENTRIES,
+                 disk_dir=RESULT_CACHE_DIR, store=None):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.store = store
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Возвращает список байтов изображений или None"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, contents, size = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return contents
+                self._drop(key)
+
+        contents = self._disk_get(key, now)
+        with self._lock:
+            if contents is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        self._remember(key, contents, now + self.ttl)
+        return contents
+
+    def put(self, key, contents):
+        """Сохраняет результат генерации"""
+        expires_at = time.time() + self.ttl
+        self._remember(key, contents, expires_at)
+        self._disk_put(key, contents, expires_at)
+
+    def _remember(self, key, contents, expires_at):
+        size = sum(len(content) for content in contents)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (expires_at, contents, size)
+            self._bytes += size
+            # Вытесняем самые давно использованные записи
+            while self._bytes > self.max_bytes or len(self._entries) > self.max_entries:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                self.evictions += 1
+
+    def _drop(self, key):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f'{key}.json')
+
+    def _disk_get(self, key, now):
+        # На диске лежит только манифест, сами байты берем из хранилища изображений
+        if not self.disk_dir or self.store is None:
+            return None
+        try:
+            with open(self._disk_path(key), 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if manifest.get('expires_at', 0) <= now:
+            try:
+                os.unlink(self._disk_path(key))
+            except OSError:
+                pass
+            return None
+
+        contents = []
+        for image_id in manifest.get('images', []):
+            f = self.store.open(image_id)
+            if f is None:
+                return None
+            with f:
+                contents.append(f.read())
+        return contents or None
+
+    def _disk_put(self, key, contents, expires_at):
+        if not self.disk_dir or self.store is None:
+            return
+        manifest = {
+            'expires_at': expires_at,
+            'images': [self.store.put(content) for content in contents],
+        }
+        os.makedirs(self.disk_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.disk_dir, prefix='.tmp-')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self._disk_path(key))
+
+    def stats(self):
+        """Счетчики кеша"""
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class SingleFlight:
+    """Склеивает одновременные одинаковые вызовы в один"""
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.shared = 0
+
+    def do(self, key, fn):
+        """Выполняет fn один раз на ключ; остальные ждут готовый результат"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+            else:
+                self.shared += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class EventBroadcast:
+    """События одной потоковой генерации для всех читателей; каждый получает их с начала
+
+    Пишется как очередь (put), закрывается сам, когда пришли все события finished.
+    """
+
+    def __init__(self, workers, on_complete=None):
+        self._events = []
+        self._workers = workers
+        self._on_complete = on_complete
+        self._cond = threading.Condition()
+        self.closed = False
+
+    def put(self, item):
+        with self._cond:
+            self._events.append(item)
+            if item[0] == 'finished':
+                self._workers -= 1
+            complete = self._workers <= 0 and not self.closed
+            self._cond.notify_all()
+        if complete:
+            self._complete()
+
+    put_nowait = put
+
+    def fail(self, error):
+        """Завершает поток ошибкой, если генерация так и не началась"""
+        with self._cond:
+            if self.closed:
+                return
+            self._workers = 0
+        self.put(('error', {'index': None, 'error': str(error)}))
+
+    def events(self):
+        with self._cond:
+            return list(self._events)
+
+    def _complete(self):
+        try:
+            if self._on_complete is not None:
+                self._on_complete(self.events())
+        except Exception:
+            # Кеширование результата не должно оставить читателей без конца потока
+            pass
+        finally:
+            with self._cond:
+                self.closed = True
+                self._cond.notify_all()
+
+    def subscribe(self):
+        """События по порядку до закрытия потока"""
+        position = 0
+        while True:
+            with self._cond:
+                while position >= len(self._events) and not self.closed:
+                    self._cond.wait()
+                if position >= len(self._events):
+                    return
+                item = self._events[position]
+            position += 1
+            yield item
+
+
+class StreamFlight:
+    """Single-flight для потоковых генераций: одинаковые запросы читают события первого"""
+
+    def __init__(self):
+        self._streams = {}
+        self._lock = threading.Lock()
+        self.shared = 0
+
+    def join(self, key, create):
+        """Возвращает (поток, лидер); create вызывается, только если потока с таким ключом нет"""
+        with self._lock:
+            stream = self._streams.get(key)
+            if stream is not None:
+                self.shared += 1
+                return stream, False
+            stream = self._streams[key] = create()
+            return stream, True
+
+    def forget(self, key, stream):
+        with self._lock:
+            if self._streams.get(key) is stream:
+                del self._streams[key]
+
+
+result_cache = ResultCache(store=image_store)
+generation_flight = SingleFlight()
+stream_flight = StreamFlight()
+
+
+def run_generation(client, params, use_cache=True):
+    """Генерация через кеш и single-flight; возвращает (байты, из_кеша)"""
+    if not (use_cache and result_cache.enabled):
+        return generate_image_contents(client, params), False
 
-    def do_GET(self):
-        # Обрабатываем GET запросы
-        if self.path == '/' or self.path == '/index.html':
-            self.serve_login_page()
-        elif self.path == '/app':
-            # Проверяем авторизацию для /app
-            if not self.is_authenticated():
-                # Перенаправляем на главную страницу
-                self.send_response(302)
-                self.send_header('Location', '/')
-                self.end_headers()
+    key = generation_cache_key(params)
+    contents = result_cache.get(key)
+    if contents is not None:
+        return contents, True
+
+    def compute():
+        # Вызовы OpenAI делает только лидер single-flight, ожидающие слотов не тратят
+        contents = generate_image_contents(client, params)
+        result_cache.put(key, contents)
+        return contents
+
+    return generation_flight.do(key, compute), False
+
+
+# Настройки превью для сетки результатов
+PREVIEW_ENABLED = os.environ.get('PREVIEW_ENABLED', '1').lower() not in ('0', 'false', 'no')
+PREVIEW_MAX_SIZE = _env_int('PREVIEW_MAX_SIZE', 384)
+PREVIEW_QUALITY = _env_int('PREVIEW_QUALITY', 75)
+
+
+def make_preview(content):
+    """Уменьшенная WebP (или JPEG) копия изображения; None, если Pillow недоступен"""
+    Image = pil_image() if PREVIEW_ENABLED else None
+    if Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(content)) as img:
+            img.draft('RGB', (PREVIEW_MAX_SIZE, PREVIEW_MAX_SIZE))
+            img.thumbnail((PREVIEW_MAX_SIZE, PREVIEW_MAX_SIZE), Image.LANCZOS, reducing_gap=2.0)
+            output = io.BytesIO()
+            try:
+                img.save(output, 'WEBP', quality=PREVIEW_QUALITY, method=4)
+            except (KeyError, OSError):
+                # Сборка Pillow без WebP: JPEG на белом фоне
+                output = io.BytesIO()
+                if img.mode in ('RGBA', 'LA', 'P'):
+                    rgba = img.convert('RGBA')
+                    flattened = Image.new('RGB', rgba.size, (255, 255, 255))
+                    flattened.paste(rgba, mask=rgba.getchannel('A'))
+                    img = flattened
+                img.convert('RGB').save(output, 'JPEG', quality=PREVIEW_QUALITY, optimize=True)
+            return output.getvalue()
+    except Exception:
+        # Битое или неизвестное изображение просто остается без превью
+        return None
+
+
+def preview_id_for(image_id, content):
+    """ID превью для оригинала: берется из хранилища или строится один раз"""
+    preview_id = image_store.get_derivative(image_id, 'preview')
+    if preview_id is not None:
+        return preview_id
+    preview = make_preview(content)
+    if preview is None or len(preview) >= len(content):
+        return None
+    preview_id = image_store.put(preview)
+    image_store.link_derivative(image_id, 'preview', preview_id)
+    return preview_id
+
+
+def store_image_contents(contents):
+    """Кладет изображения в хранилище и возвращает ссылки на них и на превью"""
+    images = []
+    for content in contents:
+        image_id = image_store.put(content)
+        image = {
+            'id': image_id,
+            'url': image_url(image_id),
+            'bytes': len(content),
+            'format': sniff_image_type(content[:16]).split('/')[-1],
+        }
+        preview_id = preview_id_for(image_id, content)
+        if preview_id is not None:
+            image['preview_url'] = image_url(preview_id)
+        images.append(image)
+    return images
+
+
+def partial_image_event(index, event):
+    """Данные события partial для промежуточного превью из потока OpenAI"""
+    return {
+        'index': index,
+        'partial_index': event.partial_image_index,
+        'format': event.output_format,
+        'b64': event.b64_json,
+    }
+
+
+def store_generation_result(contents, output=None):
+    """Перекодирует результат под запрос и кладет в хранилище; возвращает (байты, ссылки)"""
+    # В кеше лежат оригиналы, перекодирование делается под каждый запрос
+    with measure_stage('transcode'):
+        contents = apply_output_format(contents, output)
+    with measure_stage('store') as span:
+        images = store_image_contents(contents)
+        span.bytes = sum(len(content) for content in contents)
+    return contents, images
+
+
+def _stream_single_image(client, params, index, events, admitted=False):
+    # Одно изображение gpt-image-1 с промежуточными превью; слот допуска держится до конца потока.
+    # admitted - слот уже занят обработчиком до отправки заголовков
+    try:
+        if not admitted:
+            upstream_admission.acquire()
+            admitted = True
+        # Повторяем только установку потока: после первых превью начинать заново уже поздно
+        started = time.perf_counter()
+        stream = upstream_retry.call(
+            lambda timeout: client.images.generate(
+                **dict(params, n=1),
+                stream=True,
+                partial_images=GENERATE_PARTIAL_IMAGES,
+                timeout=timeout,
+            ),
+            openai_breaker,
+        )
+        for event in stream:
+            if event.type == 'image_generation.partial_image':
+                events.put(('partial', partial_image_event(index, event)))
+            elif event.type == 'image_generation.completed':
+                # Для потока upstream длится до финального изображения
+                record_stage('upstream', time.perf_counter() - started)
+                image = store_image_contents([base64.b64decode(event.b64_json)])[0]
+                events.put(('image', dict(image, index=index)))
+    except Exception as e:
+        events.put(('error', {'index': index, 'error': str(e)}))
+    finally:
+        if admitted:
+            upstream_admission.release()
+        events.put(('finished', {'index': index}))
+
+
+def _generate_all_images(client, params, events, output=None, use_cache=True):
+    # Модели без потоковой выдачи: отдаем все изображения разом, кеш и single-flight как в обычном пути
+    try:
+        contents, _ = run_generation(client, params, use_cache)
+        contents = apply_output_format(contents, output)
+        for index, image in enumerate(store_image_contents(contents)):
+            events.put(('image', dict(image, index=index)))
+    except Exception as e:
+        events.put(('error', {'index': None, 'error': str(e)}))
+    finally:
+        events.put(('finished', {'index': None}))
+
+
+def stream_worker_count(params):
+    """Сколько событий finished будет в потоке генерации"""
+    return params['n'] if MODEL_REGISTRY[params['model']].get('streaming') else 1
+
+
+def stream_result_contents(events):
+    """Байты готовых изображений из событий успешного потока или None"""
+    image_ids = {data['index']: data['id'] for event, data in events if event == 'image'}
+    if not image_ids or any(event == 'error' for event, _ in events):
+        return None
+    contents = []
+    for index in sorted(image_ids):
+        with image_store.open(image_ids[index]) as f:
+            contents.append(f.read())
+    return contents
+
+
+def open_generation_stream(params, cache_key=None):
+    """Поток событий генерации: (EventBroadcast, лидер)
+
+    С cache_key одинаковые одновременные запросы получают поток первого, а его результат
+    попадает в кеш до того, как поток закроется.
+    """
+    workers = stream_worker_count(params)
+    if cache_key is None:
+        return EventBroadcast(workers), True
+
+    def create():
+        def complete(events):
+            try:
+                contents = stream_result_contents(events)
+                if contents is not None:
+                    result_cache.put(cache_key, contents)
+            finally:
+                stream_flight.forget(cache_key, stream)
+
+        stream = EventBroadcast(workers, complete)
+        return stream
+
+    return stream_flight.join(cache_key, create)
+
+
+def start_generation_stream(client, params, events, output=None, use_cache=True, admitted=False):
+    """Запускает генерацию в фоне, события складываются в очередь; возвращает число потоков
+
+    admitted - вызывающий уже занял один слот upstream_admission, его забирает первый поток.
+    """
+    if MODEL_REGISTRY[params['model']].get('streaming'):
+        # Каждое изображение стримится отдельным запросом, чтобы превью шли параллельно
+        targets = [(_stream_single_image, (client, params, i, events, admitted and i == 0)) for i in range(params['n'])]
+    else:
+        targets = [(_generate_all_images, (client, params, events, output, use_cache))]
+
+    for target, args in targets:
+        threading.Thread(target=with_stage_timer(target), args=args, daemon=True).start()
+    return len(targets)
+
+
+# Настройки асинхронных заданий генерации
+JOB_WORKERS = _env_int('JOB_WORKERS', 4)
+JOB_QUEUE_SIZE = _env_int('JOB_QUEUE_SIZE', 32)
+JOB_RESULT_TTL = _env_float('JOB_RESULT_TTL', 3600.0)
+
+
+# Ограничения загрузки исходных изображений для edit/variation
+UPLOAD_MAX_BYTES = _env_int('UPLOAD_MAX_BYTES', 100 * 1024 * 1024)
+UPLOAD_MAX_FILE_BYTES = _env_int('UPLOAD_MAX_FILE_BYTES', 50 * 1024 * 1024)
+UPLOAD_MAX_FILES = _env_int('UPLOAD_MAX_FILES', 16)
+UPLOAD_MAX_FIELD_BYTES = 256 * 1024
+UPLOAD_SPOOL_BYTES = _env_int('UPLOAD_SPOOL_BYTES', 1024 * 1024)
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class UploadedFile:
+    """Загруженный файл, лежащий в SpooledTemporaryFile"""
+
+    def __init__(self, filename, content_type):
+        self.filename = filename
+        self.content_type = content_type
+        self.file = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES)
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > UPLOAD_MAX_FILE_BYTES:
+            raise GenerationError(f'Файл {self.filename} больше {UPLOAD_MAX_FILE_BYTES // (1024 * 1024)} МБ', 413)
+        self.file.write(data)
+
+    def as_openai_file(self):
+        """Кортеж для OpenAI SDK: файл передается как поток, без копии в памяти"""
+        self.file.seek(0)
+        return (self.filename, self.file, self.content_type)
+
+
+class MultipartForm:
+    """Результат разбора multipart/form-data: текстовые поля и файлы"""
+
+    def __init__(self):
+        self.fields = {}
+        self.files = {}
+
+    def close(self):
+        for uploads in self.files.values():
+            for upload in uploads:
+                upload.file.close()
+
+
+def _parse_part_headers(raw):
+    # Достаем name, filename и Content-Type из заголовков части
+    headers = {}
+    for line in raw.decode('utf-8', 'replace').split('\r\n'):
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    disposition = headers.get('content-disposition', '')
+    name = re.search(r'(?:^|;)\s*name="([^"]*)"', disposition)
+    filename = re.search(r'(?:^|;)\s*filename="([^"]*)"', disposition)
+    return (
+        name.group(1) if name else None,
+        filename.group(1) if filename else None,
+        headers.get('content-type') or 'application/octet-stream',
+    )
+
+
+def parse_multipart(stream, content_type, content_length):
+    """Потоково разбирает multipart/form-data, складывая файлы во временные файлы"""
+    match = re.search(r'boundary="?([^";]+)"?', content_type or '')
+    if not match or not content_type.lower().startswith('multipart/form-data'):
+        raise GenerationError('Ожидается multipart/form-data', 400)
+    if content_length > UPLOAD_MAX_BYTES:
+        raise GenerationError(f'Запрос больше {UPLOAD_MAX_BYTES // (1024 * 1024)} МБ', 413)
+
+    delimiter = b'\r\n--' + match.group(1).encode('latin-1')
+    remaining = content_length
+    # CRLF в начале позволяет искать первую границу тем же разделителем
+    buffer = bytearray(b'\r\n')
+    form = MultipartForm()
+    state = 'preamble'
+    sink = None
+    file_count = 0
+
+    def read_more():
+        nonlocal remaining
+        if remaining <= 0:
+            raise GenerationError('Неполное multipart тело запроса', 400)
+        chunk = stream.read(min(UPLOAD_CHUNK_SIZE, remaining))
+        if not chunk:
+            raise GenerationError('Неполное multipart тело запроса', 400)
+        remaining -= len(chunk)
+        buffer.extend(chunk)
+
+    def write(data):
+        if isinstance(sink, UploadedFile):
+            sink.write(data)
+        elif sink is not None:
+            sink[1].extend(data)
+            if len(sink[1]) > UPLOAD_MAX_FIELD_BYTES:
+                raise GenerationError(f'Поле {sink[0]} слишком большое', 413)
+
+    try:
+        while True:
+            if state in ('preamble', 'body'):
+                index = buffer.find(delimiter)
+                if index == -1:
+                    # Хвост оставляем в буфере: в нем может начинаться разделитель
+                    keep = len(delimiter) - 1
+                    if len(buffer) > keep:
+                        if state == 'body':
+                            write(bytes(buffer[:-keep]))
+                        del buffer[:-keep]
+                    read_more()
+                    continue
+
+                if state == 'body':
+                    write(bytes(buffer[:index]))
+                    if isinstance(sink, tuple):
+                        try:
+                            form.fields[sink[0]] = sink[1].decode('utf-8')
+                        except UnicodeDecodeError:
+                            raise GenerationError(f'Поле {sink[0]} должно быть в кодировке UTF-8', 400)
+                    sink = None
+                del buffer[:index + len(delimiter)]
+
+                while len(buffer) < 2:
+                    read_more()
+                if buffer[:2] == b'--':
+                    break
+                del buffer[:2]
+                state = 'headers'
+
+            else:
+                index = buffer.find(b'\r\n\r\n')
+                if index == -1:
+                    if len(buffer) > 16 * 1024:
+                        raise GenerationError('Слишком длинные заголовки части', 400)
+                    read_more()
+                    continue
+
+                name, filename, part_type = _parse_part_headers(bytes(buffer[:index]))
+                del buffer[:index + 4]
+                if filename is not None:
+                    file_count += 1
+                    if file_count > UPLOAD_MAX_FILES:
+                        raise GenerationError(f'Не больше {UPLOAD_MAX_FILES} файлов за запрос', 413)
+                    sink = UploadedFile(filename, part_type)
+                    form.files.setdefault(name, []).append(sink)
+                else:
+                    sink = (name, bytearray())
+                state = 'body'
+
+        # Дочитываем эпилог, чтобы соединение можно было переиспользовать
+        while remaining > 0:
+            chunk = stream.read(min(UPLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+    except BaseException:
+        form.close()
+        raise
+    return form
+
+
+def run_image_operation(client, operation, params, images, mask=None):
+    """Вызывает images.edit или images.create_variation и возвращает байты результатов"""
+    deadline = time.monotonic() + UPSTREAM_DEADLINE
+
+    def call(timeout):
+        # Файлы перематываются на каждой попытке
+        files = [upload.as_openai_file() for upload in images]
+        if operation == 'edit':
+            kwargs = dict(params, image=files if len(files) > 1 else files[0])
+            if mask is not None:
+                kwargs['mask'] = mask.as_openai_file()
+            return client.images.edit(**kwargs, timeout=timeout)
+        return client.images.create_variation(image=files[0], **params, timeout=timeout)
+
+    with upstream_admission:
+        with measure_stage('upstream'):
+            openai_response = upstream_retry.call(call, openai_breaker, deadline)
+        if not hasattr(openai_response, 'data') or not openai_response.data:
+            raise GenerationError('Неверный ответ от OpenAI API')
+        return extract_image_contents(openai_response.data, deadline)
+
+
+# Журнал использования и расходов в SQLite
+USAGE_DB_PATH = os.environ.get('USAGE_DB_PATH') or os.path.join(tempfile.gettempdir(), 'imagegen-usage.sqlite3')
+USAGE_LEDGER_ENABLED = os.environ.get('USAGE_LEDGER_ENABLED', '1').lower() not in ('0', 'false', 'no')
+USAGE_QUEUE_SIZE = _env_int('USAGE_QUEUE_SIZE', 10000)
+USAGE_BATCH_SIZE = _env_int('USAGE_BATCH_SIZE', 500)
+USAGE_FLUSH_INTERVAL = _env_float('USAGE_FLUSH_INTERVAL', 1.0)
+USAGE_PERIODS = {'hour': 3600, 'day': 86400}
+USAGE_DEFAULT_RANGE = {'hour': 48 * 3600, 'day': 30 * 86400}
+
+USAGE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS generations (
+    id INTEGER PRIMARY KEY,
+    created_at REAL NOT NULL,
+    client TEXT NOT NULL,
+    operation TEXT NOT NULL,
+    model TEXT NOT NULL,
+    size TEXT,
+    quality TEXT,
+    n INTEGER NOT NULL,
+    images INTEGER NOT NULL,
+    cached INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    latency_ms REAL NOT NULL,
+    cost REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS generations_created_at ON generations (created_at);
+CREATE TABLE IF NOT EXISTS usage_rollup (
+    period TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    model TEXT NOT NULL,
+    client TEXT NOT NULL,
+    requests INTEGER NOT NULL,
+    failed INTEGER NOT NULL,
+    cached INTEGER NOT NULL,
+    images INTEGER NOT NULL,
+    cost REAL NOT NULL,
+    latency_ms REAL NOT NULL,
+    PRIMARY KEY (period, bucket, model, client)
+) WITHOUT ROWID;
+'''
+
+
+class SQLiteBatchWriter:
+    """База SQLite, в которую фоновый поток пишет пачками из неблокирующей очереди"""
+
+    schema = ''
+    thread_name = 'sqlite-writer'
+
+    def __init__(self, path, enabled=True, queue_size=USAGE_QUEUE_SIZE, batch_size=USAGE_BATCH_SIZE,
+                 flush_interval=USAGE_FLUSH_INTERVAL):
+        self.path = path
+        self.enabled = enabled
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.dropped = 0
+        self.failed_batches = 0
+        # Ошибка открытия базы: писатель не запустился, новые записи не копятся в очереди
+        self.error = None
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._ready = threading.Event()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        # WAL позволяет читать, пока писатель держит транзакцию
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def _ensure_writer(self):
+        with self._lock:
+            if self._thread is not None:
                 return
-            self.serve_main_page()
-        else:
-            self.send_error(404)
+            self._thread = threading.Thread(target=self._writer, name=self.thread_name, daemon=True)
+            self._thread.start()
 
-    def is_authenticated(self):
-        """Проверяет cookie авторизации"""
-        cookies = self.headers.get('Cookie', '')
-        # Проверяем наличие валидного токена
-        return 'auth_token=valid' in cookies
+    def record(self, entry):
+        """Ставит запись в очередь без ожидания; при переполнении запись теряется"""
+        if not self.enabled:
+            return
+        self._ensure_writer()
+        if self.error is not None:
+            self.dropped += 1
+            return
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
 
-    
-    def do_POST(self):
-        # Обрабатываем POST запросы
-        parsed_path = urlparse(self.path)
-        
-        if parsed_path.path == '/api/login':
-            self.handle_login()
-        elif parsed_path.path == '/api/generate':
-            self.handle_generate()
+    def _writer(self):
+        try:
+            connection = self._connect()
+            connection.executescript(self.schema)
+        except Exception as e:
+            self.error = f'{type(e).__name__}: {e}'
+            print(f'{self.thread_name}: cannot open {self.path}: {self.error}; records will be dropped',
+                  file=sys.stderr, flush=True)
+            # То, что успело попасть в очередь, уже не запишется
+            while True:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                self.dropped += 1
+            return
+        finally:
+            self._ready.set()
+        while True:
+            batch = [self._queue.get()]
+            # Добираем пачку: что уже в очереди или придет за flush_interval
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                self._write_batch(connection, batch)
+                self.written += len(batch)
+            except Exception as e:
+                # Поток писателя должен пережить любую ошибку пачки, иначе остальные записи потеряются
+                self.failed_batches += 1
+                print(f'{self.thread_name}: failed to write {len(batch)} records: {type(e).__name__}: {e}',
+                      file=sys.stderr, flush=True)
+
+    def _write_batch(self, connection, batch):
+        raise NotImplementedError
+
+    def _reader(self):
+        """Соединение для чтения в текущем потоке; схема к этому моменту уже создана"""
+        self._ensure_writer()
+        self._ready.wait(5)
+        if self.error is not None:
+            raise sqlite3.OperationalError(self.error)
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = self._connect()
+        return connection
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'pending': self._queue.qsize(),
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed_batches': self.failed_batches,
+            'error': self.error,
+        }
+
+
+class UsageLedger(SQLiteBatchWriter):
+    """Журнал генераций: запись пачками в фоне и почасовые/посуточные агрегаты"""
+
+    schema = USAGE_SCHEMA
+    thread_name = 'usage-ledger'
+
+    def record_generation(self, client, operation, params, images, cached, failed, latency):
+        """Запись об одной генерации; стоимость считается только за реальные вызовы API"""
+        cost = 0.0 if cached or not images else estimate_cost(dict(params, n=images))
+        self.record({
+            'created_at': time.time(),
+            'client': client or '',
+            'operation': operation,
+            'model': params.get('model') or '',
+            'size': params.get('size'),
+            'quality': params.get('quality'),
+            'n': params.get('n', 1),
+            'images': images,
+            'cached': 1 if cached else 0,
+            'status': 'failed' if failed else 'succeeded',
+            'latency_ms': round(latency * 1000, 1),
+            'cost': cost,
+        })
+
+    @staticmethod
+    def _rollup(batch):
+        # Агрегаты пачки считаются в памяти, в базу уходит одна строка на корзину
+        rollup = {}
+        for entry in batch:
+            for period, seconds in USAGE_PERIODS.items():
+                bucket = int(entry['created_at'] // seconds * seconds)
+                key = (period, bucket, entry['model'], entry['client'])
+                row = rollup.setdefault(key, [0, 0, 0, 0, 0.0, 0.0])
+                row[0] += 1
+                row[1] += entry['status'] == 'failed'
+                row[2] += entry['cached']
+                row[3] += entry['images']
+                row[4] += entry['cost']
+                row[5] += entry['latency_ms']
+        return [key + tuple(values) for key, values in rollup.items()]
+
+    def _write_batch(self, connection, batch):
+        with connection:
+            connection.executemany(
+                'INSERT INTO generations (created_at, client, operation, model, size, quality, n, images, '
+                'cached, status, latency_ms, cost) VALUES (:created_at, :client, :operation, :model, :size, '
+                ':quality, :n, :images, :cached, :status, :latency_ms, :cost)',
+                batch,
+            )
+            connection.executemany(
+                'INSERT INTO usage_rollup (period, bucket, model, client, requests, failed, cached, images, '
+                'cost, latency_ms) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (period, bucket, model, client) DO UPDATE SET '
+                'requests = requests + excluded.requests, failed = failed + excluded.failed, '
+                'cached = cached + excluded.cached, images = images + excluded.images, '
+                'cost = cost + excluded.cost, latency_ms = latency_ms + excluded.latency_ms',
+                self._rollup(batch),
+            )
+
+    def summary(self, period='day', since=None, until=None, group_by=(), client=None):
+        """Сводка из агрегатов: по корзинам периода с необязательной группировкой по model/client"""
+        if not self.enabled:
+            raise GenerationError('Журнал использования выключен', 404)
+        if period not in USAGE_PERIODS:
+            raise GenerationError(f'Неизвестный период: {period}', 400)
+        for column in group_by:
+            if column not in ('model', 'client'):
+                raise GenerationError(f'Нельзя группировать по {column}', 400)
+        now = time.time()
+        until = now if until is None else until
+        since = until - USAGE_DEFAULT_RANGE[period] if since is None else since
+        seconds = USAGE_PERIODS[period]
+        conditions = ['period = ?', 'bucket >= ?', 'bucket < ?']
+        args = [period, int(since // seconds * seconds), until]
+        if client is not None:
+            conditions.append('client = ?')
+            args.append(client)
+        columns = ['bucket'] + list(group_by)
+        rows = self._reader().execute(
+            f'SELECT {", ".join(columns)}, SUM(requests), SUM(failed), SUM(cached), SUM(images), SUM(cost), '
+            f'SUM(latency_ms) FROM usage_rollup WHERE {" AND ".join(conditions)} '
+            f'GROUP BY {", ".join(columns)} ORDER BY {", ".join(columns)}',
+            args,
+        ).fetchall()
+
+        buckets = []
+        totals = {'requests': 0, 'failed': 0, 'cached': 0, 'images': 0, 'cost': 0.0}
+        for row in rows:
+            requests_count, failed, cached, images, cost, latency = row[len(columns):]
+            item = dict(zip(columns, row[:len(columns)]))
+            item.update({
+                'start': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(item['bucket'])),
+                'requests': requests_count,
+                'failed': failed,
+                'cached': cached,
+                'images': images,
+                'cost': round(cost, 6),
+                'avg_latency_ms': round(latency / requests_count, 1) if requests_count else None,
+            })
+            buckets.append(item)
+            for name in ('requests', 'failed', 'cached', 'images'):
+                totals[name] += item[name]
+            totals['cost'] += cost
+        totals['cost'] = round(totals['cost'], 6)
+        return {'period': period, 'since': since, 'until': until, 'buckets': buckets, 'totals': totals}
+
+
+usage_ledger = UsageLedger(USAGE_DB_PATH, USAGE_LEDGER_ENABLED)
+
+
+# История генераций с полнотекстовым поиском по промптам
+HISTORY_DB_PATH = os.environ.get('HISTORY_DB_PATH') or os.path.join(tempfile.gettempdir(), 'imagegen-history.sqlite3')
+HISTORY_ENABLED = os.environ.get('HISTORY_ENABLED', '1').lower() not in ('0', 'false', 'no')
+HISTORY_FLUSH_INTERVAL = _env_float('HISTORY_FLUSH_INTERVAL', 0.2)
+HISTORY_PAGE_SIZE = _env_int('HISTORY_PAGE_SIZE', 24)
+HISTORY_MAX_PAGE_SIZE = 100
+
+# Записи идут от новых к старым по id; вторичные индексы SQLite уже упорядочены по rowid внутри значения
+HISTORY_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY,
+    created_at REAL NOT NULL,
+    client TEXT NOT NULL,
+    operation TEXT NOT NULL,
+    model TEXT NOT NULL,
+    size TEXT,
+    quality TEXT,
+    prompt TEXT NOT NULL,
+    params TEXT NOT NULL,
+    images TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS history_created ON history (created_at);
+CREATE INDEX IF NOT EXISTS history_model ON history (model);
+CREATE INDEX IF NOT EXISTS history_size ON history (size);
+CREATE INDEX IF NOT EXISTS history_client ON history (client);
+CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5(
+    prompt, content='history', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS history_fts_insert AFTER INSERT ON history BEGIN
+    INSERT INTO history_fts (rowid, prompt) VALUES (new.id, new.prompt);
+END;
+CREATE TRIGGER IF NOT EXISTS history_fts_delete AFTER DELETE ON history BEGIN
+    INSERT INTO history_fts (history_fts, rowid, prompt) VALUES ('delete', old.id, old.prompt);
+END;
+'''
+
+
+def history_search_query(text):
+    """Пользовательский текст в запрос FTS5: каждое слово как префикс, все слова обязательны"""
+    words = re.findall(r'\w+', text or '')
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+class HistoryStore(SQLiteBatchWriter):
+    """Параметры и ссылки на изображения каждой успешной генерации"""
+
+    schema = HISTORY_SCHEMA
+    thread_name = 'generation-history'
+
+    def record_result(self, client, operation, params, images):
+        self.record((
+            time.time(),
+            client or '',
+            operation,
+            params.get('model') or '',
+            params.get('size'),
+            params.get('quality'),
+            params.get('prompt') or '',
+            json.dumps(params, ensure_ascii=False),
+            json.dumps([
+                {key: image[key] for key in ('id', 'url', 'preview_url', 'format', 'bytes') if key in image}
+                for image in images
+            ]),
+        ))
+
+    def _write_batch(self, connection, batch):
+        with connection:
+            connection.executemany(
+                'INSERT INTO history (created_at, client, operation, model, size, quality, prompt, params, images) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                batch,
+            )
+
+    def page(self, cursor=None, limit=HISTORY_PAGE_SIZE, model=None, size=None, since=None, until=None,
+             search=None, client=None):
+        """Страница истории от новых к старым; next_cursor продолжает с места остановки"""
+        if not self.enabled:
+            raise GenerationError('История выключена', 404)
+        limit = max(1, min(int(limit), HISTORY_MAX_PAGE_SIZE))
+        conditions = []
+        args = []
+        query = history_search_query(search)
+        if query:
+            # Поиск ведет индекс FTS5: он отдает rowid по убыванию и останавливается на limit
+            source = 'history_fts JOIN history ON history.id = history_fts.rowid'
+            order = 'history_fts.rowid'
+            conditions.append('history_fts MATCH ?')
+            args.append(query)
         else:
-            self.send_error(404)
-    
-    def respond_json(self, data, status_code=200):
-        """Отправляет JSON ответ с правильными заголовками"""
-        self.send_response(status_code)
-        self.send_header('Content-Type', 'application/json')
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-        self.end_headers()
-        self.wfile.write(json.dumps(data).encode('utf-8'))
-    
-    def respond_html(self, html):
-        """Отправляет HTML ответ"""
-        self.send_response(200)
-        self.send_header('Content-Type', 'text/html; charset=utf-8')
-        self.end_headers()
-        self.wfile.write(html.encode('utf-8'))
-    
-    def serve_login_page(self):
-        html = '''<!DOCTYPE html>
+            source = 'history'
+            order = 'history.id'
+        for column, value in (('model', model), ('size', size), ('client', client)):
+            if value:
+                conditions.append(f'history.{column} = ?')
+                args.append(value)
+        if since is not None:
+            conditions.append('history.created_at >= ?')
+            args.append(since)
+        if until is not None:
+            conditions.append('history.created_at < ?')
+            args.append(until)
+        if cursor:
+            try:
+                args.append(int(cursor))
+            except ValueError:
+                raise GenerationError('Неверный курсор', 400)
+            conditions.append(f'{order} < ?')
+
+        where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+        rows = self._reader().execute(
+            'SELECT history.id, history.created_at, history.operation, history.model, history.size, '
+            f'history.quality, history.prompt, history.images FROM {source} {where} ORDER BY {order} DESC LIMIT ?',
+            args + [limit + 1],
+        ).fetchall()
+
+        items = [{
+            'id': row[0],
+            'created_at': row[1],
+            'operation': row[2],
+            'model': row[3],
+            'size': row[4],
+            'quality': row[5],
+            'prompt': row[6],
+            'images': json.loads(row[7]),
+        } for row in rows[:limit]]
+        # Лишняя строка говорит, что дальше есть еще записи
+        next_cursor = str(items[-1]['id']) if len(rows) > limit else None
+        return {'items': items, 'next_cursor': next_cursor}
+
+
+generation_history = HistoryStore(HISTORY_DB_PATH, HISTORY_ENABLED, flush_interval=HISTORY_FLUSH_INTERVAL)
+
+
+# Поиск похожих промптов для повторного использования готовых результатов
+PROMPT_REUSE_THRESHOLD = _env_float('PROMPT_REUSE_THRESHOLD', 0.6)
+PROMPT_REUSE_MAX_CANDIDATES = _env_int('PROMPT_REUSE_MAX_CANDIDATES', 5)
+PROMPT_INDEX_MAX_ENTRIES = _env_int('PROMPT_INDEX_MAX_ENTRIES', 50000)
+PROMPT_INDEX_WARM_ENTRIES = _env_int('PROMPT_INDEX_WARM_ENTRIES', 5000)
+PROMPT_MINHASH_PERMUTATIONS = 64
+PROMPT_LSH_BANDS = 16
+_MINHASH_PRIME = (1 << 61) - 1
+_minhash_random = random.Random(20240601)
+# Коэффициенты фиксированы, чтобы подписи совпадали между процессами
+MINHASH_COEFFICIENTS = [
+    (_minhash_random.randrange(1, _MINHASH_PRIME), _minhash_random.randrange(0, _MINHASH_PRIME))
+    for _ in range(PROMPT_MINHASH_PERMUTATIONS)
+]
+
+
+def canonicalize_prompt(prompt):
+    """Промпт без различий в регистре, пробелах, пунктуации и ё/е"""
+    text = unicodedata.normalize('NFKC', prompt or '').casefold().replace('ё', 'е')
+    return ' '.join(re.findall(r'\w+', text))
+
+
+def prompt_shingles(canonical):
+    """Слова и пары соседних слов: замена одного слова меняет несколько элементов, порядок тоже учитывается"""
+    words = canonical.split()
+    return frozenset(words + [f'{a} {b}' for a, b in zip(words, words[1:])])
+
+
+def minhash_signature(shingles):
+    hashes = [int.from_bytes(hashlib.blake2b(item.encode('utf-8'), digest_size=8).digest(), 'little')
+              for item in shingles]
+    return [min((a * h + b) % _MINHASH_PRIME for h in hashes) for a, b in MINHASH_COEFFICIENTS]
+
+
+def prompt_reuse_key(params):
+    """Группа, внутри которой результаты взаимозаменяемы: все параметры, кроме промпта и n"""
+    return json.dumps({k: v for k, v in params.items() if k not in ('prompt', 'n')}, sort_keys=True)
+
+
+class PromptIndex:
+    """MinHash/LSH индекс прошлых промптов с готовыми изображениями"""
+
+    def __init__(self, max_entries=PROMPT_INDEX_MAX_ENTRIES, bands=PROMPT_LSH_BANDS,
+                 warm_entries=PROMPT_INDEX_WARM_ENTRIES):
+        self.max_entries = max_entries
+        self.bands = bands
+        self.rows = PROMPT_MINHASH_PERMUTATIONS // bands
+        self.warm_entries = warm_entries
+        self._entries = OrderedDict()
+        self._buckets = {}
+        self._next_id = 0
+        self._warmed = False
+        self._lock = threading.Lock()
+
+    def _band_keys(self, group, signature):
+        return [hash((group, band, tuple(signature[band * self.rows:(band + 1) * self.rows])))
+                for band in range(self.bands)]
+
+    def _add(self, group, prompt, images, created_at):
+        canonical = canonicalize_prompt(prompt)
+        if not canonical:
+            return
+        shingles = prompt_shingles(canonical)
+        band_keys = self._band_keys(group, minhash_signature(shingles))
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (group, prompt, canonical, shingles, images, created_at, band_keys)
+            for key in band_keys:
+                self._buckets.setdefault(key, set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, entry_id):
+        entry = self._entries.pop(entry_id)
+        for key in entry[6]:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[key]
+
+    def add(self, params, images):
+        """Добавляет результат генерации в индекс"""
+        images = [
+            {key: image[key] for key in ('id', 'url', 'preview_url', 'format') if key in image}
+            for image in images if image.get('id')
+        ]
+        if images:
+            self._add(prompt_reuse_key(params), params.get('prompt'), images, time.time())
+
+    def _warm(self):
+        # После холодного старта подхватываем свежие записи истории в фоне, поиск не ждет загрузки
+        with self._lock:
+            if self._warmed:
+                return
+            self._warmed = True
+        if generation_history.enabled and self.warm_entries:
+            threading.Thread(target=self._load_history, name='prompt-index-warm', daemon=True).start()
+
+    def _load_history(self):
+        try:
+            rows = generation_history._reader().execute(
+                "SELECT created_at, params, images FROM history WHERE operation = 'generate' "
+                'ORDER BY id DESC LIMIT ?',
+                (self.warm_entries,),
+            ).fetchall()
+        except sqlite3.Error:
+            return
+        for created_at, params_json, images_json in reversed(rows):
+            params = json.loads(params_json)
+            self._add(prompt_reuse_key(params), params.get('prompt'), json.loads(images_json), created_at)
+
+    def similar(self, params, threshold=PROMPT_REUSE_THRESHOLD, limit=PROMPT_REUSE_MAX_CANDIDATES):
+        """Прошлые результаты с похожим промптом: сходство Жаккара не ниже threshold, лучшие первыми"""
+        self._warm()
+        canonical = canonicalize_prompt(params.get('prompt'))
+        if not canonical:
+            return []
+        group = prompt_reuse_key(params)
+        shingles = prompt_shingles(canonical)
+        band_keys = self._band_keys(group, minhash_signature(shingles))
+        with self._lock:
+            candidate_ids = set()
+            for key in band_keys:
+                candidate_ids.update(self._buckets.get(key, ()))
+            entries = [self._entries[entry_id] for entry_id in candidate_ids]
+
+        best = {}
+        for entry_group, prompt, entry_canonical, entry_shingles, images, created_at, _ in entries:
+            if entry_group != group:
+                continue
+            # Оценка LSH только отбирает кандидатов, порог проверяем по точному сходству
+            similarity = 1.0 if entry_canonical == canonical else \
+                len(shingles & entry_shingles) / len(shingles | entry_shingles)
+            if similarity < threshold:
+                continue
+            # Изображения могли быть вытеснены из хранилища
+            if not all(os.path.exists(image_store.path(image.get('id')) or '') for image in images):
+                continue
+            previous = best.get(entry_canonical)
+            if previous is None or previous['created_at'] < created_at:
+                best[entry_canonical] = {
+                    'prompt': prompt,
+                    'similarity': round(similarity, 3),
+                    'exact': entry_canonical == canonical,
+                    'created_at': created_at,
+                    'images': images,
+                }
+        return sorted(best.values(), key=lambda c: (-c['similarity'], -c['created_at']))[:limit]
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'buckets': len(self._buckets)}
+
+
+prompt_index = PromptIndex()
+
+
+def find_reuse_candidates(params, data):
+    """Кандидаты на повторное использование с порогом из запроса (similarity_threshold) или по умолчанию"""
+    threshold = data.get('similarity_threshold', PROMPT_REUSE_THRESHOLD)
+    try:
+        threshold = float(threshold)
+    except (TypeError, ValueError):
+        raise GenerationError('similarity_threshold должен быть числом', 400)
+    if not 0.5 <= threshold <= 1:
+        raise GenerationError('similarity_threshold должен быть от 0.5 до 1', 400)
+    with measure_stage('reuse_lookup'):
+        return prompt_index.similar(params, threshold)
+
+
+def record_generation(client, operation, params, images, cached, failed, latency):
+    """Записывает результат в журнал расходов, историю и индекс похожих промптов"""
+    usage_ledger.record_generation(client, operation, params, len(images), cached, failed, latency)
+    if images:
+        generation_history.record_result(client, operation, params, images)
+        if operation == 'generate' and not cached:
+            prompt_index.add(params, images)
+
+
+# Настройки пакетной генерации
+BATCH_MAX_ITEMS = _env_int('BATCH_MAX_ITEMS', 50)
+BATCH_CONCURRENCY = _env_int('BATCH_CONCURRENCY', 4)
+# Сколько элемент пакета может ждать токенов лимита частоты, прежде чем получить 429
+BATCH_RATE_LIMIT_WAIT = _env_float('BATCH_RATE_LIMIT_WAIT', 60.0)
+
+
+def run_generation_batch(client, items, defaults, concurrency, use_cache=True, client_id=None):
+    """Запускает генерации пакета параллельно и отдает результаты по мере готовности"""
+
+    def run_item(index, item):
+        try:
+            if not isinstance(item, dict):
+                raise GenerationError('Элемент пакета должен быть объектом', 400)
+            data = dict(defaults, **item)
+            params = build_generation_params(data)
+            output = build_output_options(data, params)
+            # Лимит списывается за элемент в момент запуска, пакет больше емкости bucket проходит по мере пополнения
+            client_rate_limiter.acquire(client_id, params['n'], BATCH_RATE_LIMIT_WAIT)
+            job, _ = generation_jobs.run_sync(client, params, use_cache, output, client_id)
+            if job.status != 'succeeded':
+                return {'index': index, 'success': False, 'error': job.error, 'status': job.error_status}
+            return {'index': index, 'success': True, 'images': job.images, 'cached': job.cached}
+        except GenerationError as e:
+            return {'index': index, 'success': False, 'error': str(e), 'status': e.status}
+        except Exception as e:
+            return {'index': index, 'success': False, 'error': str(e), 'status': 500}
+
+    executor = ThreadPoolExecutor(max_workers=min(concurrency, len(items)), thread_name_prefix='batch')
+    futures = [executor.submit(run_item, index, item) for index, item in enumerate(items)]
+    executor.shutdown(wait=False)
+    for future in as_completed(futures):
+        yield future.result()
+
+
+class GenerationJob:
+    """Одно задание генерации и его состояние"""
+
+    def __init__(self, client, params, use_cache=True, output=None, client_id=None):
+        self.id = secrets.token_hex(16)
+        self.client = client
+        self.params = params
+        self.use_cache = use_cache
+        self.output = output
+        self.client_id = client_id
+        self.status = 'queued'
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.images = None
+        self.cached = False
+        self.error = None
+        self.error_status = None
+        self.retry_after = None
+        self.done = threading.Event()
+
+    def to_dict(self):
+        """Публичное представление задания для API"""
+        now = time.time()
+        started = self.started_at or now
+        finished = self.finished_at or now
+        timings = {
+            'queued_ms': round((started - self.created_at) * 1000),
+            'running_ms': round((finished - started) * 1000) if self.started_at else 0,
+            'total_ms': round((finished - self.created_at) * 1000),
+        }
+        return {
+            'id': self.id,
+            'status': self.status,
+            'model': self.params.get('model'),
+            'n': self.params.get('n'),
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'timings': timings,
+            'images': self.images,
+            'cached': self.cached,
+            'error': self.error,
+        }
+
+
+class JobManager:
+    """Ограниченный пул воркеров, выполняющих задания генерации
+
+    Задания живут в памяти процесса, поэтому API заданий рассчитан на автономный сервер
+    (python -m api.index): на Vercel опрос статуса может попасть в другой экземпляр и получить 404.
+    """
+
+    def __init__(self, workers=JOB_WORKERS, queue_size=JOB_QUEUE_SIZE, ttl=JOB_RESULT_TTL):
+        self.workers = workers
+        self.ttl = ttl
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def _ensure_workers(self):
+        # Воркеры стартуют при первом задании, чтобы не тратить холодный старт
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f'generation-job-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            try:
+                self.execute(job)
+            finally:
+                self._queue.task_done()
+
+    def _purge_expired(self, now):
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished_at and now - job.finished_at > self.ttl]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def execute(self, job):
+        """Выполняет задание в текущем потоке; возвращает байты изображений или None"""
+        job.status = 'running'
+        job.started_at = time.time()
+        # Синхронное задание пишет этапы в таймер запроса, фоновое и пакетное заводят свой
+        timer = StageTimer.current()
+        own_timer = timer is None
+        if own_timer:
+            timer = StageTimer()
+        timer.set_params(job.params)
+        try:
+            with timer.activate():
+                contents, job.cached = run_generation(job.client, job.params, job.use_cache)
+                contents, job.images = store_generation_result(contents, job.output)
+            job.status = 'succeeded'
+            return contents
+        except GenerationError as e:
+            record_error(e)
+            job.error = str(e)
+            job.error_status = e.status
+            job.retry_after = getattr(e, 'retry_after', None)
+            job.status = 'failed'
+        except Exception as e:
+            record_error(e)
+            job.error = str(e)
+            job.error_status = 500
+            job.status = 'failed'
+        finally:
+            job.finished_at = time.time()
+            job.client = None
+            record_generation(
+                job.client_id, 'generate', job.params, job.images or [],
+                job.cached, job.status == 'failed', job.finished_at - job.started_at,
+            )
+            job.done.set()
+            if own_timer:
+                timer.flush()
+        return None
+
+    def submit(self, client, params, use_cache=True, output=None, client_id=None):
+        """Ставит задание в очередь и сразу возвращает его"""
+        self._ensure_workers()
+        job = GenerationJob(client, params, use_cache, output, client_id)
+        with self._lock:
+            self._purge_expired(time.time())
+            self._jobs[job.id] = job
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                del self._jobs[job.id]
+            raise GenerationError('Очередь заданий переполнена, попробуйте позже', 503)
+        return job
+
+    def run_sync(self, client, params, use_cache=True, output=None, client_id=None):
+        """Синхронный путь: то же выполнение, но в потоке запроса"""
+        job = GenerationJob(client, params, use_cache, output, client_id)
+        contents = self.execute(job)
+        return job, contents
+
+    def get(self, job_id, client_id=None):
+        """Возвращает задание по ID или None; чужое задание выглядит как отсутствующее"""
+        with self._lock:
+            self._purge_expired(time.time())
+            job = self._jobs.get(job_id)
+        if job is None or job.client_id != client_id:
+            return None
+        return job
+
+    def stats(self):
+        """Счетчики очереди заданий"""
+        with self._lock:
+            statuses = {}
+            for job in self._jobs.values():
+                statuses[job.status] = statuses.get(job.status, 0) + 1
+            return {
+                'workers': self.workers,
+                'queued': self._queue.qsize(),
+                'queue_size': self._queue.maxsize,
+                'jobs': statuses,
+            }
+
+
+generation_jobs = JobManager()
+
+
+def render_login_page():
+    """HTML страницы входа"""
+    html = '''<!DOCTYPE html>
 <html lang="ru">
 <head>
 <meta charset="UTF-8">
@@ -188,42 +3160,24 @@ input:focus {
     </script>
 </body>
 </html>'''
-        
-        self.respond_html(html)
-    
-    def handle_login(self):
-        try:
-            # Читаем данные запроса
-            content_length = int(self.headers.get('Content-Length', 0))
-            post_data = self.rfile.read(content_length)
-            data = json.loads(post_data.decode('utf-8'))
-            
-            secret_key = data.get('secret_key')
-            expected_secret = os.environ.get('SECRET_KEY', '')
-            
-            if secret_key == expected_secret and expected_secret:
-                # ПРИ УСПЕШНОЙ АВТОРИЗАЦИИ УСТАНАВЛИВАЕМ COOKIE
-                response_data = {'success': True}
-                self.send_response(200)
-                self.send_header('Content-Type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                # Устанавливаем cookie для авторизации
-                self.send_header('Set-Cookie', 'auth_token=valid; Path=/; HttpOnly')
-                self.end_headers()
-                self.wfile.write(json.dumps(response_data).encode('utf-8'))
-            else:
-                self.respond_json({'success': False})
-            
-        except Exception as e:
-            self.respond_json({'success': False, 'error': str(e)}, 500)
+    return html
 
-    
-    def serve_main_page(self):
-        # Проверяем наличие OpenAI API ключа
-        openai_key = os.environ.get('OPENAI_API_KEY', '')
-        api_status = 'ok' if openai_key else 'missing'
-        
-        html = '''<!DOCTYPE html>
+
+def render_main_page(api_ok):
+    """HTML главной страницы для варианта с ключом OpenAI или без него"""
+    api_status = 'ok' if api_ok else 'missing'
+    model_options = '\n'.join(
+        f'                        <option value="{model}">{spec["label"]}</option>'
+        for model, spec in MODEL_REGISTRY.items()
+    )
+    # Реестр встраивается в <script>, поэтому экранируем закрывающие теги
+    models_json = json.dumps(MODEL_REGISTRY, ensure_ascii=False).replace('</', '<\\/')
+    format_options = '\n'.join(
+        f'                        <option value="{value}">{label}</option>'
+        for value, label in OUTPUT_FORMATS.items()
+    )
+
+    html = '''<!DOCTYPE html>
 <html lang="ru">
 <head>
 <meta charset="UTF-8">
@@ -370,6 +3324,29 @@ textarea {
     background: linear-gradient(135deg, #ff6b6b 0%, #ee5a24 100%);
     color: white;
 }
+.status .timings {
+    display: block;
+    margin-top: 6px;
+    font-size: 0.8rem;
+    font-weight: 400;
+    opacity: 0.9;
+}
+.reuse-candidate {
+    display: flex;
+    align-items: center;
+    justify-content: space-between;
+    gap: 12px;
+    margin-top: 10px;
+    font-weight: 400;
+    text-align: left;
+}
+.reuse-candidate button {
+    flex-shrink: 0;
+    padding: 6px 14px;
+    border: none;
+    border-radius: 8px;
+    cursor: pointer;
+}
 .images-grid {
     display: grid;
     grid-template-columns: repeat(auto-fill, minmax(280px, 1fr));
@@ -404,6 +3381,7 @@ textarea {
     display: flex;
     align-items: center;
     justify-content: center;
+    gap: 10px;
 }
 .image-card:hover .image-overlay {
     opacity: 1;
@@ -418,14 +3396,49 @@ textarea {
     font-weight: 600;
     border: 2px solid rgba(255,255,255,0.3);
 }
-.balance-link {
+.balance-link {
+    text-align: center;
+    margin: 15px 0;
+    font-size: 14px;
+}
+.balance-link a {
+    color: #667eea;
+    text-decoration: none;
+}
+.history {
+    margin-top: 40px;
+    padding-top: 30px;
+    border-top: 2px solid #e1e8ed;
+}
+.history-header {
+    display: flex;
+    flex-wrap: wrap;
+    gap: 15px;
+    align-items: center;
+}
+.history-header h2 {
+    color: #2c3e50;
+    font-weight: 700;
+    flex: 1 1 100%;
+}
+.history-header input {
+    flex: 1 1 240px;
+}
+.history-prompt {
+    padding: 10px 14px;
+    font-size: 0.8rem;
+    color: #5a6c7d;
+    white-space: nowrap;
+    overflow: hidden;
+    text-overflow: ellipsis;
+}
+.history-empty {
     text-align: center;
-    margin: 15px 0;
-    font-size: 14px;
+    color: #8795a1;
+    margin-top: 20px;
 }
-.balance-link a {
-    color: #667eea;
-    text-decoration: none;
+.history-sentinel {
+    height: 1px;
 }
 @media (max-width: 768px) {
     .container {
@@ -454,9 +3467,7 @@ textarea {
                 <div class="form-group">
                     <label for="model">Модель:</label>
                     <select id="model" name="model" onchange="updateModelOptions(); updateCostHint();">
-                        <option value="gpt-image-1">GPT Image 1 (Лучшее качество)</option>
-                        <option value="dall-e-3">DALL-E 3 (Высокое качество)</option>
-                        <option value="dall-e-2">DALL-E 2 (Быстро и доступно)</option>
+''' + model_options + '''
                     </select>
                     <div id="modelInfo" class="model-info"></div>
                 </div>
@@ -473,27 +3484,17 @@ textarea {
                 
                 <div class="form-group" id="styleGroup">
                     <label for="style">Стиль (DALL-E 3):</label>
-                    <select id="style" name="style">
-                        <option value="vivid">Яркий</option>
-                        <option value="natural">Естественный</option>
-                    </select>
+                    <select id="style" name="style"></select>
                 </div>
                 
                 <div class="form-group" id="backgroundGroup">
                     <label for="background">Фон (GPT Image 1):</label>
-                    <select id="background" name="background">
-                        <option value="auto">Авто (по умолчанию)</option>
-                        <option value="transparent">Прозрачный</option>
-                        <option value="opaque">Непрозрачный</option>
-                    </select>
+                    <select id="background" name="background"></select>
                 </div>
                 
                 <div class="form-group" id="moderationGroup">
                     <label for="moderation">Модерация (GPT Image 1):</label>
-                    <select id="moderation" name="moderation">
-                        <option value="low" selected>Низкая (менее строгая)</option>
-                        <option value="auto">Авто (стандартная)</option>
-                    </select>
+                    <select id="moderation" name="moderation"></select>
                 </div>
                 
                 <div class="form-group">
@@ -505,6 +3506,18 @@ textarea {
                         <option value="4">4</option>
                     </select>
                 </div>
+                
+                <div class="form-group">
+                    <label for="output_format">Формат файла:</label>
+                    <select id="output_format" name="output_format" onchange="updateFormatOptions();">
+''' + format_options + '''
+                    </select>
+                </div>
+                
+                <div class="form-group" id="compressionGroup">
+                    <label for="output_compression">Качество сжатия (0-100):</label>
+                    <input type="number" id="output_compression" name="output_compression" min="0" max="100" value="''' + str(OUTPUT_DEFAULT_COMPRESSION) + '''">
+                </div>
             </div>
             
             <div class="form-group">
@@ -528,27 +3541,25 @@ textarea {
         
         <div id="status"></div>
         <div id="images" class="images-grid"></div>
+
+        <div class="history">
+            <div class="history-header">
+                <h2>🗂️ История</h2>
+                <input type="search" id="historySearch" placeholder="Поиск по промптам">
+                <select id="historyModel">
+                    <option value="">Все модели</option>
+''' + model_options + '''
+                </select>
+            </div>
+            <div id="historyGrid" class="images-grid"></div>
+            <div id="historyEmpty" class="history-empty" style="display: none;">Пока ничего нет</div>
+            <div id="historySentinel" class="history-sentinel"></div>
+        </div>
     </div>
 
     <script>
-        // Данные о ценах (актуальные по состоянию на 2025)
-        const priceData = {
-            "gpt-image-1": {
-                "1024x1024": { "low": 0.011, "medium": 0.042, "high": 0.167, "auto": 0.042 },
-                "1024x1536": { "low": 0.016, "medium": 0.063, "high": 0.250, "auto": 0.063 },
-                "1536x1024": { "low": 0.016, "medium": 0.063, "high": 0.250, "auto": 0.063 }
-            },
-            "dall-e-3": {
-                "1024x1024": { "standard": 0.040, "hd": 0.080 },
-                "1024x1792": { "standard": 0.080, "hd": 0.120 },
-                "1792x1024": { "standard": 0.080, "hd": 0.120 }
-            },
-            "dall-e-2": {
-                "1024x1024": { "standard": 0.020 },
-                "512x512": { "standard": 0.018 },
-                "256x256": { "standard": 0.016 }
-            }
-        };
+        // Реестр моделей с сервера: размеры, параметры, лимиты и цены (актуальные по состоянию на 2025)
+        const MODELS = ''' + models_json + ''';
 
         function updateCostHint() {
             const model = document.getElementById('model').value;
@@ -558,83 +3569,190 @@ textarea {
             
             if (!model || !size || !quality) return;
             
-            const costPerImage = priceData[model]?.[size]?.[quality] || 0;
+            const costPerImage = MODELS[model]?.prices?.[size]?.[quality] || 0;
             const totalCost = costPerImage * n;
+            const calls = Math.ceil(n / MODELS[model].max_n);
             
             const costHint = document.getElementById('costHint');
             costHint.innerHTML = `
                 <strong>💰 Стоимость генерации:</strong><br>
                 За 1 изображение: <strong>$${costPerImage.toFixed(4)}</strong><br>
                 Общая стоимость (${n} изобр.): <strong>$${totalCost.toFixed(4)}</strong><br>
+                ${calls > 1 ? `Будет выполнено ${calls} параллельных запросов к API<br>` : ''}
                 <a href="https://platform.openai.com/docs/pricing#image-generation" target="_blank">📊 Подробнее о ценах</a>
             `;
         }
 
+        function fillSelect(select, values) {
+            select.innerHTML = '';
+            Object.entries(values).forEach(([value, label]) => {
+                const option = document.createElement('option');
+                option.value = value;
+                option.textContent = label;
+                select.appendChild(option);
+            });
+        }
+
         function updateModelOptions() {
-            const model = document.getElementById('model').value;
-            const sizeSelect = document.getElementById('size');
-            const qualityGroup = document.getElementById('qualityGroup');
-            const qualitySelect = document.getElementById('quality');
-            const styleGroup = document.getElementById('styleGroup');
-            const backgroundGroup = document.getElementById('backgroundGroup');
-            const moderationGroup = document.getElementById('moderationGroup');
-            const infoDiv = document.getElementById('modelInfo');
+            const spec = MODELS[document.getElementById('model').value];
             
-            sizeSelect.innerHTML = '';
-            qualitySelect.innerHTML = '';
+            fillSelect(document.getElementById('size'), spec.sizes);
             
-            if (model === 'gpt-image-1') {
-                sizeSelect.innerHTML = `
-                    <option value="1024x1024">1024×1024 (Квадрат)</option>
-                    <option value="1024x1536">1024×1536 (Портрет)</option>
-                    <option value="1536x1024">1536×1024 (Пейзаж)</option>
-                `;
-                qualitySelect.innerHTML = `
-                    <option value="low" selected>Низкое</option>
-                    <option value="medium">Среднее</option>
-                    <option value="high">Высокое</option>
-                    <option value="auto">По-умолчанию (среднее)</option>
-                `;
-                qualityGroup.style.display = 'block';
-                styleGroup.style.display = 'none';
-                backgroundGroup.style.display = 'block';
-                moderationGroup.style.display = 'block';
-                infoDiv.innerHTML = '🚀 Новейшая модель с лучшим качеством, пониманием текста и поддержкой прозрачного фона. Может занимать до 2 минут.';
-            } else if (model === 'dall-e-3') {
-                sizeSelect.innerHTML = `
-                    <option value="1024x1024">1024×1024 (Квадрат)</option>
-                    <option value="1024x1792">1024×1792 (Портрет)</option>
-                    <option value="1792x1024">1792×1024 (Пейзаж)</option>
-                `;
-                qualitySelect.innerHTML = `
-                    <option value="standard" selected>Стандартное</option>
-                    <option value="hd">HD</option>
-                `;
-                qualityGroup.style.display = 'block';
-                styleGroup.style.display = 'block';
-                backgroundGroup.style.display = 'none';
-                moderationGroup.style.display = 'none';
-                infoDiv.innerHTML = '🎨 Высокое качество изображений и понимание сложных описаний.';
-            } else {
-                sizeSelect.innerHTML = `
-                    <option value="1024x1024">1024×1024</option>
-                    <option value="512x512">512×512</option>
-                    <option value="256x256">256×256</option>
-                `;
-                qualitySelect.innerHTML = `<option value="standard">Стандартное</option>`;
-                qualityGroup.style.display = 'block';
-                styleGroup.style.display = 'none';
-                backgroundGroup.style.display = 'none';
-                moderationGroup.style.display = 'none';
-                infoDiv.innerHTML = '⚡ Быстрая генерация изображений по доступной цене.';
-            }
+            // Группа параметра видна, только если модель его поддерживает
+            ['quality', 'style', 'background', 'moderation'].forEach(name => {
+                const option = spec.options[name];
+                const group = document.getElementById(name + 'Group');
+                const select = document.getElementById(name);
+                if (option) {
+                    fillSelect(select, option.values);
+                    group.style.display = 'block';
+                    select.disabled = false;
+                } else {
+                    select.innerHTML = '';
+                    group.style.display = 'none';
+                    select.disabled = true;
+                }
+            });
+            
+            document.getElementById('modelInfo').innerHTML = spec.info;
+        }
+
+        function updateFormatOptions() {
+            // Для PNG сжатие не применяется, выключенное поле не попадет в форму
+            const lossless = document.getElementById('output_format').value === 'png';
+            document.getElementById('compressionGroup').style.display = lossless ? 'none' : 'flex';
+            document.getElementById('output_compression').disabled = lossless;
         }
         
         updateModelOptions();
+        updateFormatOptions();
         updateCostHint();
         
+        // Галерея истории: страницы подгружаются, когда низ списка появляется на экране
+        const historyState = { cursor: null, loading: false, done: false, generation: 0 };
+        
+        function historyCard(item, image) {
+            const card = document.createElement('div');
+            card.className = 'image-card';
+            const img = document.createElement('img');
+            img.loading = 'lazy';
+            img.decoding = 'async';
+            img.src = image.preview_url || image.url;
+            img.alt = item.prompt;
+            img.title = item.prompt;
+            const overlay = document.createElement('div');
+            overlay.className = 'image-overlay';
+            overlay.innerHTML = `
+                <a href="${image.url}" target="_blank" class="download-btn">🔍 Открыть</a>
+                <a href="${image.url}" download="ai_image_${image.id}.${image.format === 'jpeg' ? 'jpg' : image.format}" class="download-btn">📥 Скачать</a>
+            `;
+            const caption = document.createElement('div');
+            caption.className = 'history-prompt';
+            caption.textContent = `${new Date(item.created_at * 1000).toLocaleString()} · ${item.model} · ${item.prompt}`;
+            card.append(img, overlay, caption);
+            return card;
+        }
+        
+        function isSentinelVisible() {
+            const rect = document.getElementById('historySentinel').getBoundingClientRect();
+            return rect.top < window.innerHeight + 600;
+        }
+        
+        async function loadHistory() {
+            if (historyState.loading || historyState.done) return;
+            historyState.loading = true;
+            const generation = historyState.generation;
+            const params = new URLSearchParams({ limit: 24 });
+            if (historyState.cursor) params.set('cursor', historyState.cursor);
+            const search = document.getElementById('historySearch').value.trim();
+            if (search) params.set('q', search);
+            const model = document.getElementById('historyModel').value;
+            if (model) params.set('model', model);
+            try {
+                const response = await fetch('/api/history?' + params);
+                const result = await response.json();
+                // Пока шел запрос, фильтры могли смениться
+                if (generation !== historyState.generation) return;
+                if (!result.success) {
+                    historyState.done = true;
+                    return;
+                }
+                const grid = document.getElementById('historyGrid');
+                result.items.forEach(item => item.images.forEach(image => grid.appendChild(historyCard(item, image))));
+                historyState.cursor = result.next_cursor;
+                historyState.done = !result.next_cursor;
+                document.getElementById('historyEmpty').style.display = grid.children.length ? 'none' : 'block';
+            } catch (error) {
+                historyState.done = true;
+            } finally {
+                if (generation === historyState.generation) historyState.loading = false;
+            }
+            // Если страница не заполнила экран, сторож остается видимым и новых событий не будет
+            if (generation === historyState.generation && !historyState.done && isSentinelVisible()) loadHistory();
+        }
+        
+        function resetHistory() {
+            historyState.generation += 1;
+            historyState.cursor = null;
+            historyState.loading = false;
+            historyState.done = false;
+            document.getElementById('historyGrid').innerHTML = '';
+            loadHistory();
+        }
+        
+        new IntersectionObserver(entries => {
+            if (entries.some(entry => entry.isIntersecting)) loadHistory();
+        }, { rootMargin: '600px' }).observe(document.getElementById('historySentinel'));
+        
+        let historySearchTimer = null;
+        document.getElementById('historySearch').addEventListener('input', () => {
+            clearTimeout(historySearchTimer);
+            historySearchTimer = setTimeout(resetHistory, 300);
+        });
+        document.getElementById('historyModel').addEventListener('change', resetHistory);
+        
+        // После "Все равно сгенерировать" следующий запрос идет без проверки похожих промптов
+        let skipReuseCheck = false;
+        
+        // Превью из потока живут как Blob за object URL и отзываются при следующей отправке формы
+        const objectUrls = new Set();
+        // Замеры отрисовки для bench/browser_render.py
+        const renderStats = window.imagegenRender = { submittedAt: 0, images: [], liveObjectUrls: 0 };
+        
+        async function base64ToObjectUrl(b64, format) {
+            // base64 декодируется один раз, в DOM попадает только короткий blob: URL
+            const response = await fetch(`data:image/${format};base64,${b64}`);
+            const url = URL.createObjectURL(await response.blob());
+            objectUrls.add(url);
+            renderStats.liveObjectUrls = objectUrls.size;
+            return url;
+        }
+        
+        function revokeObjectUrl(url) {
+            if (url && objectUrls.delete(url)) {
+                URL.revokeObjectURL(url);
+                renderStats.liveObjectUrls = objectUrls.size;
+            }
+        }
+        
+        function releaseObjectUrls() {
+            objectUrls.forEach(url => URL.revokeObjectURL(url));
+            objectUrls.clear();
+            renderStats.liveObjectUrls = 0;
+        }
+        
+        function showImage(img, src, kind, index) {
+            const started = performance.now();
+            img.src = src;
+            img.decode().then(() => {
+                const now = performance.now();
+                renderStats.images.push({ index, kind, decode_ms: now - started, since_submit_ms: now - renderStats.submittedAt });
+            }).catch(() => {});
+        }
+        
         document.getElementById('imageForm').addEventListener('submit', async function(e) {
             e.preventDefault();
+            const form = this;
             
             const statusDiv = document.getElementById('status');
             const imagesDiv = document.getElementById('images');
@@ -646,40 +3764,172 @@ textarea {
                 statusDiv.innerHTML = '<div class="status">Генерируем изображения...</div>';
             }
             
+            releaseObjectUrls();
             imagesDiv.innerHTML = '';
+            renderStats.submittedAt = performance.now();
+            renderStats.images = [];
             
             const formData = new FormData(this);
             const data = Object.fromEntries(formData);
+            data.reuse_check = !skipReuseCheck;
+            skipReuseCheck = false;
+            const cards = {};
+            let errorText = null;
+            let timings = null;
+            const startedAt = performance.now();
+            
+            // Карточка создается при первом событии для изображения (превью или результат)
+            function getCard(index) {
+                if (!cards[index]) {
+                    const card = document.createElement('div');
+                    card.className = 'image-card';
+                    card.innerHTML = `
+                        <img alt="Generated Image ${index + 1}" decoding="async" loading="lazy">
+                        <div class="image-overlay"></div>
+                    `;
+                    imagesDiv.appendChild(card);
+                    cards[index] = card;
+                }
+                return cards[index];
+            }
+            
+            async function showPartial(payload) {
+                const card = getCard(payload.index);
+                const url = await base64ToObjectUrl(payload.b64, payload.format);
+                // Пока декодировали, могли прийти более позднее превью или готовое изображение
+                if (card.dataset.final || Number(card.dataset.partialIndex) > payload.partial_index) {
+                    revokeObjectUrl(url);
+                    return;
+                }
+                const previous = card.dataset.objectUrl;
+                card.dataset.objectUrl = url;
+                card.dataset.partialIndex = payload.partial_index;
+                showImage(card.querySelector('img'), url, 'partial', payload.index);
+                // Уже отрисованное превью картинка держит сама, Blob больше не нужен
+                revokeObjectUrl(previous);
+            }
+            
+            function handleEvent(event, payload) {
+                if (event === 'partial') {
+                    showPartial(payload);
+                    statusDiv.innerHTML = '<div class="status">🖌️ Получено превью, дорисовываем...</div>';
+                } else if (event === 'image') {
+                    // В сетке показываем легкое превью, оригинал грузится только при открытии или скачивании
+                    const card = getCard(payload.index);
+                    card.dataset.final = '1';
+                    showImage(card.querySelector('img'), payload.preview_url || payload.url, 'image', payload.index);
+                    revokeObjectUrl(card.dataset.objectUrl);
+                    delete card.dataset.objectUrl;
+                    card.querySelector('.image-overlay').innerHTML = `
+                        <a href="${payload.url}" target="_blank" class="download-btn">
+                            🔍 Открыть
+                        </a>
+                        <a href="${payload.url}" download="ai_image_${payload.index + 1}.${payload.format === 'jpeg' ? 'jpg' : payload.format}" class="download-btn">
+                            📥 Скачать
+                        </a>
+                    `;
+                } else if (event === 'error') {
+                    errorText = payload.error;
+                } else if (event === 'done') {
+                    timings = payload.timings;
+                }
+            }
+            
+            // Разбивка времени: ожидание OpenAI отдельно от собственных накладных расходов сервиса
+            function formatTimings() {
+                if (!timings) return '';
+                const stages = timings.stages || {};
+                const seconds = ms => (ms / 1000).toFixed(2) + ' с';
+                const upstream = stages.upstream || 0;
+                const download = stages.download || 0;
+                const overhead = Math.max(timings.total_ms - upstream - download, 0);
+                const network = Math.max(performance.now() - startedAt - timings.total_ms, 0);
+                const parts = [`OpenAI: ${seconds(upstream)}`];
+                if (download) parts.push(`загрузка: ${seconds(download)}`);
+                parts.push(`сервер: ${seconds(overhead)}`, `сеть: ${seconds(network)}`);
+                return `<span class="timings">⏱ ${parts.join(' · ')}</span>`;
+            }
+            
+            // Похожий промпт уже генерировался: показываем готовые результаты вместо нового запроса
+            function showReuseCandidates(candidates) {
+                statusDiv.innerHTML = '<div class="status">♻️ Похожие изображения уже есть</div>';
+                const box = statusDiv.firstChild;
+                candidates.forEach(candidate => {
+                    const row = document.createElement('div');
+                    row.className = 'reuse-candidate';
+                    const label = document.createElement('span');
+                    label.textContent = `${Math.round(candidate.similarity * 100)}% · ${candidate.prompt}`;
+                    const use = document.createElement('button');
+                    use.type = 'button';
+                    use.textContent = 'Использовать';
+                    use.addEventListener('click', () => {
+                        imagesDiv.innerHTML = '';
+                        Object.keys(cards).forEach(key => delete cards[key]);
+                        candidate.images.forEach((image, index) => handleEvent('image', Object.assign({ index }, image)));
+                        statusDiv.innerHTML = '<div class="status success">♻️ Использован готовый результат</div>';
+                    });
+                    row.append(label, use);
+                    box.appendChild(row);
+                });
+                const actions = document.createElement('div');
+                actions.className = 'reuse-candidate';
+                const generate = document.createElement('button');
+                generate.type = 'button';
+                generate.textContent = 'Все равно сгенерировать';
+                generate.addEventListener('click', () => {
+                    skipReuseCheck = true;
+                    form.requestSubmit();
+                });
+                actions.appendChild(generate);
+                box.appendChild(actions);
+            }
             
             try {
-                const response = await fetch('/api/generate', {
+                const response = await fetch('/api/generate?stream=1', {
                     method: 'POST',
                     headers: { 'Content-Type': 'application/json' },
                     body: JSON.stringify(data)
                 });
                 
-                const result = await response.json();
+                // Ошибки до начала генерации приходят обычным JSON
+                if (!(response.headers.get('Content-Type') || '').startsWith('text/event-stream')) {
+                    const result = await response.json();
+                    if (result.success && result.reuse_candidates) {
+                        showReuseCandidates(result.reuse_candidates);
+                        return;
+                    }
+                    statusDiv.innerHTML = `<div class="status error">❌ ${result.error}</div>`;
+                    return;
+                }
                 
-                if (result.success) {
-                    statusDiv.innerHTML = '<div class="status success">✨ Изображения успешно созданы!</div>';
+                const reader = response.body.getReader();
+                const decoder = new TextDecoder();
+                let buffer = '';
+                while (true) {
+                    const { value, done } = await reader.read();
+                    if (done) break;
+                    buffer += decoder.decode(value, { stream: true });
                     
-                    result.images.forEach((imageData, index) => {
-                        const card = document.createElement('div');
-                        card.className = 'image-card';
-                        
-                        card.innerHTML = `
-                            <img src="data:image/png;base64,${imageData}" alt="Generated Image ${index + 1}">
-                            <div class="image-overlay">
-                                <a href="data:image/png;base64,${imageData}" download="ai_image_${index + 1}.png" class="download-btn">
-                                    📥 Скачать
-                                </a>
-                            </div>
-                        `;
-                        
-                        imagesDiv.appendChild(card);
-                    });
+                    let separator;
+                    while ((separator = buffer.indexOf('\\n\\n')) !== -1) {
+                        const message = buffer.slice(0, separator);
+                        buffer = buffer.slice(separator + 2);
+                        let event = 'message';
+                        const dataLines = [];
+                        message.split('\\n').forEach(line => {
+                            if (line.startsWith('event: ')) event = line.slice(7);
+                            else if (line.startsWith('data: ')) dataLines.push(line.slice(6));
+                        });
+                        if (dataLines.length) handleEvent(event, JSON.parse(dataLines.join('\\n')));
+                    }
+                }
+                
+                if (errorText) {
+                    statusDiv.innerHTML = `<div class="status error">❌ ${errorText}${formatTimings()}</div>`;
                 } else {
-                    statusDiv.innerHTML = `<div class="status error">❌ ${result.error}</div>`;
+                    statusDiv.innerHTML = `<div class="status success">✨ Изображения успешно созданы!${formatTimings()}</div>`;
+                    // История пишется в фоне, обновляем галерею с небольшой задержкой
+                    setTimeout(resetHistory, 1000);
                 }
             } catch (error) {
                 statusDiv.innerHTML = `<div class="status error">❌ Ошибка сети: ${error.message}</div>`;
@@ -688,99 +3938,1841 @@ textarea {
     </script>
 </body>
 </html>'''
+    return html
+
+
+class RenderedPage:
+    """Страница, закодированная один раз, вместе со сжатыми вариантами"""
+
+    def __init__(self, html):
+        body = html.encode('utf-8')
+        digest = hashlib.sha256(body).hexdigest()[:16]
+        self.encodings = {'identity': body, 'gzip': gzip.compress(body, 9)}
+        if brotli is not None:
+            self.encodings['br'] = brotli.compress(body, quality=11)
+        # У каждого сжатого представления свой ETag
+        self.etags = {encoding: f'"{digest}-{encoding}"' for encoding in self.encodings}
+
+    def negotiate(self, accept_encoding):
+        """Выбирает лучшее сжатие из Accept-Encoding"""
+        accepted = {}
+        for item in (accept_encoding or '').split(','):
+            parts = item.strip().split(';')
+            name = parts[0].strip().lower()
+            q = 1.0
+            for param in parts[1:]:
+                if param.strip().startswith('q='):
+                    try:
+                        q = float(param.strip()[2:])
+                    except ValueError:
+                        q = 0.0
+            if name:
+                accepted[name] = q
+
+        for encoding in ('br', 'gzip'):
+            if encoding in self.encodings and accepted.get(encoding, accepted.get('*', 0)) > 0:
+                return encoding
+        return 'identity'
+
+
+_rendered_pages = {}
+_rendered_pages_lock = threading.Lock()
+
+
+def get_rendered_page(name, api_ok=False):
+    """Возвращает страницу из кеша, рендеря каждый вариант один раз"""
+    key = (name, api_ok) if name == 'main' else (name,)
+    page = _rendered_pages.get(key)
+    if page is None:
+        with _rendered_pages_lock:
+            page = _rendered_pages.get(key)
+            if page is None:
+                html = render_main_page(api_ok) if name == 'main' else render_login_page()
+                page = _rendered_pages[key] = RenderedPage(html)
+    return page
+
+
+# Размер порции исходных байт для base64 в ответе; кратен 3, чтобы порции склеивались без паддинга
+INLINE_CHUNK_BYTES = 48 * 1024
+
+
+class InlineBase64:
+    """Байты, которые respond_json выводит base64-строкой, кодируя по частям прямо в сокет"""
+
+    __slots__ = ('content',)
+
+    def __init__(self, content):
+        self.content = content
+
+    def encoded_length(self):
+        return 4 * ((len(self.content) + 2) // 3)
+
+    def chunks(self):
+        view = memoryview(self.content)
+        for offset in range(0, len(view), INLINE_CHUNK_BYTES):
+            yield base64.b64encode(view[offset:offset + INLINE_CHUNK_BYTES])
+
+    def write_to(self, wfile):
+        for chunk in self.chunks():
+            wfile.write(chunk)
+
+
+def encode_json_parts(data):
+    """JSON ответа как список фрагментов: bytes конверта и InlineBase64 на месте больших строк"""
+    payloads = []
+    token = secrets.token_hex(8)
+
+    def placeholder(value):
+        if isinstance(value, InlineBase64):
+            payloads.append(value)
+            return f'{token}:{len(payloads) - 1}'
+        raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+    text = json.dumps(data, default=placeholder)
+    if not payloads:
+        return [text.encode('utf-8')]
+    parts = []
+    # Метка стоит внутри кавычек, поэтому кавычки остаются в конверте
+    for i, piece in enumerate(re.split(f'{token}:(\\d+)', text)):
+        parts.append(payloads[int(piece)] if i % 2 else piece.encode('utf-8'))
+    return parts
+
+
+def auth_cookie_valid(headers):
+    """Проверяет cookie авторизации"""
+    cookies = headers.get('Cookie', '')
+    # Проверяем наличие валидного токена
+    return 'auth_token=valid' in cookies
+
+
+def _session_signature(session):
+    # Подпись привязана к SECRET_KEY: без входа валидную сессию не получить
+    key = ('session:' + os.environ.get('SECRET_KEY', '')).encode('utf-8')
+    return hmac.new(key, session.encode('ascii'), hashlib.sha256).hexdigest()[:32]
+
+
+def issue_session_id():
+    """Новая подписанная сессия для cookie session_id"""
+    session = secrets.token_hex(16)
+    return f'{session}.{_session_signature(session)}'
+
+
+def request_client_id(headers, client_address):
+    """Идентификатор клиента для лимитов: подписанная cookie сессии или IP адрес"""
+    match = re.search(r'(?:^|;)\s*session_id=([0-9a-f]{32})\.([0-9a-f]{32})', headers.get('Cookie', ''))
+    if match and os.environ.get('SECRET_KEY') and hmac.compare_digest(
+            match.group(2), _session_signature(match.group(1))):
+        return 'session:' + match.group(1)
+    # X-Forwarded-For подделывается клиентом, верим только записям своих прокси:
+    # каждый дописывает адрес, с которого к нему пришли, справа
+    forwarded = [part.strip() for part in headers.get('X-Forwarded-For', '').split(',') if part.strip()]
+    if TRUSTED_PROXY_HOPS > 0 and forwarded:
+        return 'ip:' + forwarded[-min(TRUSTED_PROXY_HOPS, len(forwarded))]
+    return 'ip:' + client_address[0]
+
+
+def login_cookies(data):
+    """Cookie для успешного входа или None, если секретный ключ не подошел"""
+    expected_secret = os.environ.get('SECRET_KEY', '')
+    if data.get('secret_key') != expected_secret or not expected_secret:
+        return None
+    return [
+        'auth_token=valid; Path=/; HttpOnly',
+        # Отдельная сессия нужна для персональных лимитов
+        f'session_id={issue_session_id()}; Path=/; HttpOnly; SameSite=Lax',
+    ]
+
+
+def prepare_generation(data):
+    """Параметры OpenAI, настройки перекодирования и флаг кеша из JSON запроса /api/generate"""
+    params = build_generation_params(data)
+    return params, build_output_options(data, params), not data.get('no_cache')
+
+
+class handler(BaseHTTPRequestHandler):
+    # Шаблоны маршрутов для меток метрик: ID не должны раздувать число серий
+    METRIC_ROUTES = {
+        '/', '/index.html', '/app', '/metrics', '/api/stats', '/api/usage', '/api/history', '/api/login', '/api/generate',
+        '/api/generate/batch', '/api/generate/similar', '/api/edit', '/api/variation', '/api/jobs',
+    }
+
+    def handle_one_request(self):
+        """Обрабатывает один запрос и учитывает его в метриках"""
+        self.stage_timer = StageTimer()
+        self.response_status = None
+        with self.stage_timer.activate():
+            super().handle_one_request()
+        if self.response_status is None:
+            # Соединение закрыто или истек keep-alive, запроса не было
+            return
+        method = self.command or 'UNKNOWN'
+        route = self.metrics_route()
+        self.stage_timer.name = f'{method} {route}'
+        self.stage_timer.status = self.response_status
+        self.stage_timer.flush()
+        request_count.inc((method, route, str(self.response_status)))
+        request_duration.observe(time.perf_counter() - self.request_started, (method, route))
+
+    def parse_request(self):
+        # Время запроса считаем от строки запроса, а не от ожидания на keep-alive
+        self.request_started = time.perf_counter()
+        return super().parse_request()
+
+    def send_response(self, code, message=None):
+        self.response_status = code
+        super().send_response(code, message)
+
+    def metrics_route(self):
+        return self.route_label(urlparse(getattr(self, 'path', '') or '').path)
+
+    @classmethod
+    def route_label(cls, path):
+        """Шаблон маршрута для меток метрик"""
+        if path in cls.METRIC_ROUTES:
+            return path
+        if path.startswith('/api/images/'):
+            return '/api/images/{id}'
+        if path.startswith('/api/jobs/'):
+            return '/api/jobs/{id}'
+        return 'other'
+
+    def do_OPTIONS(self):
+        # CORS preflight
+        self.send_response(204)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        # Обрабатываем GET запросы
+        parsed_path = urlparse(self.path)
+
+        if parsed_path.path == '/' or parsed_path.path == '/index.html':
+            self.serve_login_page()
+        elif parsed_path.path == '/app':
+            # Проверяем авторизацию для /app
+            if not self.is_authenticated():
+                # Перенаправляем на главную страницу
+                self.send_response(302)
+                self.send_header('Location', '/')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.serve_main_page()
+        elif parsed_path.path.startswith('/api/images/'):
+            self.serve_image(parsed_path.path[len('/api/images/'):])
+        elif parsed_path.path.startswith('/api/jobs/'):
+            self.handle_job_status(parsed_path.path[len('/api/jobs/'):])
+        elif parsed_path.path == '/api/stats':
+            self.handle_stats()
+        elif parsed_path.path == '/metrics':
+            self.handle_metrics()
+        elif parsed_path.path == '/api/usage':
+            self.handle_usage(parse_qs(parsed_path.query))
+        elif parsed_path.path == '/api/history':
+            self.handle_history(parse_qs(parsed_path.query))
+        else:
+            self.send_error(404)
+
+    def is_authenticated(self):
+        """Проверяет cookie авторизации"""
+        return auth_cookie_valid(self.headers)
+
+    def client_id(self):
+        """Идентификатор клиента для лимитов: подписанная cookie сессии или IP адрес"""
+        return request_client_id(self.headers, self.client_address)
+
+    def check_rate_limit(self, cost=1):
+        """Списывает cost из token bucket клиента или бросает RateLimitExceeded"""
+        client_rate_limiter.acquire(self.client_id(), cost)
+
+    def respond_error(self, error):
+        """Отправляет ошибку запроса, для 429 и 503 добавляет Retry-After"""
+        record_error(error)
+        headers = None
+        if getattr(error, 'retry_after', None):
+            headers = {'Retry-After': str(error.retry_after)}
+        self.respond_json({'success': False, 'error': str(error)}, getattr(error, 'status', 500), headers)
+
+    # Тело POST еще не прочитано: ответ до read_body() должен закрыть соединение,
+    # иначе на keep-alive остаток тела разберется как следующий запрос
+    body_pending = False
+
+    def read_body(self):
+        """Читает тело запроса по Content-Length"""
+        with measure_stage('read_body') as span:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            span.bytes = len(body)
+        self.body_pending = False
+        return body
+
+    
+    def do_POST(self):
+        # Обрабатываем POST запросы
+        parsed_path = urlparse(self.path)
+        self.body_pending = self.headers.get('Content-Length', '0').strip() not in ('', '0')
         
-        self.respond_html(html)
+        if parsed_path.path == '/api/login':
+            self.handle_login()
+        elif parsed_path.path == '/api/generate':
+            self.handle_generate()
+        elif parsed_path.path == '/api/generate/batch':
+            self.handle_generate_batch()
+        elif parsed_path.path == '/api/generate/similar':
+            self.handle_generate_similar()
+        elif parsed_path.path == '/api/edit':
+            self.handle_image_operation('edit')
+        elif parsed_path.path == '/api/variation':
+            self.handle_image_operation('variation')
+        elif parsed_path.path == '/api/jobs':
+            self.handle_job_submit()
+        else:
+            self.send_error(404)
+    
+    def debug_trace_requested(self):
+        """Отладочный trace отдается только при TRACE_DEBUG и ?debug=1"""
+        return TRACE_DEBUG and parse_qs(urlparse(self.path).query).get('debug', ['0'])[0] in ('1', 'true')
+
+    def respond_json(self, data, status_code=200, headers=None):
+        """Отправляет JSON ответ с правильными заголовками"""
+        if isinstance(data, dict) and self.debug_trace_requested():
+            data = dict(data, trace=self.stage_timer.trace())
+        # Изображения в base64 не собираются в одну строку: конверт и картинки пишутся по частям
+        with measure_stage('json_dumps') as span:
+            parts = encode_json_parts(data)
+            length = sum(len(part) if isinstance(part, bytes) else part.encoded_length() for part in parts)
+            span.bytes = length
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        if self.body_pending:
+            self.send_header('Connection', 'close')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_server_timing()
+        self.send_header('Content-Length', str(length))
+        self.end_headers()
+        with measure_stage('write') as span:
+            for part in parts:
+                if isinstance(part, bytes):
+                    self.wfile.write(part)
+                else:
+                    part.write_to(self.wfile)
+            span.bytes = length
+    
+    def respond_html(self, page):
+        """Отправляет HTML ответ с учетом сжатия и If-None-Match"""
+        if isinstance(page, str):
+            page = RenderedPage(page)
+        encoding = page.negotiate(self.headers.get('Accept-Encoding'))
+        etag = page.etags[encoding]
+
+        if_none_match = [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]
+        if etag in if_none_match or f'W/{etag}' in if_none_match:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'private, no-cache')
+            self.send_header('Vary', 'Accept-Encoding')
+            self.end_headers()
+            return
+
+        body = page.encodings[encoding]
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_server_timing()
+        self.send_header('Content-Length', str(len(body)))
+        if encoding != 'identity':
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('ETag', etag)
+        # Страница может меняться при деплое, поэтому всегда ревалидируем
+        self.send_header('Cache-Control', 'private, no-cache')
+        self.send_header('Vary', 'Accept-Encoding')
+        self.end_headers()
+        with measure_stage('write') as span:
+            self.wfile.write(body)
+            span.bytes = len(body)
+    
+    def send_server_timing(self):
+        """Заголовок Server-Timing с этапами, завершенными к моменту ответа"""
+        self.send_header('Server-Timing', self.stage_timer.server_timing())
+        self.send_header('Timing-Allow-Origin', '*')
+
+    def serve_login_page(self):
+        self.respond_html(get_rendered_page('login'))
+    
+    def handle_login(self):
+        try:
+            # Читаем данные запроса
+            post_data = self.read_body()
+            data = parse_json_object(post_data)
+            
+            cookies = login_cookies(data)
+            if cookies:
+                # ПРИ УСПЕШНОЙ АВТОРИЗАЦИИ УСТАНАВЛИВАЕМ COOKIE
+                response_data = {'success': True}
+                body = json.dumps(response_data).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('Access-Control-Allow-Origin', '*')
+                # Устанавливаем cookie для авторизации и сессии
+                for cookie in cookies:
+                    self.send_header('Set-Cookie', cookie)
+                self.end_headers()
+                self.wfile.write(body)
+            else:
+                self.respond_json({'success': False})
+            
+        except Exception as e:
+            self.respond_error(e)
+
+    def serve_image(self, image_id):
+        """Отдает изображение из хранилища с поддержкой ETag и Range"""
+        f = image_store.open(image_id)
+        if f is None:
+            self.send_error(404)
+            return
+
+        with f:
+            etag = f'"{image_id}"'
+            cache_control = 'public, max-age=31536000, immutable'
+
+            if etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Cache-Control', cache_control)
+                self.end_headers()
+                return
+
+            size = os.fstat(f.fileno()).st_size
+            content_type = sniff_image_type(f.read(16))
+            f.seek(0)
+
+            start, end = 0, size - 1
+            status = 200
+            range_header = self.headers.get('Range')
+            if range_header:
+                match = re.match(r'^bytes=(\d*)-(\d*)$', range_header.strip())
+                if match and (match.group(1) or match.group(2)):
+                    if match.group(1):
+                        start = int(match.group(1))
+                        if match.group(2):
+                            end = min(int(match.group(2)), size - 1)
+                    else:
+                        # Суффиксный диапазон: последние N байт
+                        start = max(size - int(match.group(2)), 0)
+                    status = 206
+                if status != 206 or start > end:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{size}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', cache_control)
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            if status == 206:
+                self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+            self.end_headers()
+
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(IMAGE_DOWNLOAD_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+    def handle_stats(self):
+        """Отдает внутренние счетчики процесса"""
+        if not self.is_authenticated():
+            self.respond_json({'success': False, 'error': 'Требуется авторизация'}, 401)
+            return
+        self.respond_json({
+            'success': True,
+            'client_pool': openai_clients.stats(),
+            'result_cache': dict(result_cache.stats(), coalesced=generation_flight.shared + stream_flight.shared),
+            'jobs': generation_jobs.stats(),
+            'rate_limit': client_rate_limiter.stats(),
+            'admission': upstream_admission.stats(),
+            'usage_ledger': usage_ledger.stats(),
+            'history': generation_history.stats(),
+            'prompt_index': prompt_index.stats(),
+            'resilience': {
+                'openai': dict(upstream_retry.stats(), breaker=openai_breaker.stats()),
+                'download': dict(download_retry.stats(), breaker=download_breaker.stats()),
+            },
+        })
+
+
+    def handle_usage(self, query):
+        """Расходы и число генераций по часам или дням из готовых агрегатов"""
+        if not self.is_authenticated():
+            self.respond_json({'success': False, 'error': 'Требуется авторизация'}, 401)
+            return
+        try:
+            def timestamp(name):
+                value = query.get(name, [None])[0]
+                return float(value) if value else None
+
+            group_by = [column for column in query.get('group_by', [''])[0].split(',') if column]
+            summary = usage_ledger.summary(
+                period=query.get('period', ['day'])[0],
+                since=timestamp('since'),
+                until=timestamp('until'),
+                group_by=group_by,
+                # mine=1 ограничивает сводку текущей сессией
+                client=self.client_id() if query.get('mine', ['0'])[0] in ('1', 'true') else None,
+            )
+            self.respond_json(dict({'success': True}, **summary))
+        except ValueError:
+            self.respond_json({'success': False, 'error': 'since и until должны быть unix-временем'}, 400)
+        except (GenerationError, sqlite3.Error) as e:
+            self.respond_error(e)
+
+    def handle_history(self, query):
+        """Страница истории генераций с фильтрами и поиском по промптам"""
+        if not self.is_authenticated():
+            self.respond_json({'success': False, 'error': 'Требуется авторизация'}, 401)
+            return
+        try:
+            def param(name):
+                return query.get(name, [None])[0] or None
+
+            page = generation_history.page(
+                cursor=param('cursor'),
+                limit=param('limit') or HISTORY_PAGE_SIZE,
+                model=param('model'),
+                size=param('size'),
+                since=float(param('since')) if param('since') else None,
+                until=float(param('until')) if param('until') else None,
+                search=param('q'),
+                client=self.client_id() if param('mine') in ('1', 'true') else None,
+            )
+            self.respond_json(dict({'success': True}, **page))
+        except ValueError:
+            self.respond_json({'success': False, 'error': 'limit, since и until должны быть числами'}, 400)
+        except (GenerationError, sqlite3.Error) as e:
+            self.respond_error(e)
+
+    def handle_metrics(self):
+        """Отдает метрики в текстовом формате Prometheus"""
+        if METRICS_TOKEN and not secrets.compare_digest(
+                self.headers.get('Authorization', ''), f'Bearer {METRICS_TOKEN}'):
+            self.respond_json({'success': False, 'error': 'Требуется авторизация'}, 401)
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def serve_main_page(self):
+        # Проверяем наличие OpenAI API ключа
+        api_ok = bool(os.environ.get('OPENAI_API_KEY', ''))
+        self.respond_html(get_rendered_page('main', api_ok))
     
     def handle_generate(self):
         try:
-            # Получаем API ключ из окружения
+            # Получаем API ключ из окружения
+            api_key = os.environ.get('OPENAI_API_KEY')
+            if not api_key:
+                self.respond_json({'success': False, 'error': 'OpenAI API ключ не настроен на сервере'}, 500)
+                return
+            
+            # Берем OpenAI клиент из процессного пула
+            with measure_stage('client_setup'):
+                client = openai_clients.get(api_key)
+            
+            # Читаем данные запроса
+            post_data = self.read_body()
+            data = parse_json_object(post_data)
+            
+            params, output, use_cache = prepare_generation(data)
+            self.stage_timer.set_params(params)
+
+            # Похожий промпт уже генерировался: предлагаем готовый результат до обращения к OpenAI.
+            # Кандидаты - это чужая история, поэтому только после входа, как и /api/history
+            if data.get('reuse_check') and self.is_authenticated():
+                candidates = find_reuse_candidates(params, data)
+                if candidates:
+                    self.respond_json({'success': True, 'reuse_candidates': candidates})
+                    return
+
+            self.check_rate_limit(params['n'])
+
+            # Потоковый режим: превью и готовые изображения уходят по мере появления
+            query = parse_qs(urlparse(self.path).query)
+            if query.get('stream', ['0'])[0] in ('1', 'true'):
+                self.stream_generation(client, params, use_cache, output)
+                return
+            
+            # Синхронный путь: тот же движок заданий, но без очереди
+            job, contents = generation_jobs.run_sync(client, params, use_cache, output, self.client_id())
+            if job.status != 'succeeded':
+                headers = {'Retry-After': str(job.retry_after)} if job.retry_after else None
+                self.respond_json({'success': False, 'error': job.error}, job.error_status, headers)
+                return
+
+            # По умолчанию отдаем ссылки на хранилище, base64 только по запросу и кодируется при записи
+            if data.get('inline'):
+                images = [InlineBase64(content) for content in contents]
+            else:
+                images = job.images
+            
+            # Возвращаем результат
+            self.respond_json({'success': True, 'images': images, 'cached': job.cached})
+
+        except GenerationError as e:
+            self.respond_error(e)
+        except Exception as e:
+            self.respond_error(e)
+
+    def handle_generate_similar(self):
+        """Готовые результаты для похожих промптов с теми же параметрами, без обращения к OpenAI"""
+        if not self.is_authenticated():
+            self.respond_json({'success': False, 'error': 'Требуется авторизация'}, 401)
+            return
+        try:
+            data = parse_json_object(self.read_body())
+            params = build_generation_params(data)
+            self.respond_json({'success': True, 'candidates': find_reuse_candidates(params, data)})
+        except GenerationError as e:
+            self.respond_error(e)
+        except Exception as e:
+            self.respond_error(e)
+
+    def handle_generate_batch(self):
+        """Генерирует изображения для списка промптов с ограниченным параллелизмом"""
+        try:
             api_key = os.environ.get('OPENAI_API_KEY')
             if not api_key:
                 self.respond_json({'success': False, 'error': 'OpenAI API ключ не настроен на сервере'}, 500)
                 return
-            
-            # Инициализируем OpenAI клиент
-            client = OpenAI(api_key=api_key)
-            
-            # Читаем данные запроса
+
+            post_data = self.read_body()
+            data = parse_json_object(post_data)
+
+            items = data.get('items')
+            if not isinstance(items, list) or not items:
+                self.respond_json({'success': False, 'error': 'Список items обязателен'}, 400)
+                return
+            if len(items) > BATCH_MAX_ITEMS:
+                self.respond_json({'success': False, 'error': f'Не больше {BATCH_MAX_ITEMS} элементов за запрос'}, 400)
+                return
+
+            if not isinstance(data.get('defaults') or {}, dict):
+                self.respond_json({'success': False, 'error': 'defaults должен быть объектом'}, 400)
+                return
+            try:
+                concurrency = int(data.get('concurrency') or BATCH_CONCURRENCY)
+            except (TypeError, ValueError):
+                self.respond_json({'success': False, 'error': 'concurrency должен быть числом'}, 400)
+                return
+            concurrency = max(1, min(concurrency, BATCH_CONCURRENCY))
+
+            run = run_generation_batch(
+                openai_clients.get(api_key),
+                items,
+                data.get('defaults') or {},
+                concurrency,
+                not data.get('no_cache'),
+                self.client_id(),
+            )
+
+            query = parse_qs(urlparse(self.path).query)
+            if query.get('stream', ['0'])[0] in ('1', 'true'):
+                # Результаты уходят по мере готовности, индекс сохраняет привязку к запросу
+                self.start_event_stream()
+                try:
+                    failed = 0
+                    for result in run:
+                        failed += 0 if result['success'] else 1
+                        self.send_event('result', result)
+                    self.send_event('done', self.with_timings({'success': failed == 0, 'count': len(items), 'failed': failed}))
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                except Exception as e:
+                    self.fail_event_stream(e)
+                return
+
+            results = sorted(run, key=lambda result: result['index'])
+            self.respond_json({'success': True, 'results': results})
+
+        except GenerationError as e:
+            self.respond_error(e)
+        except Exception as e:
+            self.respond_error(e)
+
+    def handle_image_operation(self, operation):
+        """Редактирование или вариация загруженного изображения"""
+        form = None
+        attempted = False
+        results = []
+        try:
+            api_key = os.environ.get('OPENAI_API_KEY')
+            if not api_key:
+                self.close_connection = True
+                self.respond_json({'success': False, 'error': 'OpenAI API ключ не настроен на сервере'}, 500)
+                return
+
+            if 'Content-Length' not in self.headers:
+                self.close_connection = True
+                self.respond_json({'success': False, 'error': 'Требуется заголовок Content-Length'}, 411)
+                return
             content_length = int(self.headers.get('Content-Length', 0))
-            post_data = self.rfile.read(content_length)
-            data = json.loads(post_data.decode('utf-8'))
-            
-            # Получаем параметры
-            model = data.get('model')
-            size = data.get('size')
-            quality = data.get('quality')
-            style = data.get('style')
-            background = data.get('background')
-            moderation = data.get('moderation')
-            n = int(data.get('n', 1))
-            prompt = data.get('prompt')
-            
-            if not prompt:
-                self.respond_json({'success': False, 'error': 'Описание изображения обязательно'}, 400)
+            with measure_stage('read_body') as span:
+                form = parse_multipart(self.rfile, self.headers.get('Content-Type'), content_length)
+                span.bytes = content_length
+            self.body_pending = False
+
+            params = build_generation_params(form.fields, operation)
+            self.stage_timer.set_params(params)
+            images = form.files.get('image') or form.files.get('image[]')
+            if not images:
+                self.respond_json({'success': False, 'error': 'Загрузите исходное изображение'}, 400)
                 return
-            
-            # Собираем параметры для OpenAI API
-            params = {
-                "model": model,
-                "prompt": prompt,
-                "n": n,
-                "size": size
-            }
-            
-            # Параметры для GPT Image 1 (согласно документации)
-            if model == "gpt-image-1":
-                # Quality: low, medium, high, auto
-                if quality and quality in ["low", "medium", "high", "auto"]:
-                    params["quality"] = quality
-                # Background: transparent, opaque, auto
-                if background and background in ["transparent", "opaque", "auto"]:
-                    params["background"] = background
-                # Moderation: auto (standard), low (less restrictive)
-                if moderation and moderation in ["low", "auto"]:
-                    params["moderation"] = moderation
-                    
-            elif model == "dall-e-3":
-                if quality and quality in ["standard", "hd"]:
-                    params["quality"] = quality
-                else:
-                    params["quality"] = "standard"
-                if style and style in ["vivid", "natural"]:
-                    params["style"] = style
+            if operation == 'variation' and len(images) > 1:
+                self.respond_json({'success': False, 'error': 'Для вариации нужно одно изображение'}, 400)
+                return
+            mask = (form.files.get('mask') or [None])[0]
+
+            output = build_output_options(form.fields, params)
+            self.check_rate_limit(params['n'])
+            attempted = True
+            contents = run_image_operation(openai_clients.get(api_key), operation, params, images, mask)
+            with measure_stage('transcode'):
+                contents = apply_output_format(contents, output)
+            with measure_stage('store'):
+                results = store_image_contents(contents)
+            self.respond_json({'success': True, 'images': results})
+
+        except GenerationError as e:
+            # Тело могло остаться недочитанным, соединение дальше использовать нельзя
+            self.close_connection = True
+            self.respond_error(e)
+        except Exception as e:
+            self.close_connection = True
+            self.respond_error(e)
+        finally:
+            if form is not None:
+                form.close()
+            if attempted:
+                record_generation(
+                    self.client_id(), operation, params, results, False, not results,
+                    time.perf_counter() - self.stage_timer.started,
+                )
+
+    def handle_job_submit(self):
+        """Ставит генерацию в очередь и сразу возвращает ID задания"""
+        try:
+            api_key = os.environ.get('OPENAI_API_KEY')
+            if not api_key:
+                self.respond_json({'success': False, 'error': 'OpenAI API ключ не настроен на сервере'}, 500)
+                return
+
+            post_data = self.read_body()
+            data = parse_json_object(post_data)
+
+            params = build_generation_params(data)
+            self.stage_timer.set_params(params)
+            self.check_rate_limit(params['n'])
+            job = generation_jobs.submit(
+                openai_clients.get(api_key),
+                params,
+                not data.get('no_cache'),
+                build_output_options(data, params),
+                self.client_id(),
+            )
+            self.respond_json({
+                'success': True,
+                'job': job.to_dict(),
+                'status_url': f'/api/jobs/{job.id}',
+            }, 202)
+
+        except GenerationError as e:
+            self.respond_error(e)
+        except Exception as e:
+            self.respond_error(e)
+
+    def handle_job_status(self, job_id):
+        """Отдает статус, тайминги и результат задания"""
+        job = generation_jobs.get(job_id, self.client_id())
+        if job is None:
+            self.respond_json({'success': False, 'error': 'Задание не найдено или устарело'}, 404)
+            return
+        self.respond_json({'success': True, 'job': job.to_dict()})
+
+    def start_event_stream(self):
+        """Отправляет заголовки потока Server-Sent Events"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('X-Accel-Buffering', 'no')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        # В заголовок попадает только подготовка, полная разбивка придет в событии done
+        self.send_server_timing()
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        # Конец потока обозначается закрытием соединения
+        self.close_connection = True
+
+    def send_event(self, event, data):
+        """Отправляет одно Server-Sent Event сообщение"""
+        with measure_stage('json_dumps'):
+            payload = f'event: {event}\ndata: {json.dumps(data)}\n\n'.encode('utf-8')
+        with measure_stage('write') as span:
+            self.wfile.write(payload)
+            self.wfile.flush()
+            span.bytes = len(payload)
+
+    def fail_event_stream(self, error):
+        """Ошибка после заголовков потока: второй ответ записать нельзя, поэтому событие error и закрытие"""
+        record_error(error)
+        self.close_connection = True
+        try:
+            self.send_event('error', {'index': None, 'error': str(error)})
+        except OSError:
+            pass
+
+    def with_timings(self, data):
+        """Добавляет к итоговому событию потока разбивку по этапам и trace в режиме отладки"""
+        data = dict(data, timings=self.stage_timer.timings())
+        if self.debug_trace_requested():
+            data['trace'] = self.stage_timer.trace()
+        return data
+
+    def record_stream_usage(self, params, images, cached, failed):
+        record_generation(
+            self.client_id(), 'generate', params, images, cached, failed,
+            time.perf_counter() - self.stage_timer.started,
+        )
+
+    def stream_generation(self, client, params, use_cache=True, output=None):
+        """Транслирует генерацию клиенту в формате Server-Sent Events"""
+        use_cache = use_cache and result_cache.enabled
+        cache_key = generation_cache_key(params) if use_cache else None
+        cached = result_cache.get(cache_key) if use_cache else None
+
+        # Одинаковые одновременные запросы потоковой модели читают события первого;
+        # остальные модели склеиваются в run_generation
+        streamed = MODEL_REGISTRY[params['model']].get('streaming') and cached is None
+        stream, leader = (None, False) if cached is not None else open_generation_stream(
+            params, cache_key if streamed else None)
+
+        # Первый слот потоковой модели нужен до отправки заголовков, чтобы перегрузка стала обычным 429.
+        # Слот занимает только лидер и передает его первому потоку генерации
+        admitted = streamed and leader
+        if admitted:
+            try:
+                upstream_admission.acquire()
+            except Exception as e:
+                stream.fail(e)
+                raise
+
+        started = False
+        try:
+            self.start_event_stream()
+            if cached is not None:
+                # Готовый результат из кеша отдаем сразу
+                images = store_image_contents(apply_output_format(cached, output))
+                for index, image in enumerate(images):
+                    self.send_event('image', dict(image, index=index))
+                self.record_stream_usage(params, images, True, False)
+                self.send_event('done', self.with_timings({'success': True, 'count': len(cached), 'cached': True}))
+                return
+
+            if leader:
+                start_generation_stream(client, params, stream, output, use_cache, admitted)
+                started = True
+            images = {}
+            failed = False
+            for event, data in stream.subscribe():
+                if event == 'finished':
+                    continue
+                if event == 'image':
+                    images[data['index']] = data
+                elif event == 'error':
+                    failed = True
+                self.send_event(event, data)
+
+            # Присоединившийся к чужой генерации за нее не платит
+            self.record_stream_usage(params, [images[index] for index in sorted(images)], not leader, failed)
+            self.send_event('done', self.with_timings({'success': not failed, 'count': len(images), 'cached': not leader}))
+        except (BrokenPipeError, ConnectionResetError):
+            # Клиент ушел, фоновые генерации доработают сами
+            pass
+        except Exception as e:
+            self.fail_event_stream(e)
+        finally:
+            if leader and not started:
+                # Лидер не дошел до запуска: присоединившиеся не должны ждать вечно
+                stream.fail('Генерация прервана')
+                if admitted:
+                    upstream_admission.release()
+
+
+# ASGI приложение (uvicorn api.index:asgi_app или python -m api.index --asgi): страница, вход и генерация
+# на asyncio. Ожидание OpenAI и загрузок не занимает поток, поэтому один процесс держит сотни генераций
+ASGI_MAX_INFLIGHT = _env_int('ASGI_MAX_INFLIGHT', 256)
+ASGI_MAX_WAITING = _env_int('ASGI_MAX_WAITING', 512)
+ASGI_DOWNLOAD_MAX_CONNECTIONS = _env_int('ASGI_DOWNLOAD_MAX_CONNECTIONS', 64)
+ASGI_MAX_BODY_BYTES = _env_int('ASGI_MAX_BODY_BYTES', 1024 * 1024)
+CORS_HEADERS = [
+    ('Access-Control-Allow-Origin', '*'),
+    ('Access-Control-Allow-Methods', 'GET, POST, OPTIONS'),
+    ('Access-Control-Allow-Headers', 'Content-Type'),
+]
+
+
+class AsyncAdmissionController(AdmissionController):
+    """Лимит одновременных генераций ASGI приложения; ожидание слота не блокирует цикл событий"""
+
+    def __init__(self, max_inflight=ASGI_MAX_INFLIGHT, max_waiting=ASGI_MAX_WAITING, **kwargs):
+        super().__init__(max_inflight, max_waiting, **kwargs)
+        self._slots = None
+
+    async def acquire(self):
+        import asyncio
+
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_inflight)
+        if self._slots.locked():
+            if self.waiting >= self.max_waiting:
+                self._reject()
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._slots.acquire(), self.wait_timeout)
+            except asyncio.TimeoutError:
+                self._reject()
+            finally:
+                self.waiting -= 1
+        else:
+            await self._slots.acquire()
+        self.inflight += 1
+        self.admitted += 1
+
+    def release(self):
+        self.inflight -= 1
+        self._slots.release()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class AsyncSingleFlight:
+    """SingleFlight для корутин: одинаковые одновременные генерации ждут один future"""
+
+    def __init__(self):
+        self._calls = {}
+        self.shared = 0
+
+    async def do(self, key, fn):
+        import asyncio
+
+        future = self._calls.get(key)
+        if future is not None:
+            self.shared += 1
+            # shield: отмена ожидающего не отменяет результат для остальных
+            return await asyncio.shield(future)
+
+        future = self._calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Ожидающих может не быть, исключение считаем полученным
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._calls[key]
+
+
+class AsyncEventBroadcast(EventBroadcast):
+    """EventBroadcast для корутин одного цикла событий; on_complete здесь корутина"""
+
+    def __init__(self, workers, on_complete=None):
+        super().__init__(workers, on_complete)
+        self._changed = None
+        self._completion = None
+
+    def put(self, item):
+        import asyncio
+
+        self._events.append(item)
+        if item[0] == 'finished':
+            self._workers -= 1
+        if self._workers <= 0 and self._completion is None:
+            self._completion = asyncio.get_running_loop().create_task(self._complete())
+        self._wake()
+
+    put_nowait = put
+
+    async def _complete(self):
+        try:
+            if self._on_complete is not None:
+                await self._on_complete(self.events())
+        except Exception:
+            pass
+        finally:
+            self.closed = True
+            self._wake()
+
+    def _wake(self):
+        if self._changed is not None:
+            self._changed.set()
+            self._changed = None
+
+    async def subscribe(self):
+        import asyncio
+
+        position = 0
+        while True:
+            if position < len(self._events):
+                position += 1
+                yield self._events[position - 1]
+                continue
+            if self.closed:
+                return
+            if self._changed is None:
+                self._changed = asyncio.Event()
+            await self._changed.wait()
+
+
+asgi_admission = AsyncAdmissionController()
+asgi_flight = AsyncSingleFlight()
+asgi_stream_flight = StreamFlight()
+metrics.register(Gauge(
+    'imagegen_async_generations_in_flight', 'Upstream generations currently running in the ASGI app.',
+    lambda: asgi_admission.stats()['inflight']))
+metrics.register(Gauge(
+    'imagegen_async_generations_waiting', 'ASGI generations waiting for an upstream slot.',
+    lambda: asgi_admission.stats()['waiting']))
+
+
+class AsyncUpstream:
+    """AsyncOpenAI клиенты и httpx.AsyncClient для загрузок; живут в цикле событий ASGI сервера"""
+
+    def __init__(self, pool=openai_clients, download_connections=ASGI_DOWNLOAD_MAX_CONNECTIONS):
+        # Настройки keep-alive и таймаутов общие с синхронным реестром
+        self.pool = pool
+        self.download_connections = download_connections
+        self._http_client = None
+        self._download_client = None
+        self._clients = {}
+
+    def openai(self, api_key, base_url=None):
+        """Асинхронный клиент OpenAI для пары (api_key, base_url)"""
+        key, base_url = self.pool.client_key(api_key, base_url)
+        client = self._clients.get(key)
+        if client is None:
+            import httpx
+            from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+            if self._http_client is None:
+                # Число соединений ограничивает asgi_admission, а не пул
+                self._http_client = DefaultAsyncHttpxClient(
+                    limits=httpx.Limits(
+                        max_connections=None,
+                        max_keepalive_connections=self.pool.max_keepalive,
+                        keepalive_expiry=self.pool.keepalive_expiry,
+                    ),
+                    timeout=httpx.Timeout(self.pool.timeout, connect=10.0),
+                )
+            # Повторы делает наш слой устойчивости, встроенные повторы SDK выключены
+            client = self._clients[key] = AsyncOpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                http_client=self._http_client,
+                max_retries=0,
+            )
+        return client
+
+    def downloads(self):
+        """Общий httpx.AsyncClient для скачивания изображений по ссылкам"""
+        if self._download_client is None:
+            import httpx
+
+            self._download_client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=self.download_connections,
+                    max_keepalive_connections=self.download_connections,
+                ),
+                follow_redirects=True,
+            )
+        return self._download_client
+
+    async def aclose(self):
+        for client in (self._http_client, self._download_client):
+            if client is not None:
+                await client.aclose()
+        self._http_client = None
+        self._download_client = None
+        self._clients = {}
+
+
+async def _generate_once_async(upstream, client, params, deadline):
+    import asyncio
+
+    async with asgi_admission:
+        with measure_stage('upstream'):
+            openai_response = await upstream_retry.call_async(
+                lambda timeout: client.images.generate(**params, timeout=timeout), openai_breaker, deadline)
+
+        if not hasattr(openai_response, 'data') or not openai_response.data:
+            raise GenerationError('Неверный ответ от OpenAI API')
+
+        # Декодирование base64 нагружает CPU, выносим его из цикла событий
+        contents, pending = await asyncio.to_thread(decode_image_items, openai_response.data)
+        if pending:
+            with measure_stage('download') as span:
+                try:
+                    downloaded = await download_images_async(
+                        upstream.downloads(), [url for _, url in pending], deadline)
+                except ImageDownloadError as e:
+                    raise GenerationError(str(e))
+                span.bytes = sum(len(content) for content in downloaded)
+            for (i, _), content in zip(pending, downloaded):
+                contents[i] = content
+        return contents
+
+
+async def generate_image_contents_async(upstream, client, params):
+    """Асинхронный generate_image_contents: большие n делятся на параллельные вызовы"""
+    import asyncio
+
+    deadline = time.monotonic() + UPSTREAM_DEADLINE
+    chunks = split_n(params)
+    if len(chunks) == 1:
+        return await _generate_once_async(upstream, client, params, deadline)
+    results = await asyncio.gather(
+        *(_generate_once_async(upstream, client, dict(params, n=n), deadline) for n in chunks))
+    return [content for chunk in results for content in chunk]
+
+
+async def run_generation_async(upstream, client, params, use_cache=True):
+    """Асинхронный run_generation: тот же кеш результатов, single-flight в пределах цикла событий"""
+    import asyncio
+
+    if not (use_cache and result_cache.enabled):
+        return await generate_image_contents_async(upstream, client, params), False
+
+    key = generation_cache_key(params)
+    # Кеш может читать диск
+    contents = await asyncio.to_thread(result_cache.get, key)
+    if contents is not None:
+        return contents, True
+
+    async def compute():
+        contents = await generate_image_contents_async(upstream, client, params)
+        await asyncio.to_thread(result_cache.put, key, contents)
+        return contents
+
+    return await asgi_flight.do(key, compute), False
+
+
+async def _stream_single_image_async(client, params, index, events, admitted=False):
+    # Асинхронный _stream_single_image
+    import asyncio
+
+    try:
+        if not admitted:
+            await asgi_admission.acquire()
+            admitted = True
+        started = time.perf_counter()
+        stream = await upstream_retry.call_async(
+            lambda timeout: client.images.generate(
+                **dict(params, n=1),
+                stream=True,
+                partial_images=GENERATE_PARTIAL_IMAGES,
+                timeout=timeout,
+            ),
+            openai_breaker,
+        )
+        async for event in stream:
+            if event.type == 'image_generation.partial_image':
+                events.put_nowait(('partial', partial_image_event(index, event)))
+            elif event.type == 'image_generation.completed':
+                record_stage('upstream', time.perf_counter() - started)
+                content = base64.b64decode(event.b64_json)
+                image = (await asyncio.to_thread(store_image_contents, [content]))[0]
+                events.put_nowait(('image', dict(image, index=index)))
+    except Exception as e:
+        events.put_nowait(('error', {'index': index, 'error': str(e)}))
+    finally:
+        if admitted:
+            asgi_admission.release()
+        events.put_nowait(('finished', {'index': index}))
+
+
+async def _generate_all_images_async(upstream, client, params, events, output=None, use_cache=True):
+    # Асинхронный _generate_all_images
+    import asyncio
+
+    try:
+        contents, _ = await run_generation_async(upstream, client, params, use_cache)
+        _, images = await asyncio.to_thread(store_generation_result, contents, output)
+        for index, image in enumerate(images):
+            events.put_nowait(('image', dict(image, index=index)))
+    except Exception as e:
+        events.put_nowait(('error', {'index': None, 'error': str(e)}))
+    finally:
+        events.put_nowait(('finished', {'index': None}))
+
+
+def open_generation_stream_async(params, cache_key=None):
+    """Асинхронный open_generation_stream: (AsyncEventBroadcast, лидер)"""
+    workers = stream_worker_count(params)
+    if cache_key is None:
+        return AsyncEventBroadcast(workers), True
+
+    def create():
+        async def complete(events):
+            import asyncio
+
+            try:
+                contents = await asyncio.to_thread(stream_result_contents, events)
+                if contents is not None:
+                    await asyncio.to_thread(result_cache.put, cache_key, contents)
+            finally:
+                asgi_stream_flight.forget(cache_key, stream)
+
+        stream = AsyncEventBroadcast(workers, complete)
+        return stream
+
+    return asgi_stream_flight.join(cache_key, create)
+
+
+def start_generation_stream_async(upstream, client, params, events, output=None, use_cache=True, admitted=False):
+    """Запускает задачи генерации, события складываются в events через put_nowait; возвращает задачи"""
+    import asyncio
+
+    if MODEL_REGISTRY[params['model']].get('streaming'):
+        coroutines = [_stream_single_image_async(client, params, i, events, admitted and i == 0) for i in range(params['n'])]
+    else:
+        coroutines = [_generate_all_images_async(upstream, client, params, events, output, use_cache)]
+    return [asyncio.create_task(coroutine) for coroutine in coroutines]
+
+
+class AsgiRequest:
+    """Один HTTP запрос ASGI: заголовки в том же виде, что у handler, ответ пишется по частям"""
+
+    def __init__(self, scope, receive, send):
+        self._receive = receive
+        self._send = send
+        self.method = scope['method']
+        self.path = scope['path']
+        self.query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+        self.headers = HTTPMessage()
+        for name, value in scope.get('headers', []):
+            self.headers[name.decode('latin-1')] = value.decode('latin-1')
+        self.client_address = tuple(scope.get('client') or ('', 0))
+        self.stage_timer = StageTimer()
+        self.status = None
+
+    def client_id(self):
+        return request_client_id(self.headers, self.client_address)
+
+    def debug_trace_requested(self):
+        return TRACE_DEBUG and self.query.get('debug', ['0'])[0] in ('1', 'true')
+
+    async def read_body(self):
+        with measure_stage('read_body') as span:
+            chunks = []
+            size = 0
+            while True:
+                message = await self._receive()
+                if message['type'] == 'http.disconnect':
+                    break
+                chunk = message.get('body', b'')
+                size += len(chunk)
+                if size > ASGI_MAX_BODY_BYTES:
+                    raise GenerationError('Слишком большой запрос', 413)
+                chunks.append(chunk)
+                if not message.get('more_body'):
+                    break
+            body = b''.join(chunks)
+            span.bytes = len(body)
+        return body
+
+    async def read_json(self):
+        return parse_json_object(await self.read_body())
+
+    async def start(self, status, headers):
+        """Отправляет статус и заголовки вместе с Server-Timing"""
+        self.status = status
+        headers = list(headers) + [
+            ('Server-Timing', self.stage_timer.server_timing()),
+            ('Timing-Allow-Origin', '*'),
+        ]
+        await self._send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(name.lower().encode('latin-1'), str(value).encode('latin-1')) for name, value in headers],
+        })
+
+    async def write(self, chunk, more=True):
+        await self._send({'type': 'http.response.body', 'body': chunk, 'more_body': more})
+
+    async def respond(self, status, headers=(), body=b''):
+        await self.start(status, list(headers) + [('Content-Length', len(body))])
+        with measure_stage('write') as span:
+            await self.write(body, False)
+            span.bytes = len(body)
+
+    async def respond_json(self, data, status=200, headers=()):
+        """JSON ответ; base64 изображений кодируется по частям, как в handler.respond_json"""
+        if isinstance(data, dict) and self.debug_trace_requested():
+            data = dict(data, trace=self.stage_timer.trace())
+        with measure_stage('json_dumps') as span:
+            parts = encode_json_parts(data)
+            length = sum(len(part) if isinstance(part, bytes) else part.encoded_length() for part in parts)
+            span.bytes = length
+        await self.start(status, list(headers) + [('Content-Type', 'application/json')] + CORS_HEADERS
+                         + [('Content-Length', length)])
+        with measure_stage('write') as span:
+            for part in parts:
+                for chunk in ([part] if isinstance(part, bytes) else part.chunks()):
+                    await self.write(chunk)
+            await self.write(b'', False)
+            span.bytes = length
+
+    async def respond_error(self, error):
+        """Ошибка запроса, для 429 и 503 с Retry-After"""
+        record_error(error)
+        headers = []
+        if getattr(error, 'retry_after', None):
+            headers.append(('Retry-After', str(error.retry_after)))
+        await self.respond_json({'success': False, 'error': str(error)}, getattr(error, 'status', 500), headers)
+
+    async def respond_html(self, page):
+        """HTML с учетом сжатия и If-None-Match"""
+        encoding = page.negotiate(self.headers.get('Accept-Encoding'))
+        etag = page.etags[encoding]
+        headers = [('ETag', etag), ('Cache-Control', 'private, no-cache'), ('Vary', 'Accept-Encoding')]
+        if_none_match = [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]
+        if etag in if_none_match or f'W/{etag}' in if_none_match:
+            await self.respond(304, headers)
+            return
+        if encoding != 'identity':
+            headers.append(('Content-Encoding', encoding))
+        await self.respond(200, [('Content-Type', 'text/html; charset=utf-8')] + headers, page.encodings[encoding])
+
+    async def start_event_stream(self):
+        await self.start(200, [
+            ('Content-Type', 'text/event-stream; charset=utf-8'),
+            ('Cache-Control', 'no-cache'),
+            ('X-Accel-Buffering', 'no'),
+            ('Access-Control-Allow-Origin', '*'),
+        ])
+
+    async def send_event(self, event, data):
+        with measure_stage('json_dumps'):
+            payload = f'event: {event}\ndata: {json.dumps(data)}\n\n'.encode('utf-8')
+        with measure_stage('write') as span:
+            await self.write(payload)
+            span.bytes = len(payload)
+
+    def with_timings(self, data):
+        data = dict(data, timings=self.stage_timer.timings())
+        if self.debug_trace_requested():
+            data['trace'] = self.stage_timer.trace()
+        return data
+
+    def record_usage(self, params, images, cached, failed):
+        record_generation(
+            self.client_id(), 'generate', params, images, cached, failed,
+            time.perf_counter() - self.stage_timer.started,
+        )
+
+
+class AsgiApp:
+    """ASGI приложение с маршрутами /, /app, /api/login, /api/generate и отдачей изображений"""
+
+    def __init__(self):
+        self.upstream = AsyncUpstream()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        request = AsgiRequest(scope, receive, send)
+        with request.stage_timer.activate():
+            try:
+                await self.dispatch(request)
+            except Exception as e:
+                if request.status is not None:
+                    # Заголовки уже ушли, ответ исправить нельзя
+                    raise
+                await request.respond_error(e)
+        route = handler.route_label(request.path)
+        request.stage_timer.name = f'{request.method} {route}'
+        request.stage_timer.status = request.status
+        request.stage_timer.flush()
+        request_count.inc((request.method, route, str(request.status)))
+        request_duration.observe(time.perf_counter() - request.stage_timer.started, (request.method, route))
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.upstream.aclose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def dispatch(self, request):
+        path = request.path
+        if request.method == 'OPTIONS':
+            await request.respond(204, CORS_HEADERS)
+        elif request.method == 'GET' and path in ('/', '/index.html'):
+            await request.respond_html(get_rendered_page('login'))
+        elif request.method == 'GET' and path == '/app':
+            if not auth_cookie_valid(request.headers):
+                await request.respond(302, [('Location', '/')])
+                return
+            await request.respond_html(get_rendered_page('main', bool(os.environ.get('OPENAI_API_KEY', ''))))
+        elif request.method == 'GET' and path.startswith('/api/images/'):
+            await self.serve_image(request, path[len('/api/images/'):])
+        elif request.method == 'POST' and path == '/api/login':
+            await self.login(request)
+        elif request.method == 'POST' and path == '/api/generate':
+            await self.generate(request)
+        else:
+            await request.respond(404, [('Content-Type', 'text/plain; charset=utf-8')], b'Not Found')
+
+    async def login(self, request):
+        cookies = login_cookies(await request.read_json())
+        if cookies:
+            await request.respond_json({'success': True}, headers=[('Set-Cookie', cookie) for cookie in cookies])
+        else:
+            await request.respond_json({'success': False})
+
+    async def serve_image(self, request, image_id):
+        """Изображение из хранилища с ETag; диапазоны отдает только handler"""
+        import asyncio
+
+        etag = f'"{image_id}"'
+        headers = [('ETag', etag), ('Cache-Control', 'public, max-age=31536000, immutable')]
+        if etag in [tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')]:
+            await request.respond(304, headers)
+            return
+
+        def read():
+            f = image_store.open(image_id)
+            if f is None:
+                return None
+            with f:
+                return f.read()
+
+        content = await asyncio.to_thread(read)
+        if content is None:
+            await request.respond(404, [('Content-Type', 'text/plain; charset=utf-8')], b'Not Found')
+            return
+        await request.respond(200, [
+            ('Content-Type', sniff_image_type(content[:16])),
+            ('Access-Control-Allow-Origin', '*'),
+        ] + headers, content)
+
+    async def generate(self, request):
+        import asyncio
+
+        api_key = os.environ.get('OPENAI_API_KEY')
+        if not api_key:
+            await request.respond_json({'success': False, 'error': 'OpenAI API ключ не настроен на сервере'}, 500)
+            return
+
+        with measure_stage('client_setup'):
+            client = self.upstream.openai(api_key)
+        data = await request.read_json()
+        params, output, use_cache = prepare_generation(data)
+        request.stage_timer.set_params(params)
+
+        if data.get('reuse_check') and auth_cookie_valid(request.headers):
+            candidates = find_reuse_candidates(params, data)
+            if candidates:
+                await request.respond_json({'success': True, 'reuse_candidates': candidates})
+                return
+
+        client_rate_limiter.acquire(request.client_id(), params['n'])
+        if request.query.get('stream', ['0'])[0] in ('1', 'true'):
+            await self.stream_generation(request, client, params, use_cache, output)
+            return
+
+        images = []
+        cached = False
+        failed = True
+        try:
+            contents, cached = await run_generation_async(self.upstream, client, params, use_cache)
+            contents, images = await asyncio.to_thread(store_generation_result, contents, output)
+            failed = False
+        finally:
+            request.record_usage(params, images, cached, failed)
+
+        if data.get('inline'):
+            images = [InlineBase64(content) for content in contents]
+        await request.respond_json({'success': True, 'images': images, 'cached': cached})
+
+    async def stream_generation(self, request, client, params, use_cache=True, output=None):
+        """Асинхронный handler.stream_generation: Server-Sent Events по мере готовности изображений"""
+        import asyncio
+
+        use_cache = use_cache and result_cache.enabled
+        cache_key = generation_cache_key(params) if use_cache else None
+        cached = await asyncio.to_thread(result_cache.get, cache_key) if use_cache else None
+
+        streamed = MODEL_REGISTRY[params['model']].get('streaming') and cached is None
+        stream, leader = (None, False) if cached is not None else open_generation_stream_async(
+            params, cache_key if streamed else None)
+
+        # Первый слот потоковой модели нужен до отправки заголовков, чтобы перегрузка стала обычным 429
+        admitted = streamed and leader
+        if admitted:
+            try:
+                await asgi_admission.acquire()
+            except Exception as e:
+                stream.fail(e)
+                raise
+
+        started = False
+        try:
+            await request.start_event_stream()
+            if cached is not None:
+                _, images = await asyncio.to_thread(store_generation_result, cached, output)
+                for index, image in enumerate(images):
+                    await request.send_event('image', dict(image, index=index))
+                request.record_usage(params, images, True, False)
+                await request.send_event('done', request.with_timings({'success': True, 'count': len(cached), 'cached': True}))
+                return
+
+            if leader:
+                # Ссылка на задачи живет вместе с потоком, иначе их может собрать GC
+                stream.tasks = start_generation_stream_async(
+                    self.upstream, client, params, stream, output, use_cache, admitted)
+                started = True
+            images = {}
+            failed = False
+            async for event, data in stream.subscribe():
+                if event == 'finished':
+                    continue
+                if event == 'image':
+                    images[data['index']] = data
+                elif event == 'error':
+                    failed = True
+                await request.send_event(event, data)
+
+            request.record_usage(params, [images[index] for index in sorted(images)], not leader, failed)
+            await request.send_event('done', request.with_timings({'success': not failed, 'count': len(images), 'cached': not leader}))
+        except Exception as e:
+            if request.status is None:
+                raise
+            # Заголовки потока уже ушли: сообщаем ошибку событием и закрываем поток
+            record_error(e)
+            try:
+                await request.send_event('error', {'index': None, 'error': str(e)})
+            except OSError:
+                pass
+        finally:
+            if leader and not started:
+                stream.fail('Генерация прервана')
+                if admitted:
+                    asgi_admission.release()
+            if request.status is not None:
+                # Конец потока
+                await request.write(b'', False)
+
+
+asgi_app = AsgiApp()
+
+
+# Настройки автономного сервера (python -m api.index)
+SERVER_WORKERS = _env_int('SERVER_WORKERS', 16)
+SERVER_QUEUE_DEPTH = _env_int('SERVER_QUEUE_DEPTH', 64)
+# Простой keep-alive соединения между запросами: ждет в селекторе, воркер не занимает
+SERVER_KEEPALIVE_TIMEOUT = _env_float('SERVER_KEEPALIVE_TIMEOUT', 15.0)
+# Чтение уже начатого запроса держит воркер, поэтому таймаут короткий
+SERVER_READ_TIMEOUT = _env_float('SERVER_READ_TIMEOUT', 10.0)
+SERVER_MAX_IDLE_CONNECTIONS = _env_int('SERVER_MAX_IDLE_CONNECTIONS', 1024)
+SERVER_DRAIN_TIMEOUT = _env_float('SERVER_DRAIN_TIMEOUT', 30.0)
+
+
+class PooledHTTPServer(HTTPServer):
+    """HTTP сервер с фиксированным пулом воркеров и ограниченной очередью соединений
+
+    Воркер обрабатывает по одному запросу; keep-alive соединение между запросами
+    ждет в общем селекторе и возвращается в очередь, когда клиент прислал данные.
+    """
+
+    def __init__(self, server_address, handler_class, workers=SERVER_WORKERS,
+                 queue_depth=SERVER_QUEUE_DEPTH, keepalive_timeout=SERVER_KEEPALIVE_TIMEOUT,
+                 max_idle=SERVER_MAX_IDLE_CONNECTIONS):
+        import selectors
+        import socket
+
+        # Селектор и сокеты пробуждения создаются до bind(): при ошибке bind HTTPServer
+        # зовет server_close(), и он должен найти их на месте, а не скрыть исходную ошибку
+        self._selector = selectors.DefaultSelector()
+        self._wake_reader, self._wake_writer = socket.socketpair()
+        self._wake_reader.setblocking(False)
+        self._selector.register(self._wake_reader, selectors.EVENT_READ)
+        self.request_queue_size = queue_depth
+        super().__init__(server_address, handler_class)
+        self.draining = threading.Event()
+        self.keepalive_timeout = keepalive_timeout
+        self.max_idle = max_idle
+        self._connections = queue.Queue(maxsize=queue_depth)
+        self._parking = queue.SimpleQueue()
+        self._idle_thread = threading.Thread(target=self._idle_loop, name='http-idle', daemon=True)
+        self._idle_thread.start()
+        self._workers = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._worker, name=f'http-worker-{i}', daemon=True)
+            thread.start()
+            self._workers.append(thread)
+
+    def process_request(self, request, client_address):
+        # Соединение ждет свободного воркера; при переполнении очереди сразу 503
+        self._enqueue(request, client_address, None)
+
+    def _enqueue(self, request, client_address, connection_handler):
+        try:
+            self._connections.put_nowait((request, client_address, connection_handler))
+        except queue.Full:
+            self._reject(request)
+
+    def _reject(self, request):
+        try:
+            request.sendall(
+                b'HTTP/1.1 503 Service Unavailable\r\n'
+                b'Content-Length: 0\r\n'
+                b'Retry-After: 1\r\n'
+                b'Connection: close\r\n\r\n'
+            )
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def _worker(self):
+        while True:
+            item = self._connections.get()
+            if item is None:
+                return
+            request, client_address, connection_handler = item
+            try:
+                if connection_handler is None:
+                    connection_handler = self.RequestHandlerClass(request, client_address, self)
                 else:
-                    params["style"] = "vivid"
-            
-            # Генерируем изображения
-            openai_response = client.images.generate(**params)
-            
-            if not hasattr(openai_response, 'data') or not openai_response.data:
-                self.respond_json({'success': False, 'error': 'Неверный ответ от OpenAI API'}, 500)
+                    connection_handler.resume()
+            except Exception:
+                self.handle_error(request, client_address)
+                self.shutdown_request(request)
+                continue
+            if getattr(connection_handler, 'close_connection', True) or self.draining.is_set():
+                self.shutdown_request(request)
+            else:
+                self._park(request, client_address, connection_handler)
+
+    def _park(self, request, client_address, connection_handler):
+        self._parking.put((request, client_address, connection_handler))
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wake_writer.send(b'\0')
+        except OSError:
+            pass
+
+    def _idle_loop(self):
+        import selectors
+
+        idle = {}
+        while True:
+            while True:
+                try:
+                    request, client_address, connection_handler = self._parking.get_nowait()
+                except queue.Empty:
+                    break
+                if self.draining.is_set() or len(idle) >= self.max_idle:
+                    self._close_parked(request, connection_handler)
+                    continue
+                try:
+                    self._selector.register(request, selectors.EVENT_READ, (client_address, connection_handler))
+                except (ValueError, OSError):
+                    self._close_parked(request, connection_handler)
+                    continue
+                idle[request] = time.monotonic() + self.keepalive_timeout
+            if self.draining.is_set():
+                for request in idle:
+                    self._close_parked(request, self._selector.unregister(request).data[1])
                 return
-            
-            # Обрабатываем изображения
-            images = []
-            for i, image_data in enumerate(openai_response.data):
-                if hasattr(image_data, 'b64_json') and image_data.b64_json:
-                    images.append(image_data.b64_json)
-                elif hasattr(image_data, 'url') and image_data.url:
+
+            now = time.monotonic()
+            timeout = min(idle.values()) - now if idle else None
+            for key, _ in self._selector.select(max(timeout, 0) if timeout is not None else None):
+                if key.fileobj is self._wake_reader:
                     try:
-                        image_response = requests.get(image_data.url, timeout=60)
-                        if image_response.status_code == 200:
-                            image_b64 = base64.b64encode(image_response.content).decode('utf-8')
-                            images.append(image_b64)
-                        else:
-                            self.respond_json({'success': False, 'error': f'Ошибка загрузки изображения {i+1}'}, 500)
-                            return
-                    except requests.exceptions.RequestException as e:
-                        self.respond_json({'success': False, 'error': f'Ошибка загрузки: {str(e)}'}, 500)
-                        return
-                else:
-                    self.respond_json({'success': False, 'error': f'Изображение {i+1} не содержит данных'}, 500)
-                    return
-            
-            # Возвращаем результат
-            self.respond_json({'success': True, 'images': images})
-            
-        except Exception as e:
-            self.respond_json({'success': False, 'error': str(e)}, 500)
+                        while self._wake_reader.recv(4096):
+                            pass
+                    except OSError:
+                        pass
+                    continue
+                # Клиент прислал следующий запрос (или закрыл соединение) - отдаем воркеру
+                self._selector.unregister(key.fileobj)
+                del idle[key.fileobj]
+                self._enqueue(key.fileobj, *key.data)
+
+            now = time.monotonic()
+            for request in [request for request, deadline in idle.items() if deadline <= now]:
+                del idle[request]
+                self._close_parked(request, self._selector.unregister(request).data[1])
+
+    def _close_parked(self, request, connection_handler):
+        connection_handler.close_connection = True
+        try:
+            connection_handler.finish()
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def drain(self, timeout=SERVER_DRAIN_TIMEOUT):
+        """Дожидается обработки принятых соединений и останавливает воркеров"""
+        self.draining.set()
+        self._wake()
+        deadline = time.monotonic() + timeout
+        for _ in self._workers:
+            try:
+                self._connections.put(None, timeout=max(deadline - time.monotonic(), 0))
+            except queue.Full:
+                break
+        for thread in self._workers:
+            thread.join(max(deadline - time.monotonic(), 0))
+        # Соединения, которые так и не дождались воркера, закрываем сами
+        while True:
+            try:
+                item = self._connections.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                self.shutdown_request(item[0])
+        self._idle_thread.join(max(deadline - time.monotonic(), 0))
+        return all(not thread.is_alive() for thread in self._workers)
+
+    def server_close(self):
+        super().server_close()
+        self._wake_reader.close()
+        self._wake_writer.close()
+        self._selector.close()
+
+
+class KeepAliveHandler(handler):
+    """handler с HTTP/1.1 keep-alive для автономного сервера"""
+
+    protocol_version = 'HTTP/1.1'
+    timeout = SERVER_READ_TIMEOUT
+    # Заголовки и тело уходят отдельными send: без TCP_NODELAY повторный запрос ждет delayed ACK
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        # Один запрос за проход воркера, плюс те, что клиент уже прислал конвейером
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self.has_buffered_input():
+            self.handle_one_request()
+        # При остановке сервера закрываем соединение после текущего ответа
+        if self.server.draining.is_set():
+            self.close_connection = True
+
+    def finish(self):
+        # rfile живет вместе с соединением: в его буфере может лежать начало следующего запроса
+        if self.close_connection:
+            super().finish()
+        else:
+            self.wfile.flush()
+
+    def resume(self):
+        """Обрабатывает следующий запрос на соединении, вернувшемся из ожидания"""
+        try:
+            self.handle()
+        finally:
+            self.finish()
+
+    def has_buffered_input(self):
+        """Есть ли уже полученные данные, не дожидаясь сокета"""
+        self.connection.setblocking(False)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+
+def serve(host='0.0.0.0', port=8000, workers=SERVER_WORKERS, queue_depth=SERVER_QUEUE_DEPTH,
+          drain_timeout=SERVER_DRAIN_TIMEOUT):
+    """Запускает автономный сервер и плавно останавливает его по SIGTERM/SIGINT"""
+    server = PooledHTTPServer((host, port), KeepAliveHandler, workers, queue_depth)
+
+    def stop(signum, frame):
+        # shutdown() блокируется до выхода из serve_forever, поэтому зовем его из другого потока
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    print(f'Serving on http://{host}:{server.server_port} ({workers} workers, queue {queue_depth})', flush=True)
+    try:
+        server.serve_forever()
+    finally:
+        drained = server.drain(drain_timeout)
+        server.server_close()
+        print('Server stopped' if drained else 'Server stopped, some connections were cut', flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Автономный сервер генератора изображений')
+    parser.add_argument('--host', default=os.environ.get('HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=_env_int('PORT', 8000))
+    parser.add_argument('--workers', type=int, default=SERVER_WORKERS)
+    parser.add_argument('--queue-depth', type=int, default=SERVER_QUEUE_DEPTH)
+    parser.add_argument('--drain-timeout', type=float, default=SERVER_DRAIN_TIMEOUT)
+    parser.add_argument('--asgi', action='store_true', help='запустить asgi_app через uvicorn вместо пула потоков')
+    args = parser.parse_args(argv)
+    if args.asgi:
+        try:
+            import uvicorn
+        except ImportError:
+            parser.error('для --asgi нужен uvicorn: pip install uvicorn')
+        uvicorn.run(asgi_app, host=args.host, port=args.port, log_level='warning',
+                    timeout_graceful_shutdown=int(args.drain_timeout))
+        return
+    serve(args.host, args.port, args.workers, args.queue_depth, args.drain_timeout)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,422 @@
+"""Память и время отрисовки результатов на странице в настоящем браузере.
+
+Поднимает заглушку OpenAI и автономный сервер так же, как bench/loadgen.py, открывает
+/app в браузере на Chromium и несколько раз подряд отправляет форму генерации (по умолчанию
+gpt-image-1, n=4, с превью из потока). Браузер управляется через Chrome DevTools Protocol
+напрямую, без сторонних пакетов. После каждой отправки измеряются:
+
+- время от отправки до загрузки первого превью и последнего готового изображения;
+- размер JS-кучи после сборки мусора (HeapProfiler.collectGarbage, Runtime.getHeapUsage);
+- суммарная длина src/href внутри #images в пике за раунд и после него;
+- число живых object URL, если страница их считает (window.imagegenRender).
+
+Рост кучи от раунда к раунду означает, что прошлые результаты не освобождаются.
+
+    python bench/browser_render.py --rounds 5 --save bench/baselines/browser.json
+    python bench/browser_render.py --rounds 5 --compare bench/baselines/browser.json
+
+Браузер запускается из --browser (или переменной CHROME, иначе chromium/google-chrome из
+PATH) с --remote-debugging-port. С --cdp можно подключиться к уже открытому браузеру,
+например к Chrome на телефоне через adb forward; с --target нагрузка идет на уже запущенный
+сервер.
+"""
+
+import argparse
+import base64
+import http.client
+import json
+import os
+import platform
+import shlex
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from loadgen import ROOT, Environment, free_port, git_revision, percentile, wait_for_port  # noqa: E402
+
+BROWSER_CANDIDATES = ('chromium', 'chromium-browser', 'google-chrome', 'google-chrome-stable', 'chrome')
+
+
+class CdpSession:
+    """Минимальный клиент DevTools Protocol: WebSocket (RFC 6455) к одной вкладке"""
+
+    def __init__(self, ws_url, timeout=60.0):
+        parsed = urlparse(ws_url)
+        self.sock = socket.create_connection((parsed.hostname, parsed.port), timeout=timeout)
+        key = base64.b64encode(os.urandom(16)).decode('ascii')
+        self.sock.sendall((
+            f'GET {parsed.path} HTTP/1.1\r\n'
+            f'Host: {parsed.hostname}:{parsed.port}\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            f'Sec-WebSocket-Key: {key}\r\n'
+            'Sec-WebSocket-Version: 13\r\n\r\n'
+        ).encode('ascii'))
+        self.file = self.sock.makefile('rb')
+        status = self.file.readline()
+        if b' 101 ' not in status:
+            raise RuntimeError(f'DevTools не принял WebSocket: {status!r}')
+        while self.file.readline() not in (b'\r\n', b''):
+            pass
+        self._next_id = 0
+
+    def _send_frame(self, opcode, payload):
+        header = bytearray([0x80 | opcode])
+        length = len(payload)
+        if length < 126:
+            header.append(0x80 | length)
+        elif length < 65536:
+            header.append(0x80 | 126)
+            header += struct.pack('>H', length)
+        else:
+            header.append(0x80 | 127)
+            header += struct.pack('>Q', length)
+        # Кадры клиента по протоколу всегда маскируются
+        mask = os.urandom(4)
+        masked = bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+        self.sock.sendall(bytes(header) + mask + masked)
+
+    def _read_exact(self, size):
+        data = self.file.read(size)
+        if len(data) != size:
+            raise ConnectionError('DevTools закрыл соединение')
+        return data
+
+    def _receive(self):
+        message = bytearray()
+        while True:
+            first, second = self._read_exact(2)
+            length = second & 0x7f
+            if length == 126:
+                length = struct.unpack('>H', self._read_exact(2))[0]
+            elif length == 127:
+                length = struct.unpack('>Q', self._read_exact(8))[0]
+            data = self._read_exact(length)
+            opcode = first & 0x0f
+            if opcode == 0x8:
+                raise ConnectionError('DevTools закрыл соединение')
+            if opcode == 0x9:
+                self._send_frame(0xA, data)
+                continue
+            if opcode in (0x0, 0x1, 0x2):
+                message += data
+                if first & 0x80:
+                    return json.loads(message.decode('utf-8'))
+
+    def call(self, method, **params):
+        """Команда протокола; события, пришедшие до ответа, пропускаются"""
+        self._next_id += 1
+        request_id = self._next_id
+        self._send_frame(0x1, json.dumps({'id': request_id, 'method': method, 'params': params}).encode('utf-8'))
+        while True:
+            message = self._receive()
+            if message.get('id') != request_id:
+                continue
+            if 'error' in message:
+                raise RuntimeError(f'{method}: {message["error"].get("message")}')
+            return message.get('result', {})
+
+    def evaluate(self, expression, timeout=None):
+        """Значение JS выражения; промисы дожидаются"""
+        params = {'expression': expression, 'awaitPromise': True, 'returnByValue': True}
+        if timeout is not None:
+            params['timeout'] = int(timeout * 1000)
+        result = self.call('Runtime.evaluate', **params)
+        if 'exceptionDetails' in result:
+            details = result['exceptionDetails']
+            raise RuntimeError((details.get('exception') or {}).get('description') or details.get('text'))
+        return result['result'].get('value')
+
+    def close(self):
+        try:
+            self._send_frame(0x8, b'')
+        except OSError:
+            pass
+        self.sock.close()
+
+
+def devtools_json(endpoint, path, method='GET'):
+    parsed = urlparse(endpoint)
+    connection = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=10)
+    connection.request(method, path)
+    return json.loads(connection.getresponse().read().decode('utf-8'))
+
+
+def open_page(endpoint):
+    """WebSocket вкладки браузера: первая открытая или новая"""
+    pages = [target for target in devtools_json(endpoint, '/json/list') if target.get('type') == 'page']
+    if not pages:
+        pages = [devtools_json(endpoint, '/json/new?about:blank', 'PUT')]
+    return pages[0]['webSocketDebuggerUrl']
+
+
+class Browser:
+    """Браузер на Chromium с открытым портом DevTools, запущенный как дочерний процесс"""
+
+    def __init__(self, command):
+        self.profile = tempfile.mkdtemp(prefix='imagegen-browser-')
+        port = free_port()
+        self.endpoint = f'http://127.0.0.1:{port}'
+        self.process = subprocess.Popen(shlex.split(command) + [
+            '--headless=new',
+            f'--remote-debugging-port={port}',
+            f'--user-data-dir={self.profile}',
+            '--no-first-run',
+            '--no-default-browser-check',
+            '--window-size=1280,900',
+            'about:blank',
+        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        wait_for_port(port, 30)
+
+    def close(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        shutil.rmtree(self.profile, ignore_errors=True)
+
+
+def find_browser():
+    if os.environ.get('CHROME'):
+        return os.environ['CHROME']
+    for name in BROWSER_CANDIDATES:
+        path = shutil.which(name)
+        if path:
+            return path
+    return None
+
+
+# Счетчик раунда: загрузки картинок в #images и пик длины src/href, независимо от версии страницы
+ROUND_SETUP = '''(() => {
+    const images = document.getElementById('images');
+    const attributeBytes = () => {
+        let total = 0;
+        images.querySelectorAll('[src], [href]').forEach(node => {
+            total += (node.getAttribute('src') || node.getAttribute('href') || '').length;
+        });
+        return total;
+    };
+    window.__renderProbe = { submittedAt: performance.now(), loads: [], peakAttributeBytes: 0, attributeBytes };
+    if (!window.__renderProbeInstalled) {
+        window.__renderProbeInstalled = true;
+        // load не всплывает, поэтому ловим на погружении
+        images.addEventListener('load', event => {
+            const probe = window.__renderProbe;
+            const src = event.target.currentSrc || event.target.src || '';
+            const kind = src.startsWith('data:') || src.startsWith('blob:') ? 'partial' : 'image';
+            probe.loads.push({ kind, ms: performance.now() - probe.submittedAt });
+            probe.peakAttributeBytes = Math.max(probe.peakAttributeBytes, probe.attributeBytes());
+        }, true);
+    }
+})()'''
+
+ROUND_WAIT = '''new Promise((resolve, reject) => {
+    const deadline = performance.now() + %(timeout)d;
+    const check = () => {
+        const probe = window.__renderProbe;
+        // Ленивые картинки грузятся только рядом с экраном, как у пользователя, который смотрит на результат
+        document.getElementById('images').scrollIntoView();
+        if (probe.loads.filter(item => item.kind === 'image').length >= %(n)d) {
+            resolve(true);
+        } else if (performance.now() > deadline) {
+            reject(new Error('нет готовых изображений: ' + document.getElementById('status').innerText));
+        } else {
+            setTimeout(check, 20);
+        }
+    };
+    check();
+})'''
+
+ROUND_RESULT = '''(() => {
+    const probe = window.__renderProbe;
+    return {
+        loads: probe.loads,
+        peak_attribute_bytes: probe.peakAttributeBytes,
+        attribute_bytes: probe.attributeBytes(),
+        live_object_urls: window.imagegenRender ? window.imagegenRender.liveObjectUrls : null,
+    };
+})()'''
+
+
+def wait_loaded(page, url, timeout=30.0):
+    page.call('Page.navigate', url=url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if page.evaluate(f'location.href === {json.dumps(url)} && document.readyState === "complete"'):
+                return
+        except RuntimeError:
+            # Контекст страницы пересоздается во время навигации
+            pass
+        time.sleep(0.05)
+    raise RuntimeError(f'{url} не загрузилась за {timeout} с')
+
+
+def run_round(page, args, number):
+    # Случайные слова, чтобы страница не предлагала похожие прошлые результаты
+    prompt = f'{os.urandom(6).hex()} {os.urandom(6).hex()} {number}'
+    page.evaluate(ROUND_SETUP)
+    page.evaluate(f'''(() => {{
+        document.getElementById('prompt').value = {json.dumps(prompt)};
+        document.querySelector('#imageForm button[type=submit]').click();
+    }})()''')
+    started = time.perf_counter()
+    page.evaluate(ROUND_WAIT % {'timeout': args.timeout * 1000, 'n': args.n}, timeout=args.timeout + 5)
+    wall_ms = (time.perf_counter() - started) * 1000
+    result = page.evaluate(ROUND_RESULT)
+    # Второй проход добирает то, что освободилось после финализации первого
+    for _ in range(2):
+        page.call('HeapProfiler.collectGarbage')
+    heap = page.call('Runtime.getHeapUsage')
+    finals = [item['ms'] for item in result['loads'] if item['kind'] == 'image']
+    partials = [item['ms'] for item in result['loads'] if item['kind'] == 'partial']
+    return {
+        'round': number,
+        'wall_ms': round(wall_ms, 1),
+        'last_image_ms': round(sorted(finals)[args.n - 1], 1),
+        'first_partial_ms': round(min(partials), 1) if partials else None,
+        'heap_mb': round(heap['usedSize'] / 1024 / 1024, 2),
+        'peak_dom_kb': round(result['peak_attribute_bytes'] / 1024, 1),
+        'dom_kb': round(result['attribute_bytes'] / 1024, 1),
+        'live_object_urls': result['live_object_urls'],
+    }
+
+
+def summarize(rounds):
+    def stat(name, q):
+        values = [item[name] for item in rounds if item[name] is not None]
+        return round(percentile(values, q), 1) if values else None
+
+    # Первый раунд прогревает страницу и кеши браузера, рост кучи считаем от него
+    heaps = [item['heap_mb'] for item in rounds]
+    return {
+        'last_image_ms': stat('last_image_ms', 0.5),
+        'first_partial_ms': stat('first_partial_ms', 0.5),
+        'heap_mb': heaps[-1],
+        'heap_growth_mb': round(heaps[-1] - heaps[0], 2),
+        'peak_dom_kb': stat('peak_dom_kb', 0.5),
+        'dom_kb': rounds[-1]['dom_kb'],
+        'live_object_urls': rounds[-1]['live_object_urls'],
+    }
+
+
+COMPARED = ('last_image_ms', 'first_partial_ms', 'heap_mb', 'heap_growth_mb', 'peak_dom_kb', 'dom_kb')
+
+
+def print_rounds(rounds):
+    print(f'{"round":>5} {"last ms":>9} {"partial ms":>11} {"heap MB":>8} {"peak DOM KB":>12} {"DOM KB":>8} {"blobs":>6}')
+    for item in rounds:
+        cells = [item['last_image_ms'], item['first_partial_ms'], item['heap_mb'],
+                 item['peak_dom_kb'], item['dom_kb'], item['live_object_urls']]
+        cells = ['-' if value is None else value for value in cells]
+        print(f'{item["round"]:>5} {cells[0]:>9} {cells[1]:>11} {cells[2]:>8} {cells[3]:>12} {cells[4]:>8} {cells[5]:>6}')
+
+
+def print_comparison(summary, baseline):
+    previous = baseline['summary']
+    print(f'\nсравнение с {baseline["meta"].get("revision") or "baseline"} ({baseline["meta"].get("created")}):')
+    for name in COMPARED:
+        before, after = previous.get(name), summary.get(name)
+        if before and after is not None:
+            print(f'  {name} {before} -> {after} ({(after - before) / before * 100:+.1f}%)')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Память и время отрисовки результатов в браузере')
+    parser.add_argument('--rounds', type=int, default=5, help='отправок формы подряд')
+    parser.add_argument('--model', default='gpt-image-1')
+    parser.add_argument('--n', type=int, default=4)
+    parser.add_argument('--timeout', type=float, default=120.0, help='ожидание одного раунда, с')
+    parser.add_argument('--browser', help='команда запуска Chromium; по умолчанию CHROME или chromium из PATH')
+    parser.add_argument('--cdp', help='адрес DevTools уже запущенного браузера, например http://127.0.0.1:9222')
+    parser.add_argument('--target', help='URL уже запущенного сервера вместо локального окружения')
+    parser.add_argument('--latency', type=float, default=0.2, help='задержка заглушки, с')
+    parser.add_argument('--image-side', type=int, default=1024)
+    parser.add_argument('--asgi', action='store_true', help='поднять сервер как asgi_app под uvicorn')
+    parser.add_argument('--server-env', action='append', default=[], metavar='NAME=VALUE')
+    parser.add_argument('--workdir', default=os.path.join(ROOT, 'bench', '.work'))
+    parser.add_argument('--save', help='сохранить результат в JSON')
+    parser.add_argument('--compare', help='сравнить с сохраненным JSON')
+    args = parser.parse_args(argv)
+
+    command = None if args.cdp else (args.browser or find_browser())
+    if not args.cdp and not command:
+        parser.error('не найден Chromium: укажите --browser, переменную CHROME или --cdp')
+
+    # Остальные настройки окружения те же, что у loadgen по умолчанию
+    args.jitter, args.response, args.error_rate = 0.0, 'auto', 0.0
+    args.cache, args.server_workers = False, 32
+    args.server_env = ['SECRET_KEY=bench',
+                       'HISTORY_DB_PATH=' + os.path.join(args.workdir, 'history.sqlite3'),
+                       'USAGE_DB_PATH=' + os.path.join(args.workdir, 'usage.sqlite3')] + args.server_env
+
+    environment = None
+    browser = None
+    page = None
+    try:
+        environment = None if args.target else Environment(args)
+        target = (args.target or environment.target).rstrip('/')
+        browser = None if args.cdp else Browser(command)
+        endpoint = args.cdp or browser.endpoint
+        version = devtools_json(endpoint, '/json/version')
+        page = CdpSession(open_page(endpoint), timeout=args.timeout + 10)
+        # Cookie входа ставим со страницы логина, как после успешного /api/login
+        wait_loaded(page, target + '/')
+        page.evaluate("document.cookie = 'auth_token=valid; path=/'")
+        wait_loaded(page, target + '/app')
+        page.evaluate(f'''(() => {{
+            const model = document.getElementById('model');
+            model.value = {json.dumps(args.model)};
+            model.dispatchEvent(new Event('change'));
+            document.getElementById('n').value = {json.dumps(str(args.n))};
+        }})()''')
+        rounds = [run_round(page, args, number) for number in range(1, args.rounds + 1)]
+    finally:
+        if page is not None:
+            page.close()
+        if browser is not None:
+            browser.close()
+        if environment is not None:
+            environment.close()
+
+    summary = summarize(rounds)
+    result = {
+        'meta': {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'browser': version.get('User-Agent'),
+            'target': args.target or 'local',
+            'server': None if args.target else ('asgi' if args.asgi else 'threads'),
+            'model': args.model,
+            'n': args.n,
+            'rounds': args.rounds,
+            'stub': None if args.target else {'latency': args.latency, 'image_side': args.image_side},
+        },
+        'rounds': rounds,
+        'summary': summary,
+    }
+    print_rounds(rounds)
+    print('\nитог: ' + ', '.join(f'{name} {value}' for name, value in summary.items()))
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(summary, json.load(f))
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, 'w') as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+            f.write('\n')
+        print(f'\nсохранено в {args.save}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+"""Холодный старт: время первого ответа каждого маршрута в свежем процессе.
+
+Для каждого маршрута и каждого повтора запускается новый интерпретатор, как при
+холодном старте на Vercel: он импортирует api.index, обслуживает один запрос и
+сообщает время импорта, время до первого ответа и какие тяжелые модули успели
+загрузиться. Генерация идет в bench/stub_openai.py без задержки, поэтому в ее
+времени видна стоимость ленивой загрузки клиента OpenAI.
+
+    python bench/coldstart.py --runs 10 --save bench/baselines/coldstart.json
+    python bench/coldstart.py --runs 10 --compare bench/baselines/coldstart.json --max-regression 25
+
+С --max-regression процесс завершается с кодом 1, если медиана первого ответа
+какого-либо маршрута выросла больше чем на заданный процент.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from loadgen import ROOT, free_port, git_revision, percentile, wait_for_port  # noqa: E402
+
+HEAVY_MODULES = ('openai', 'httpx', 'requests', 'PIL.Image')
+
+ROUTES = {
+    'page': ('GET', '/', None, {}),
+    'app': ('GET', '/app', None, {'Cookie': 'auth_token=valid'}),
+    'login': ('POST', '/api/login', {'secret_key': 'bench'}, {}),
+    'generate': ('POST', '/api/generate', {'model': 'dall-e-2', 'prompt': 'benchmark', 'size': '256x256'}, {}),
+}
+
+# Выполняется в дочернем процессе: импорт модуля и один запрос через настоящий handler
+CHILD = r'''
+import http.client, json, sys, threading, time
+started = time.perf_counter()
+from api import index
+imported = time.perf_counter()
+method, path, body, headers = json.loads(sys.argv[1])
+server = index.HTTPServer(('127.0.0.1', 0), index.handler)
+threading.Thread(target=server.handle_request, daemon=True).start()
+connection = http.client.HTTPConnection('127.0.0.1', server.server_port, timeout=60)
+payload = json.dumps(body).encode('utf-8') if body is not None else None
+if payload is not None:
+    headers = dict(headers, **{'Content-Type': 'application/json'})
+connection.request(method, path, payload, headers)
+response = connection.getresponse()
+response.read()
+finished = time.perf_counter()
+print(json.dumps({
+    'status': response.status,
+    'import_ms': (imported - started) * 1000,
+    'first_response_ms': (finished - started) * 1000,
+    'loaded': [name for name in json.loads(sys.argv[2]) if name in sys.modules],
+}))
+'''
+
+
+def run_once(route, env):
+    """Один холодный процесс: метрики дочернего процесса плюс полное время с запуском интерпретатора"""
+    started = time.perf_counter()
+    output = subprocess.check_output(
+        [sys.executable, '-c', CHILD, json.dumps(ROUTES[route]), json.dumps(HEAVY_MODULES)],
+        cwd=ROOT, env=env, stderr=subprocess.DEVNULL,
+    )
+    result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    result['process_ms'] = (time.perf_counter() - started) * 1000
+    return result
+
+
+def summarize(route, samples):
+    def stat(name, q):
+        return round(percentile([sample[name] for sample in samples], q), 1)
+
+    return {
+        'route': route,
+        'runs': len(samples),
+        'status': sorted({sample['status'] for sample in samples}),
+        'import_ms': stat('import_ms', 0.5),
+        'first_response_ms': stat('first_response_ms', 0.5),
+        'first_response_p95_ms': stat('first_response_ms', 0.95),
+        'process_ms': stat('process_ms', 0.5),
+        'loaded': sorted({name for sample in samples for name in sample['loaded']}),
+    }
+
+
+COMPARED = ('import_ms', 'first_response_ms', 'first_response_p95_ms', 'process_ms')
+
+
+def print_routes(routes):
+    print(f'{"route":>9} {"import ms":>10} {"first ms":>10} {"p95 ms":>10} {"process ms":>11}  loaded')
+    for item in routes:
+        print(f'{item["route"]:>9} {item["import_ms"]:>10} {item["first_response_ms"]:>10} '
+              f'{item["first_response_p95_ms"]:>10} {item["process_ms"]:>11}  {", ".join(item["loaded"]) or "-"}')
+
+
+def print_comparison(routes, baseline, max_regression=None):
+    """Изменения относительно baseline; возвращает маршруты, превысившие max_regression"""
+    previous = {item['route']: item for item in baseline['routes']}
+    print(f'\nсравнение с {baseline["meta"].get("revision") or "baseline"} ({baseline["meta"].get("created")}):')
+    regressions = []
+    for item in routes:
+        old = previous.get(item['route'])
+        if old is None:
+            continue
+        parts = []
+        for name in COMPARED:
+            before, after = old.get(name), item.get(name)
+            if before and after is not None:
+                parts.append(f'{name} {before} -> {after} ({(after - before) / before * 100:+.1f}%)')
+        new_modules = sorted(set(item['loaded']) - set(old.get('loaded', [])))
+        if new_modules:
+            parts.append('новые модули: ' + ', '.join(new_modules))
+        print(f'  {item["route"]}: ' + ', '.join(parts))
+        before, after = old.get('first_response_ms'), item['first_response_ms']
+        if max_regression is not None and before and (after - before) / before * 100 > max_regression:
+            regressions.append(item['route'])
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Холодный старт маршрутов api.index')
+    parser.add_argument('--routes', default=','.join(ROUTES), help='маршруты через запятую: ' + ', '.join(ROUTES))
+    parser.add_argument('--runs', type=int, default=5, help='холодных процессов на маршрут')
+    parser.add_argument('--workdir', default=os.path.join(ROOT, 'bench', '.work'))
+    parser.add_argument('--save', help='сохранить результат в JSON')
+    parser.add_argument('--compare', help='сравнить с сохраненным JSON')
+    parser.add_argument('--max-regression', type=float, metavar='PERCENT',
+                        help='с --compare: код 1 при росте медианы первого ответа больше чем на PERCENT')
+    args = parser.parse_args(argv)
+    routes = [route.strip() for route in args.routes.split(',') if route.strip()]
+    unknown = [route for route in routes if route not in ROUTES]
+    if unknown:
+        parser.error('неизвестные маршруты: ' + ', '.join(unknown))
+
+    stub = None
+    env = dict(os.environ)
+    env.update({
+        'OPENAI_API_KEY': 'sk-bench',
+        'SECRET_KEY': 'bench',
+        'RATE_LIMIT_PER_MINUTE': '0',
+        'RESULT_CACHE_ENABLED': '0',
+        'IMAGE_STORE_DIR': os.path.join(args.workdir, 'images'),
+        'USAGE_DB_PATH': os.path.join(args.workdir, 'usage.sqlite3'),
+        'HISTORY_DB_PATH': os.path.join(args.workdir, 'history.sqlite3'),
+    })
+    if 'generate' in routes:
+        stub_port = free_port()
+        stub = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, 'bench', 'stub_openai.py'), '--port', str(stub_port)],
+            cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        wait_for_port(stub_port)
+        env['OPENAI_BASE_URL'] = f'http://127.0.0.1:{stub_port}/v1'
+
+    try:
+        # Прогрев: байткод и кеши файловой системы, чтобы мерить импорт, а не компиляцию
+        run_once(routes[0], env)
+        results = []
+        for route in routes:
+            results.append(summarize(route, [run_once(route, env) for _ in range(args.runs)]))
+    finally:
+        if stub is not None:
+            stub.terminate()
+            stub.wait(timeout=10)
+
+    result = {
+        'meta': {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'runs': args.runs,
+        },
+        'routes': results,
+    }
+    print_routes(results)
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = print_comparison(results, json.load(f), args.max_regression)
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, 'w') as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+            f.write('\n')
+        print(f'\nсохранено в {args.save}')
+    if regressions:
+        print('\nрегрессия холодного старта: ' + ', '.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+"""Нагрузочный тест /api/generate против заглушки OpenAI.
+
+По умолчанию поднимает bench/stub_openai.py и автономный сервер (python -m api.index)
+на свободных портах, прогоняет уровни параллелизма и печатает пропускную способность,
+p50/p95/p99 и пиковый RSS сервера. Результат можно сохранить как baseline и сравнить
+с ним следующий прогон:
+
+    python bench/loadgen.py --concurrency 1,8,32 --requests 200 --save bench/baselines/local.json
+    python bench/loadgen.py --concurrency 1,8,32 --requests 200 --compare bench/baselines/local.json
+
+С --target нагрузка идет на уже запущенный сервер, тогда RSS не измеряется.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=15.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f'порт {port} не открылся за {timeout} с')
+
+
+def percentile(values, q):
+    """Перцентиль с линейной интерполяцией"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def read_peak_rss(pid):
+    """Пиковый RSS процесса в МБ из /proc (VmHWM), None вне Linux"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss(pid):
+    # Запись 5 в clear_refs сбрасывает VmHWM, чтобы пик считался по каждому уровню
+    try:
+        with open(f'/proc/{pid}/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+class Environment:
+    """Заглушка и сервер приложения, запущенные как дочерние процессы"""
+
+    def __init__(self, args):
+        self.processes = []
+        self.server_pid = None
+        stub_port = free_port()
+        self.spawn([
+            sys.executable, os.path.join(ROOT, 'bench', 'stub_openai.py'),
+            '--port', str(stub_port),
+            '--latency', str(args.latency),
+            '--jitter', str(args.jitter),
+            '--response', args.response,
+            '--image-side', str(args.image_side),
+            '--error-rate', str(args.error_rate),
+        ])
+        wait_for_port(stub_port)
+
+        env = dict(os.environ)
+        env.update({
+            'OPENAI_API_KEY': 'sk-bench',
+            'OPENAI_BASE_URL': f'http://127.0.0.1:{stub_port}/v1',
+            'RATE_LIMIT_PER_MINUTE': '0',
+            'RESULT_CACHE_ENABLED': '1' if args.cache else '0',
+            'IMAGE_STORE_DIR': os.path.join(args.workdir, 'images'),
+        })
+        for item in args.server_env:
+            name, _, value = item.partition('=')
+            env[name] = value
+        port = free_port()
+        server = self.spawn([
+            sys.executable, '-m', 'api.index', '--host', '127.0.0.1', '--port', str(port),
+            '--workers', str(args.server_workers),
+        ] + (['--asgi'] if args.asgi else []), env)
+        self.server_pid = server.pid
+        wait_for_port(port)
+        self.target = f'http://127.0.0.1:{port}'
+
+    def spawn(self, command, env=None):
+        process = subprocess.Popen(command, cwd=ROOT, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.processes.append(process)
+        return process
+
+    def close(self):
+        for process in reversed(self.processes):
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def run_level(target, payload, concurrency, total):
+    """Отправляет total запросов из concurrency потоков с keep-alive"""
+    parsed = urlparse(target)
+    body = json.dumps(payload).encode('utf-8')
+    counter = iter(range(total))
+    lock = threading.Lock()
+    latencies = []
+    errors = {}
+
+    def worker():
+        connection = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=300)
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    break
+            started = time.perf_counter()
+            try:
+                connection.request('POST', '/api/generate', body, {'Content-Type': 'application/json'})
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+                if response.getheader('Connection', '').lower() == 'close':
+                    connection.close()
+            except (OSError, http.client.HTTPException) as e:
+                status = type(e).__name__
+                connection.close()
+            elapsed = time.perf_counter() - started
+            with lock:
+                if status == 200:
+                    latencies.append(elapsed)
+                else:
+                    errors[str(status)] = errors.get(str(status), 0) + 1
+        connection.close()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    def ms(value):
+        return round(value * 1000, 1) if value is not None else None
+
+    return {
+        'concurrency': concurrency,
+        'requests': total,
+        'ok': len(latencies),
+        'errors': errors,
+        'wall_s': round(wall, 3),
+        'throughput_rps': round(len(latencies) / wall, 2) if wall else None,
+        'mean_ms': ms(sum(latencies) / len(latencies)) if latencies else None,
+        'p50_ms': ms(percentile(latencies, 0.50)),
+        'p95_ms': ms(percentile(latencies, 0.95)),
+        'p99_ms': ms(percentile(latencies, 0.99)),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+COMPARED = ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms', 'peak_rss_mb')
+
+
+def print_levels(levels):
+    print(f'{"conc":>5} {"ok":>6} {"err":>5} {"rps":>9} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"rss MB":>8}')
+    for level in levels:
+        values = [level.get(name) for name in COMPARED]
+        cells = [f'{value:>9}' if value is not None else f'{"-":>9}' for value in values[:4]]
+        rss = level.get('peak_rss_mb')
+        print(f'{level["concurrency"]:>5} {level["ok"]:>6} {sum(level["errors"].values()):>5} '
+              + ' '.join(cells) + f' {rss if rss is not None else "-":>8}')
+
+
+def print_comparison(levels, baseline):
+    """Изменения относительно baseline по совпадающим уровням параллелизма"""
+    previous = {level['concurrency']: level for level in baseline['levels']}
+    print(f'\nсравнение с {baseline["meta"].get("revision") or "baseline"} ({baseline["meta"].get("created")}):')
+    for level in levels:
+        old = previous.get(level['concurrency'])
+        if old is None:
+            continue
+        parts = []
+        for name in COMPARED:
+            before, after = old.get(name), level.get(name)
+            if before and after is not None:
+                parts.append(f'{name} {before} -> {after} ({(after - before) / before * 100:+.1f}%)')
+        print(f'  conc {level["concurrency"]}: ' + ', '.join(parts))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Нагрузочный тест /api/generate')
+    parser.add_argument('--target', help='URL уже запущенного сервера вместо локального окружения')
+    parser.add_argument('--concurrency', default='1,4,16', help='уровни параллелизма через запятую')
+    parser.add_argument('--requests', type=int, default=100, help='запросов на уровень')
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--model', default='dall-e-2')
+    parser.add_argument('--size', default='256x256')
+    parser.add_argument('--quality')
+    parser.add_argument('--n', type=int, default=1)
+    parser.add_argument('--inline', action='store_true', help='просить base64 в ответе')
+    parser.add_argument('--cache', action='store_true', help='не выключать кеш результатов на сервере')
+    parser.add_argument('--latency', type=float, default=0.2, help='задержка заглушки, с')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--response', choices=('auto', 'b64', 'url'), default='auto')
+    parser.add_argument('--image-side', type=int, default=256)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--server-workers', type=int, default=32)
+    parser.add_argument('--asgi', action='store_true', help='поднять сервер как asgi_app под uvicorn')
+    parser.add_argument('--server-env', action='append', default=[], metavar='NAME=VALUE')
+    parser.add_argument('--workdir', default=os.path.join(ROOT, 'bench', '.work'))
+    parser.add_argument('--save', help='сохранить результат в JSON')
+    parser.add_argument('--compare', help='сравнить с сохраненным JSON')
+    args = parser.parse_args(argv)
+
+    payload = {'model': args.model, 'prompt': 'benchmark', 'size': args.size, 'n': args.n}
+    if args.quality:
+        payload['quality'] = args.quality
+    if args.inline:
+        payload['inline'] = True
+
+    environment = None if args.target else Environment(args)
+    target = args.target or environment.target
+    pid = environment.server_pid if environment else None
+    try:
+        if args.warmup:
+            run_level(target, payload, 1, args.warmup)
+        levels = []
+        for concurrency in [int(value) for value in args.concurrency.split(',') if value.strip()]:
+            if pid:
+                reset_peak_rss(pid)
+            level = run_level(target, payload, concurrency, args.requests)
+            level['peak_rss_mb'] = read_peak_rss(pid) if pid else None
+            levels.append(level)
+    finally:
+        if environment:
+            environment.close()
+
+    result = {
+        'meta': {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'target': args.target or 'local',
+            'server': None if args.target else ('asgi' if args.asgi else 'threads'),
+            'payload': payload,
+            'stub': None if args.target else {
+                'latency': args.latency, 'jitter': args.jitter, 'response': args.response,
+                'image_side': args.image_side, 'error_rate': args.error_rate,
+            },
+        },
+        'levels': levels,
+    }
+    print_levels(levels)
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(levels, json.load(f))
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, 'w') as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+            f.write('\n')
+        print(f'\nсохранено в {args.save}')
+
+
+if __name__ == '__main__':
+    main()
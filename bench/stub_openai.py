@@ -0,0 +1,182 @@
+"""Локальная заглушка OpenAI Images API для нагрузочных тестов.
+
+Отвечает на POST /v1/images/generations, /v1/images/edits и /v1/images/variations
+как настоящий API: base64 в JSON или ссылки на /files/<id>.png, которые отдает сама.
+Задержка, размер картинок и доля ошибок настраиваются аргументами.
+
+    python bench/stub_openai.py --port 9100 --latency 1.5 --jitter 0.5 --response url
+
+Приложение направляется на заглушку через OPENAI_BASE_URL=http://127.0.0.1:9100/v1,
+скачивание по ссылкам идет на тот же адрес.
+"""
+
+import argparse
+import base64
+import itertools
+import json
+import os
+import random
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def _chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+
+def make_png(side, seed=0):
+    """Шумный PNG side x side: почти не сжимается, размер близок к настоящим картинкам"""
+    rng = random.Random(seed)
+    row_bytes = side * 3
+    rows = [b'\x00' + rng.randbytes(row_bytes) for _ in range(side)]
+    header = struct.pack('>IIBBBBB', side, side, 8, 2, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + _chunk(b'IHDR', header)
+            + _chunk(b'IDAT', zlib.compress(b''.join(rows), 1)) + _chunk(b'IEND', b''))
+
+
+class StubState:
+    """Настройки заглушки и готовые картинки"""
+
+    def __init__(self, latency=0.0, jitter=0.0, response='auto', image_side=256, error_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.response = response
+        self.error_rate = error_rate
+        self.image = make_png(image_side)
+        # tEXt-чанк с номером делает каждую картинку уникальной для хранилища по хешу
+        self._iend = len(self.image) - 12
+        self._counter = itertools.count()
+        self.files = {}
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def unique_image(self):
+        number = next(self._counter)
+        return self.image[:self._iend] + _chunk(b'tEXt', b'n\x00' + str(number).encode()) + self.image[self._iend:]
+
+    def remember(self, content):
+        file_id = os.urandom(8).hex()
+        with self._lock:
+            self.files[file_id] = content
+            # Ссылки живут недолго, как и настоящие
+            while len(self.files) > 1000:
+                self.files.pop(next(iter(self.files)))
+        return file_id
+
+    def sleep(self):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_request(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            return json.loads(body or b'{}')
+        # multipart правок и вариаций не разбираем, достаточно n по умолчанию
+        return {}
+
+    def do_POST(self):
+        state = self.server.state
+        data = self.read_request()
+        with state._lock:
+            state.requests += 1
+        if not self.path.startswith('/v1/images/'):
+            self.send_body(404, b'{"error": {"message": "not found"}}')
+            return
+
+        state.sleep()
+        if state.error_rate and random.random() < state.error_rate:
+            self.send_body(500, b'{"error": {"message": "stub failure", "type": "server_error"}}')
+            return
+
+        n = int(data.get('n') or 1)
+        if data.get('stream'):
+            self.stream_images(data)
+            return
+
+        mode = state.response
+        if mode == 'auto':
+            # Как у OpenAI: gpt-image-1 отдает base64, DALL·E по умолчанию ссылки
+            mode = 'b64' if data.get('model') == 'gpt-image-1' or data.get('response_format') == 'b64_json' else 'url'
+        items = []
+        for _ in range(n):
+            content = state.unique_image()
+            if mode == 'b64':
+                items.append({'b64_json': base64.b64encode(content).decode('ascii')})
+            else:
+                host = self.headers.get('Host') or f'127.0.0.1:{self.server.server_port}'
+                items.append({'url': f'http://{host}/files/{state.remember(content)}.png'})
+        self.send_body(200, json.dumps({'created': int(time.time()), 'data': items}).encode('utf-8'))
+
+    def stream_images(self, data):
+        state = self.server.state
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        b64 = base64.b64encode(state.unique_image()).decode('ascii')
+        for index in range(int(data.get('partial_images') or 0)):
+            event = {'type': 'image_generation.partial_image', 'b64_json': b64,
+                     'partial_image_index': index, 'output_format': 'png'}
+            self.wfile.write(f'event: {event["type"]}\ndata: {json.dumps(event)}\n\n'.encode('utf-8'))
+            self.wfile.flush()
+        event = {'type': 'image_generation.completed', 'b64_json': b64, 'output_format': 'png'}
+        self.wfile.write(f'event: {event["type"]}\ndata: {json.dumps(event)}\n\n'.encode('utf-8'))
+        self.wfile.flush()
+
+    def do_GET(self):
+        state = self.server.state
+        if self.path.startswith('/files/'):
+            content = state.files.get(self.path[len('/files/'):].split('.')[0])
+            if content is not None:
+                self.send_body(200, content, 'image/png')
+                return
+        self.send_body(404, b'{"error": {"message": "not found"}}')
+
+
+class StubServer(ThreadingHTTPServer):
+    # Сотни одновременных подключений не должны упираться в backlog по умолчанию (5)
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Заглушка OpenAI Images API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9100)
+    parser.add_argument('--latency', type=float, default=0.0, help='базовая задержка ответа, с')
+    parser.add_argument('--jitter', type=float, default=0.0, help='случайная добавка к задержке, с')
+    parser.add_argument('--response', choices=('auto', 'b64', 'url'), default='auto')
+    parser.add_argument('--image-side', type=int, default=256, help='сторона картинки в пикселях')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля ответов 500')
+    args = parser.parse_args(argv)
+
+    server = StubServer((args.host, args.port), StubHandler)
+    server.state = StubState(args.latency, args.jitter, args.response, args.image_side, args.error_rate)
+    print(f'stub listening on http://{args.host}:{server.server_port}/v1', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()